@@ -22,6 +22,9 @@ def process_file(vc, options):
         people = json.load(f)
 
     destinations = []
+    if options.store:
+        from peoplestore import PeopleStore
+        store = PeopleStore(options.store)
 
     for id in people:
         person = people[id]
@@ -39,6 +42,11 @@ def process_file(vc, options):
                 e = vc.get_embedding(options.audiofile, time[0], time[1])
                 embeddings.append(e)
 
+        if options.store:
+            store.add_person(newperson, embeddings)
+            print("Added to store", options.store)
+            continue
+
         newperson["voice"] = base64.b64encode(pickle.dumps(embeddings)).decode("ascii")
 
         # Target file
@@ -57,6 +65,10 @@ def process_file(vc, options):
             json.dump(newperson, f, indent=" ")
 
         print("Saved to", dst)
+
+    if options.store:
+        store.save()
+        destinations.append(options.store)
     return destinations
 
 if __name__ == "__main__":
@@ -71,14 +83,22 @@ if __name__ == "__main__":
     parser.add_argument('times', type=str, nargs='*', help="Times, format start-end e.g. 1.0-5.2")
     parser.add_argument("-d", "--dest", dest="dst", help="Destination", required=False)
     parser.add_argument("-a", "--avatar", dest="avatar", help="Avatar img")
+    parser.add_argument("--store", dest="store", help="Add to this people store (directory) instead of writing json files")
+    parser.add_argument("--cache", dest="cache", help="Embedding cache directory, default the directory of the audio file, '' to disable")
 
     options = parser.parse_args()
 
     if not options.name and not options.src:
         raise SystemExit("Need either a name or a file with multiple people")
 
-    from modules.mod_speaker_identification2 import VoiceCompare
-    vc = VoiceCompare(None)
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "modules"))
+    from mod_speaker_identification2 import VoiceCompare
+    from embeddingcache import EmbeddingCache
+
+    if options.cache is None:
+        options.cache = os.path.dirname(os.path.abspath(options.audiofile))
+    vc = VoiceCompare(None, cache=EmbeddingCache(options.cache) if options.cache else None)
     vc._load_model()
 
     if options.src:
@@ -102,6 +122,14 @@ if __name__ == "__main__":
     if options.avatar:
         person["src"] = options.avatar
 
+    if options.store:
+        from peoplestore import PeopleStore
+        store = PeopleStore(options.store)
+        store.add_person(person, embeddings)
+        store.save()
+        print("Added %s to %s" % (options.name, options.store))
+        raise SystemExit()
+
     # If we don't have a destination, put it under  ~/peopleDB/name.json
     # where " " is replaced with "_"
     if not options.dst:
@@ -0,0 +1,129 @@
+import math
+import time
+
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbour index for normalized embeddings.
+
+    The reference embeddings are clustered (spherical k-means) into nlist
+    lists. A query is only compared with the references in the nprobe
+    lists with the closest centroids, so nprobe trades recall for speed
+    (nprobe == nlist is an exact search). Every reference has a label (the
+    person it belongs to) and the search gives the best labels, which are
+    meant as a shortlist to be rescored exactly.
+    """
+
+    def __init__(self, vectors, labels, nlist=None, iterations=10, seed=0):
+        vectors = self.normalize(vectors)
+        labels = np.asarray(labels)
+        if len(vectors) != len(labels):
+            raise Exception("Need a label for every vector (%d vectors, %d labels)" %
+                            (len(vectors), len(labels)))
+        if not nlist:
+            nlist = max(1, int(math.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        self.num_labels = int(labels.max()) + 1 if len(labels) else 0
+
+        self.centroids = self._kmeans(vectors, nlist, iterations, seed)
+        assignment = (vectors @ self.centroids.T).argmax(axis=1)
+
+        # For every list, the vectors sorted by label, and where each label starts
+        self.lists = []
+        for l in range(len(self.centroids)):
+            members = np.flatnonzero(assignment == l)
+            members = members[np.argsort(labels[members], kind="stable")]
+            member_labels = labels[members]
+            starts = np.flatnonzero(np.r_[True, member_labels[1:] != member_labels[:-1]]) \
+                if len(members) else np.zeros(0, dtype=np.int64)
+            self.lists.append((vectors[members], starts, member_labels[starts]))
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    @staticmethod
+    def _kmeans(vectors, k, iterations, seed):
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), k, replace=False)]
+        for _ in range(iterations):
+            assignment = (vectors @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            counts = np.bincount(assignment, minlength=k)
+            empty = counts == 0
+            # Restart empty clusters on random vectors
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            centroids = IVFIndex.normalize(sums)
+        return centroids
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        Returns (labels, scores), both (len(queries), k), with the best
+        labels for every query and their best similarity, best first.
+        Missing labels (too few candidates in the probed lists) are -1.
+        """
+        queries = self.normalize(queries).reshape(-1, self.centroids.shape[1])
+        nprobe = min(nprobe, len(self.centroids))
+        k = min(k, self.num_labels)
+        if k <= 0 or nprobe <= 0:
+            return (np.full((len(queries), 0), -1, dtype=np.int64),
+                    np.zeros((len(queries), 0), dtype=np.float32))
+
+        probe = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        best = np.full((len(queries), self.num_labels), -np.inf, dtype=np.float32)
+        for l, (vectors, starts, labels) in enumerate(self.lists):
+            rows = np.flatnonzero((probe == l).any(axis=1))
+            if len(rows) == 0 or len(vectors) == 0:
+                continue
+            scores = np.maximum.reduceat(queries[rows] @ vectors.T, starts, axis=1)
+            cells = np.ix_(rows, labels)
+            best[cells] = np.maximum(best[cells], scores)
+
+        top = np.argpartition(-best, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(best, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        top[np.isneginf(top_scores)] = -1
+        return top, top_scores
+
+
+def benchmark(num_references, dim=192, per_person=10, num_queries=2000, nprobe=(4, 8, 16)):
+    """
+    Exact vs approximate search on synthetic embeddings, people are random
+    directions and their references and the queries noisy versions of them
+    """
+    rng = np.random.default_rng(1)
+    num_people = num_references // per_person
+    people = IVFIndex.normalize(rng.normal(size=(num_people, dim)))
+    labels = np.repeat(np.arange(num_people), per_person)
+    references = IVFIndex.normalize(people[labels] + rng.normal(scale=0.08, size=(len(labels), dim)))
+    truth = rng.integers(0, num_people, num_queries)
+    queries = IVFIndex.normalize(people[truth] + rng.normal(scale=0.08, size=(num_queries, dim)))
+
+    t = time.time()
+    exact = labels[(queries @ references.T).argmax(axis=1)]
+    exact_time = time.time() - t
+
+    t = time.time()
+    index = IVFIndex(references, labels)
+    build_time = time.time() - t
+
+    print("%d references (%d people), %d lists, built in %.2fs" %
+          (num_references, num_people, len(index.centroids), build_time))
+    print("  exact        %8.3fs" % exact_time)
+    for n in nprobe:
+        t = time.time()
+        found, _ = index.search(queries, k=5, nprobe=n)
+        ann_time = time.time() - t
+        recall = (found == exact[:, None]).any(axis=1).mean()
+        print("  nprobe %-4d  %8.3fs  recall@5 %.3f" % (n, ann_time, recall))
+
+
+if __name__ == "__main__":
+    for n in [1000, 10000, 100000]:
+        benchmark(n)
@@ -0,0 +1,122 @@
+"""
+Reading and writing the json files the stages pass between them.
+
+orjson or ujson is used if installed, the json module otherwise.
+Intermediate files (speaker turns, caches) are written compact, files
+that are published or read by people (word timestamps, subtitles, the
+cast) are indented, always by the json module, so they look the same
+with any backend.
+Files are written to a temporary file that is renamed into place, so a
+stage that is stopped half way never leaves a broken file for the next
+one, and a reader never sees half a file.
+"""
+
+import os
+import json
+import tempfile
+
+try:
+    import orjson
+    BACKEND = "orjson"
+except Exception:
+    try:
+        import ujson
+        BACKEND = "ujson"
+    except Exception:
+        BACKEND = "json"
+
+
+def _plain(obj):
+    # numpy arrays and scalars, which orjson writes by itself
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+
+def dumps(data, pretty=False):
+    """
+    data as json (bytes, utf-8). Pretty output always comes from the json
+    module, indented with one space like the rest of the repo, so it
+    looks the same whatever backend is installed.
+    """
+    if pretty:
+        return json.dumps(data, indent=" ", ensure_ascii=False, default=_plain).encode("utf-8")
+    if BACKEND == "orjson":
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    if BACKEND == "ujson":
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False,
+                      default=_plain).encode("utf-8")
+
+
+def loads(data):
+    if BACKEND == "orjson":
+        return orjson.loads(data)
+    if BACKEND == "ujson":
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def load(filename):
+    with open(filename, "rb") as f:
+        return loads(f.read())
+
+
+def load_segments(filename):
+    """
+    The segments of a transcript, both for a list of segments and a dict
+    with "segments" (whisper)
+    """
+    data = load(filename)
+    if isinstance(data, dict) and "segments" in data:
+        return data["segments"]
+    return data
+
+
+def write_atomic(filename, data):
+    """
+    Write data (bytes) to a temporary file next to filename, then rename
+    it to filename
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(filename) + ".",
+                               suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp makes the file only readable by us
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save(data, filename, pretty=False):
+    """
+    Save data as json, indented if pretty (for published files)
+    """
+    write_atomic(filename, dumps(data, pretty))
+
+
+def rename_speakers(segments, prefix="Taler_"):
+    """
+    Rename the speakers of segments (and their words) to prefix + number,
+    numbered in the order they first speak. Changes the segments, returns
+    {old name: new name}.
+    """
+    names = {}
+    for segment in segments:
+        if "speaker" in segment and segment["speaker"] not in names:
+            names[segment["speaker"]] = "%s%02d" % (prefix, len(names))
+
+    for segment in segments:
+        if segment.get("speaker") in names:
+            segment["speaker"] = names[segment["speaker"]]
+        for word in segment.get("words", []):
+            if word.get("speaker") in names:
+                word["speaker"] = names[word["speaker"]]
+    return names
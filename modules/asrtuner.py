@@ -0,0 +1,137 @@
+import os
+import json
+import time
+
+import numpy as np
+
+PROFILE = os.environ.get("ASR_PROFILE", os.path.expanduser("~/.cache/transcribe/asr_profiles.json"))
+
+DEFAULTS = {
+    "chunk_length_s": 28,
+    "stride_length_s": 2,
+    "batch_size": 6
+}
+
+
+def synthetic_clip(seconds=60, sample_rate=16000, seed=0):
+    """
+    A speech like clip for calibration: voiced "syllables" (a few
+    harmonics of a gliding pitch with an envelope) separated by short
+    pauses, plus a little noise. What matters for calibration is that the
+    model decodes full length outputs, not what it says.
+    """
+    rng = np.random.default_rng(seed)
+    audio = np.zeros(seconds * sample_rate, dtype=np.float32)
+    pos = 0
+    while pos < len(audio):
+        length = int(rng.uniform(0.1, 0.35) * sample_rate)
+        t = np.arange(length) / sample_rate
+        pitch = rng.uniform(90, 220) * (1 + 0.2 * t / t[-1] * rng.uniform(-1, 1))
+        phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+        syllable = sum(np.sin(h * phase) / h for h in range(1, 6))
+        syllable *= np.sin(np.pi * t / t[-1]) * rng.uniform(0.2, 0.5)
+        end = min(len(audio), pos + length)
+        audio[pos:end] = syllable[:end - pos]
+        pos = end + int(rng.choice([0.05, 0.05, 0.1, 0.4]) * sample_rate)
+    audio += rng.normal(scale=0.005, size=len(audio)).astype(np.float32)
+    return audio
+
+
+def calibrate(pipeline, num_beams=(1, 3, 5), batch_sizes=(1, 2, 4, 8, 16, 32),
+              chunk_lengths=(20, 28), stride_length_s=2, seconds=60, memory_fraction=0.85,
+              generate_kwargs={}):
+    """
+    Run the pipeline over a synthetic clip for a grid of settings, and find
+    the fastest for each number of beams that stays within memory_fraction
+    of the GPU memory. Bigger batches are not tried once a batch size runs
+    out of memory or gets slower.
+    Returns {num_beams: {"chunk_length_s", "stride_length_s", "batch_size",
+    "speed" (seconds of audio per second), "peak_mb"}, ...}
+    """
+    import torch
+    device = pipeline.device
+    on_gpu = device.type == "cuda"
+    budget = torch.cuda.get_device_properties(device).total_memory * memory_fraction if on_gpu else None
+    clip = synthetic_clip(seconds)
+
+    best = {}
+    for beams in num_beams:
+        for chunk_length in chunk_lengths:
+            last_speed = 0
+            for batch_size in batch_sizes:
+                if on_gpu:
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats(device)
+                kwargs = dict(generate_kwargs)
+                kwargs["num_beams"] = beams
+                try:
+                    t = time.time()
+                    pipeline({"raw": clip, "sampling_rate": 16000}, generate_kwargs=kwargs,
+                             chunk_length_s=chunk_length, stride_length_s=stride_length_s,
+                             batch_size=batch_size)
+                    speed = seconds / (time.time() - t)
+                except RuntimeError as e:
+                    if "out of memory" not in str(e):
+                        raise
+                    print("  beams %d, chunks %ds, batch %d: out of memory" % (beams, chunk_length, batch_size))
+                    break
+                peak = torch.cuda.max_memory_allocated(device) if on_gpu else 0
+                print("  beams %d, chunks %ds, batch %d: %.1fx realtime, %d MB" %
+                      (beams, chunk_length, batch_size, speed, peak / (1024 * 1024)))
+                if budget and peak > budget:
+                    break
+                if beams not in best or speed > best[beams]["speed"]:
+                    best[beams] = {"chunk_length_s": chunk_length,
+                                   "stride_length_s": stride_length_s,
+                                   "batch_size": batch_size,
+                                   "speed": speed,
+                                   "peak_mb": int(peak / (1024 * 1024))}
+                if speed < last_speed:
+                    break  # Saturated
+                last_speed = speed
+
+    if on_gpu:
+        torch.cuda.empty_cache()
+    return best
+
+
+def load_profiles(filename=PROFILE):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def save_profile(key, profile, filename=PROFILE):
+    """
+    Add or replace a profile, written atomically as several nodes may
+    share a home directory
+    """
+    profiles = load_profiles(filename)
+    profiles[key] = profile
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".%d" % os.getpid(), "w") as f:
+        json.dump(profiles, f, indent=" ")
+    os.replace(filename + ".%d" % os.getpid(), filename)
+
+
+def get_settings(pipe, model, num_beams=3, autotune=True, log=None):
+    """
+    The pipeline settings for the model on this device, from the profile.
+    If there is no profile yet and autotune is set, the pipeline (a model
+    server handle) is calibrated first. Falls back to the defaults.
+    """
+    key = "%s|%s" % (pipe.device_name(), model)
+    profiles = load_profiles()
+    if key not in profiles and autotune:
+        if log:
+            log.info("No pipeline profile for %s, calibrating" % key)
+        profiles[key] = {str(k): v for k, v in pipe.calibrate().items()}
+        save_profile(key, profiles[key])
+
+    settings = dict(DEFAULTS)
+    profile = profiles.get(key, {})
+    if str(num_beams) in profile:
+        for name in DEFAULTS:
+            settings[name] = profile[str(num_beams)][name]
+    return settings
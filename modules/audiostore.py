@@ -0,0 +1,169 @@
+import os
+import math
+import struct
+import hashlib
+import threading
+
+import numpy as np
+
+
+class AudioStore:
+    """
+    Memory mapped access to a PCM wav file.
+
+    The file is mapped once and every caller gets views into the same
+    mapping, so a stage that needs thousands of small bits of audio (VAD
+    frames, embedding windows) never re-opens or re-decodes the file.
+    Only 16 bit PCM is supported, which is what ffmpeg gives us.
+    """
+    _stores = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(path):
+        """
+        Return a (cached) store for the given wav file. The cache is keyed
+        on the path, and a store is re-opened if the file has changed.
+        """
+        key = os.path.abspath(path)
+        st = os.stat(key)
+        with AudioStore._lock:
+            store = AudioStore._stores.get(key)
+            if not store or store._stat != (st.st_size, st.st_mtime):
+                store = AudioStore(key)
+                AudioStore._stores[key] = store
+            return store
+
+    @staticmethod
+    def release(path):
+        """
+        Drop a cached store, e.g. before removing a temporary file
+        """
+        with AudioStore._lock:
+            AudioStore._stores.pop(os.path.abspath(path), None)
+
+    def __init__(self, path):
+        self.path = path
+        st = os.stat(path)
+        self._stat = (st.st_size, st.st_mtime)
+
+        offset, length, self.channels, self.sample_rate, self.sample_width = \
+            self._parse_header(path, st.st_size)
+
+        if self.sample_width != 2:
+            raise Exception("Only 16 bit PCM is supported, '%s' has %d bit" %
+                            (path, self.sample_width * 8))
+
+        frame_size = self.sample_width * self.channels
+        self.num_samples = length // frame_size
+        if self.num_samples:
+            data = np.memmap(path, dtype="<i2", mode="r", offset=offset,
+                             shape=(self.num_samples * self.channels,))
+        else:
+            data = np.zeros(0, dtype="<i2")
+        self._data = data.reshape(-1, self.channels) if self.channels > 1 else data
+        self.duration = self.num_samples / float(self.sample_rate)
+        self._hash = None
+
+    @staticmethod
+    def _parse_header(path, filesize):
+        """
+        Find the format and the data chunk of a RIFF/WAVE file.
+        Returns (data offset, data length, channels, sample rate, sample width)
+        """
+        fmt = None
+        with open(path, "rb") as f:
+            riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+            if riff != b"RIFF" or wave != b"WAVE":
+                raise Exception("Not a wav file: '%s'" % path)
+
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise Exception("Missing data chunk in '%s'" % path)
+                chunk_id, chunk_size = struct.unpack("<4sI", header)
+                if chunk_id == b"fmt ":
+                    tag, channels, rate, _, _, bits = struct.unpack("<HHIIHH", f.read(16))
+                    if tag not in (1, 0xFFFE):  # PCM or WAVE_FORMAT_EXTENSIBLE
+                        raise Exception("Unsupported wav encoding %d in '%s'" % (tag, path))
+                    fmt = (channels, rate, bits // 8)
+                    f.seek(chunk_size - 16 + (chunk_size % 2), 1)
+                elif chunk_id == b"data":
+                    if not fmt:
+                        raise Exception("Data before format chunk in '%s'" % path)
+                    offset = f.tell()
+                    # Streamed wavs (ffmpeg to a pipe) have a bogus size
+                    length = min(chunk_size, filesize - offset)
+                    return (offset, length) + fmt
+                else:
+                    f.seek(chunk_size + (chunk_size % 2), 1)
+
+    def hash(self):
+        """
+        Hash of the audio content (format and samples), so the same audio
+        is recognized whatever the file is called
+        """
+        if not self._hash:
+            h = hashlib.sha1(b"%d:%d:%d:" % (self.sample_rate, self.channels, self.sample_width))
+            data = memoryview(self._data).cast("B")
+            block = 1 << 24
+            for offset in range(0, len(data), block):
+                h.update(data[offset:offset + block])
+            self._hash = h.hexdigest()
+        return self._hash
+
+    def _range(self, start, end):
+        """
+        Sample range for the given time span (in seconds). Rounds like the
+        old wave based readers did, floor for the start, ceil for the length.
+        """
+        first = max(0, math.floor(self.sample_rate * start))
+        if end is None:
+            return first, self.num_samples
+        last = first + math.ceil(self.sample_rate * (end - start))
+        return first, min(max(first, last), self.num_samples)
+
+    def get_pcm(self, start=0, end=None):
+        """
+        Zero copy int16 view of the given time span
+        """
+        first, last = self._range(start, end)
+        return self._data[first:last]
+
+    def get_samples(self, first, count):
+        """
+        Zero copy int16 view of count samples from the given sample
+        """
+        return self._data[first:first + count]
+
+    def get_bytes(self, start=0, end=None):
+        """
+        The raw PCM bytes of the given time span as a memoryview (for
+        webrtcvad, wave.writeframes and friends).
+        """
+        return memoryview(self.get_pcm(start, end)).cast("B")
+
+    def get_float(self, start=0, end=None):
+        """
+        Mono float32 signal in [-1, 1) for the given time span. Multichannel
+        audio is mixed down. This is necessarily a copy.
+        """
+        return self.to_float(self.get_pcm(start, end))
+
+    @staticmethod
+    def to_float(pcm):
+        if pcm.ndim > 1:
+            return pcm.mean(axis=1, dtype=np.float32) / 32768.0
+        return pcm.astype(np.float32) / 32768.0
+
+    def write_segment(self, dst_file, start, end):
+        """
+        Write the given time span to a new wav file
+        """
+        import wave
+        with wave.open(dst_file, "w") as dst:
+            dst.setsampwidth(self.sample_width)
+            dst.setnchannels(self.channels)
+            dst.setframerate(self.sample_rate)
+            dst.writeframes(self.get_bytes(start, end))
+        return dst_file
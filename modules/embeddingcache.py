@@ -0,0 +1,117 @@
+import os
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of speaker embeddings.
+
+    Embeddings are keyed on a hash of the audio data, the model and the
+    window (first sample, number of samples), so reprocessing or rerunning
+    a workflow on the same audio never recomputes them, whatever the wav
+    file is called. Everything lives in a single sqlite file, by default
+    next to the wav. The cache is opened lazily and old or excess entries
+    are evicted when it is opened.
+    """
+    FILENAME = "embeddings_cache.sqlite"
+
+    def __init__(self, directory, max_size_mb=2048, max_age_days=30):
+        self.filename = os.path.join(directory, EmbeddingCache.FILENAME)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_age = max_age_days * 86400
+        self._conn = None
+        self._loaded = {}  # (audio, model) -> {(first, count): vector}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn:
+            return self._conn
+
+        self._conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                audio TEXT, model TEXT, first INTEGER, count INTEGER,
+                                vector BLOB,
+                                PRIMARY KEY (audio, model, first, count))""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS audio (
+                                audio TEXT, model TEXT, used REAL,
+                                PRIMARY KEY (audio, model))""")
+        self._conn.commit()
+        self.evict()
+        return self._conn
+
+    def evict(self):
+        """
+        Remove everything that hasn't been used for max_age, then the least
+        recently used audio until the file is below max_size
+        """
+        c = self._connect()
+        now = time.time()
+        old = c.execute("SELECT audio, model FROM audio WHERE used < ?",
+                        (now - self.max_age,)).fetchall()
+
+        if os.path.getsize(self.filename) > self.max_size:
+            sizes = c.execute("""SELECT a.audio, a.model, SUM(LENGTH(e.vector)) FROM audio a
+                                 JOIN embeddings e ON a.audio = e.audio AND a.model = e.model
+                                 WHERE a.used >= ? GROUP BY a.audio, a.model
+                                 ORDER BY a.used""", (now - self.max_age,)).fetchall()
+            total = sum(size for _, _, size in sizes)
+            for audio, model, size in sizes:
+                if total <= self.max_size * 0.8:
+                    break
+                old.append((audio, model))
+                total -= size
+
+        if not old:
+            return 0
+
+        c.executemany("DELETE FROM embeddings WHERE audio = ? AND model = ?", old)
+        c.executemany("DELETE FROM audio WHERE audio = ? AND model = ?", old)
+        c.commit()
+        c.execute("VACUUM")
+        return len(old)
+
+    def _load(self, audio, model):
+        key = (audio, model)
+        if key not in self._loaded:
+            c = self._connect()
+            rows = c.execute("SELECT first, count, vector FROM embeddings WHERE audio = ? AND model = ?",
+                             key).fetchall()
+            self._loaded[key] = {(first, count): np.frombuffer(vector, dtype=np.float32)
+                                 for first, count, vector in rows}
+            c.execute("INSERT OR REPLACE INTO audio (audio, model, used) VALUES (?, ?, ?)",
+                      (audio, model, time.time()))
+            c.commit()
+        return self._loaded[key]
+
+    def get(self, audio, model, first, count):
+        """
+        Returns the cached vector for the window or None
+        """
+        with self._lock:
+            return self._load(audio, model).get((first, count))
+
+    def put(self, audio, model, items):
+        """
+        Store a list of ((first, count), vector) for the given audio
+        """
+        if not items:
+            return
+        with self._lock:
+            loaded = self._load(audio, model)
+            rows = []
+            for (first, count), vector in items:
+                vector = np.ascontiguousarray(vector, dtype=np.float32).reshape(-1)
+                loaded[(first, count)] = vector
+                rows.append((audio, model, first, count, vector.tobytes()))
+            c = self._connect()
+            c.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            c.commit()
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
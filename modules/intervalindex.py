@@ -0,0 +1,112 @@
+import bisect
+import itertools
+
+
+class IntervalIndex:
+    """
+    Sorted array index of time intervals (start, end) per key, typically
+    the blocks each speaker talks in.
+
+    For every key the intervals are kept as sorted arrays of starts and
+    ends with prefix sums, so how long each key overlaps a given time span
+    or the total weight of the intervals of each key that touch it are a
+    couple of bisects per key, however many intervals there are.
+    """
+
+    def __init__(self):
+        self._intervals = {}  # key -> [(start, end, weight)]
+        self._index = None
+
+    @staticmethod
+    def from_cast(cast):
+        """
+        Index a cast, {person: [{"start": .., "end": ..}, ...]}
+        """
+        index = IntervalIndex()
+        for person in cast:
+            index._intervals.setdefault(person, [])
+            for entry in cast[person]:
+                index.add(person, entry["start"], entry["end"])
+        return index
+
+    def add(self, key, start, end, weight=1):
+        self._intervals.setdefault(key, []).append((start, end, weight))
+        self._index = None
+
+    def keys(self):
+        return list(self._intervals)
+
+    def _build(self):
+        """
+        For every key, the merged (non-overlapping) intervals with prefix
+        sums of their durations for overlap(), and the starts and ends of
+        the intervals as given, each sorted with prefix sums of the weights,
+        for weights()
+        """
+        self._index = {}
+        for key, intervals in self._intervals.items():
+            merged = []
+            for start, end, _ in sorted(intervals):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            starts = [s for s, _ in merged]
+            ends = [e for _, e in merged]
+            durations = [0] + list(itertools.accumulate(e - s for s, e in merged))
+
+            by_start = sorted((s, w) for s, _, w in intervals)
+            by_end = sorted((e, w) for _, e, w in intervals)
+            self._index[key] = (
+                starts, ends, durations,
+                [s for s, _ in by_start], [0] + list(itertools.accumulate(w for _, w in by_start)),
+                [e for e, _ in by_end], [0] + list(itertools.accumulate(w for _, w in by_end)))
+
+    def overlap(self, start, end):
+        """
+        Returns {key: seconds} for the keys that overlap start-end
+        """
+        if self._index is None:
+            self._build()
+
+        overlaps = {}
+        for key, (starts, ends, durations, _, _, _, _) in self._index.items():
+            first = bisect.bisect_right(ends, start)  # First block ending after start
+            last = bisect.bisect_left(starts, end)  # Blocks before this start before end
+            if last <= first:
+                continue
+            overlap = durations[last] - durations[first]
+            overlap -= max(0, start - starts[first])
+            overlap -= max(0, ends[last - 1] - end)
+            if overlap > 0:
+                overlaps[key] = overlap
+        return overlaps
+
+    def most_overlap(self, start, end):
+        """
+        The key that overlaps start-end the most, None if there are none.
+        On ties the key that was added first wins.
+        """
+        best = None
+        for key, overlap in self.overlap(start, end).items():
+            if best is None or overlap > best[1]:
+                best = (key, overlap)
+        return best[0] if best else None
+
+    def weights(self, start, end):
+        """
+        Returns {key: total weight} of the intervals that touch start-end
+        (start <= end of the interval and the interval's start <= end),
+        only for keys that have such intervals
+        """
+        if self._index is None:
+            self._build()
+
+        weights = {}
+        for key, (_, _, _, starts, start_weights, ends, end_weights) in self._index.items():
+            # Everything that starts before end, except what ends before start
+            first = bisect.bisect_left(ends, start)
+            last = bisect.bisect_right(starts, end)
+            if last > first:
+                weights[key] = start_weights[last] - end_weights[first]
+        return weights
@@ -5,6 +5,8 @@ import copy
 import time
 import os
 
+import artefacts
+
 try:
     from sentence_transformers import SentenceTransformer, util
 except:
@@ -31,6 +33,7 @@ pip install autofaiss sentence-transformers
 
 # from autofaiss import build_index
 import numpy as np
+from intervalindex import IntervalIndex
 
 
 ccmodule = {
@@ -94,13 +97,13 @@ The text:
 
 
 class GroupModel:
-    instance = None
-
+    """
+    Sentence embeddings, from the node's model server if it runs
+    """
     @staticmethod
     def get(model="NbAiLab/nb-sbert"):
-        if not GroupModel.instance:
-            GroupModel.instance = SentenceTransformer(model)
-        return GroupModel.instance
+        from modelserver import get_model
+        return get_model("sentence_transformer", model)
 
 
 class GroupSentences:
@@ -459,22 +462,14 @@ class GroupSentences:
         {"speaker": num_characters}
         """
 
-        for chapter in chapters:
-            speakers = {}
-            for sentence in sentences:
-                if sentence["who"] == None or sentence["who"] == "null":
-                    continue
-
-                if sentence["start"] > chapter["end"] or \
-                   sentence["end"] < chapter["start"]:
-                   continue
-
-                if sentence["who"] not in speakers:
-                    speakers[sentence["who"]] = len(sentence["text"])
-                else:                    
-                    speakers[sentence["who"]] += len(sentence["text"])
+        index = IntervalIndex()
+        for sentence in sentences:
+            if sentence["who"] == None or sentence["who"] == "null":
+                continue
+            index.add(sentence["who"], sentence["start"], sentence["end"], len(sentence["text"]))
 
-            chapter["speaking"] = speakers
+        for chapter in chapters:
+            chapter["speaking"] = index.weights(chapter["start"], chapter["end"])
 
         return chapters
 
@@ -513,8 +508,7 @@ def process_task(cc, task, stop_event):
 
     # Do actual work
     cc.status["progress"] = 0
-    with open(src, "r") as f:
-        source = json.load(f)
+    source = artefacts.load(src)
 
     groupie = GroupSentences(GroupModel.get(), cache_file=openai_cache)
     cc.status["progress"] = 15
@@ -555,11 +549,9 @@ def process_task(cc, task, stop_event):
             print(" --------------------------- ")
     finally:
         if dst:
-            with open(dst, "w") as f:
-                json.dump(chapters, f, indent=" ")
+            artefacts.save(chapters, dst, pretty=True)
         if summarize and freshness:
-            with open(dst_freshness, "w") as f:
-                json.dump(freshness, f, indent=" ")
+            artefacts.save(freshness, dst_freshness, pretty=True)
 
     cc.status["progress"] = 100
 
@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import contextlib
 import sys
 import wave
 import json
@@ -9,6 +8,12 @@ from argparse import ArgumentParser
 import tempfile
 import os
 
+import numpy as np
+
+from audiostore import AudioStore
+from segmentfile import SegmentWriter
+import nonspeech
+
 
 ccmodule = {
     "description": "Detect voices, create an output file with start,end tags",
@@ -16,15 +21,23 @@ ccmodule = {
     "provides": [],
     "inputs": {
         "src": "Source file to detect from (WAVE file)",
-        "dst": "Destination file, .json or .csv",
+        "dst": "Destination file, .json, .jsonl or .csv",
         "format": "Format for end file - autodetected if dst given, otherwise dst is named after format",
+        "incremental": "Write segments (.jsonl or .csv) as they are found to dst + '.partial', renamed to dst when done, so others can follow it (see segmentfile.py), default False",
         "agressive": "How agressive to be (1-3), default 2",
         "max_pause": "What's the maximum pause between segments for it to be detected as two?",
         "max_segment_length": "Max lenght of detected segments",
-        "output_dir": "Destination directory for wave segments - if blank no segments are stored"
+        "output_dir": "Destination directory for wave segments - if blank no segments are stored",
+        "workers": "Number of processes running voice detection on shards of the file, default 1. With more than 1 the file is sharded (see shard_length), and the output may differ from workers=1 near the shard edges",
+        "prefilter": "Skip blocks of clear silence or noise (by level and spectral flatness) without running the detector on them, default False",
+        "silence_db": "Prefilter: frames below this level (dBFS) are silence, default -50",
+        "max_flatness": "Prefilter: frames with a spectral flatness above this are noise, default 0.5",
+        "nonspeech": "Prefilter: destination file for the mask of skipped audio (used by mod_whisper and speaker identification), default next to dst",
+        "shard_length": "Length of the shards in seconds, default 600 if workers > 1. The detector restarts at each shard (after a lead in), so the result depends on this but not on the number of workers, and may differ from an unsharded run near the shard edges"
     },
     "outputs": {
-        "dst": "Output file"
+        "dst": "Output file",
+        "nonspeech": "Mask of the audio skipped by the prefilter (if used)"
     },
     "defaults": {
         "priority": 50,  # Normal
@@ -37,25 +50,135 @@ ccmodule = {
 }
 
 
-class Frame(object):
-    """Represents a "frame" of audio data."""
-    def __init__(self, bytes, timestamp, duration):
-        self.bytes = bytes
-        self.timestamp = timestamp
-        self.duration = duration
+class VadCollector:
+    """
+    Turns speech flags (one per frame) into voice segments, a block of
+    flags at a time. A segment starts at the first speech frame and ends
+    when padding_frames frames of silence have followed, or when it's
+    longer than max_segment_length (plus padding_frames frames).
+
+    The flags are handled a run of equal flags at a time, so the cost is
+    per segment, not per frame. Segments that start less than max_pause
+    after a short (< 4 seconds) segment are merged into that one.
+    """
+
+    def __init__(self, frame_duration_ms, padding_frames,
+                 output_dir=None, max_segment_length=None, max_pause=0):
+        self.frame_duration_ms = frame_duration_ms
+        self.padding_frames = padding_frames
+        self.output_dir = output_dir
+        self.max_segment_length = max_segment_length
+        self.max_pause = max_pause
+        self.segments = []
+
+        self._pos = 0  # Index of the next frame
+        self._triggered = False
+        self._start = 0  # First frame of the current segment
+        self._first = 0  # First frame with audio for the current segment
+        self._padding = 0
+
+    def _max_frames(self, start):
+        """
+        The number of frames after start before a segment is too long, the
+        smallest k for which k frames is more than max_segment_length
+        """
+        if self.max_segment_length is None:
+            return float("inf")
+        limit = self.max_segment_length * 1000
+        k = int(limit // self.frame_duration_ms)
+        while k > 0 and ((start + k) * self.frame_duration_ms) - start * self.frame_duration_ms > limit:
+            k -= 1
+        while not ((start + k) * self.frame_duration_ms) - start * self.frame_duration_ms > limit:
+            k += 1
+        return k
+
+    def add(self, flags):
+        """
+        Add a block of flags, returns the segments that were completed
+        (merged segments are only given the first time)
+        """
+        done = len(self.segments)
+        edges = np.flatnonzero(np.diff(flags)) + 1
+        starts = np.concatenate(([0], edges))
+        ends = np.concatenate((edges, [len(flags)]))
+        for run_start, run_end in zip(starts.tolist(), ends.tolist()):
+            self._run(bool(flags[run_start]), self._pos + run_start, self._pos + run_end)
+        self._pos += len(flags)
+        return self.segments[done:]
+
+    def _run(self, is_speech, pos, end):
+        """
+        A run of frames pos to end with the same flag
+        """
+        while pos < end:
+            if not self._triggered:
+                if not is_speech:
+                    return
+                self._triggered = True
+                self._start = pos
+                self._too_long = pos + self._max_frames(pos)
+                pos += 1
+                continue
+
+            if is_speech and pos < self._too_long:
+                # Speech resets the padding until the segment is too long
+                self._padding = 0
+                pos = min(end, self._too_long)
+                continue
+
+            last = pos + self.padding_frames - self._padding
+            if last >= end:
+                self._padding += end - pos
+                return
+            self._end_segment(last)
+            pos = last + 1
+
+    def _end_segment(self, idx):
+        frame_duration_ms = self.frame_duration_ms
+        start = self._start * frame_duration_ms
+        end = idx * frame_duration_ms
+        s = {"type": "voice", "start": start / 1000., "end": end / 1000., "idx": idx}
+        if self.output_dir:
+            s["file"] = os.path.join(self.output_dir, "segment_%08d.wav" % idx)
+            s["frames"] = (self._first, idx + 1)
+
+        segments = self.segments
+        if self.max_pause and len(segments) > 0:
+            if s["start"] - segments[-1]["end"] < self.max_pause and \
+             s["end"] - segments[-1]["start"] < self.max_segment_length:
+
+                # Only merge if the last segment is too short
+                if segments[-1]["end"] - segments[-1]["start"] < 4.0:
+                    print("MERGING", segments[-1]["end"], s["start"], segments[-1]["idx"])
+                    segments[-1]["end"] = s["end"]
+                    if self.output_dir:
+                        # The merged file has the audio of both
+                        segments[-1]["frames"] = (segments[-1]["frames"][0], idx + 1)
+                    s = None
+
+        if s:
+            segments.append(s)
+        self._triggered = False
+        self._padding = 0
+        self._first = idx + 1
 
 
 class VoiceDetector:
 
-    def __init__(self, sourcefile, output_dir=None):
+    def __init__(self, sourcefile, output_dir=None, sample_rate=16000):
 
         self.is_tmp = False
+        self.is_stream = False
         self.output_dir = output_dir
+        self.sample_rate = sample_rate  # For files that are decoded
 
-        if not sourcefile.endswith(".wav"):
+        if not sourcefile.endswith(".wav") and output_dir:
+            # Segment files are cut from the whole audio, so that needs a wav
             self.is_tmp = True
             self.sourcefile = self.convert(sourcefile)
         else:
+            # Other files are decoded by ffmpeg as we go
+            self.is_stream = not sourcefile.endswith(".wav")
             self.sourcefile = sourcefile
 
         if output_dir and not os.path.exists(output_dir):
@@ -63,143 +186,266 @@ class VoiceDetector:
 
     def __del__(self):
         if self.is_tmp:
+            AudioStore.release(self.sourcefile)
             os.remove(self.sourcefile)
 
-    def analyze(self, aggressive=2, max_segment_length=8, max_pause=0, framelen=30):
-        audio, sample_rate = self.read_wave(self.sourcefile)
-        vad = webrtcvad.Vad(int(aggressive))
-        frames = self.frame_generator(framelen, audio, sample_rate)
-        frames = list(frames)
-        segments = self.vad_collector(sample_rate, framelen, 3, vad, frames,
-                                      output_dir=self.output_dir,
-                                      max_segment_length=max_segment_length,
-                                      max_pause=max_pause)
-
-        return segments
+    def analyze(self, aggressive=2, max_segment_length=8, max_pause=0, framelen=30,
+                workers=1, shard_length=None, lead_in=30, prefilter=False, callback=None,
+                **prefilter_args):
+        """
+        Find the voice segments. If a callback is given, it's called as
+        callback(segments, seconds) as the detection goes on, with the
+        segments that are final (can't be merged with the next one any
+        more) and how far into the file it has got.
+        """
+        collector = VadCollector(framelen, 3, output_dir=self.output_dir,
+                                 max_segment_length=max_segment_length,
+                                 max_pause=max_pause)
+        skips = []
+        if self.is_stream:
+            # Sharding needs random access, streams are done in one go
+            blocks = self.stream_speech_flags(webrtcvad.Vad(int(aggressive)), framelen,
+                                              prefilter_args if prefilter else None, skips)
+        else:
+            audio, sample_rate = self.read_wave(self.sourcefile)
+            if prefilter:
+                skips.append(self.prefilter(framelen, **prefilter_args))
+            skip = skips[0] if skips else None
+            if workers > 1 and not shard_length:
+                shard_length = 600
+            if shard_length:
+                blocks = self.sharded_speech_flags(int(aggressive), len(audio), sample_rate, framelen,
+                                                   workers, shard_length, lead_in, skip)
+            else:
+                blocks = self.speech_flags(webrtcvad.Vad(int(aggressive)), audio, sample_rate, framelen,
+                                           skip=skip)
+
+        # The collector sees the flags in order whichever way they were made,
+        # so padding across shard edges is handled as in a single run
+        flags = []
+        done = 0
+        num_frames = 0
+        for block in blocks:
+            flags.append(block)
+            collector.add(block)
+            num_frames += len(block)
+            if callback:
+                # The last segment may still be merged with the next
+                final = len(collector.segments) - (1 if max_pause else 0)
+                callback(collector.segments[done:max(done, final)], num_frames * framelen / 1000.)
+                done = max(done, final)
+
+        # One byte per frame, kept for anyone needing more than the segments
+        self.flags = np.concatenate(flags) if flags else np.zeros(0, dtype=np.uint8)
+        self.nonspeech = nonspeech.from_flags(np.concatenate(skips), framelen) if skips else []
+
+        if self.output_dir:
+            self.write_segments(collector.segments, audio, sample_rate, framelen)
+        if callback:
+            callback(collector.segments[done:], num_frames * framelen / 1000.)
+        return collector.segments
 
     def read_wave(self, path):
         """Reads a .wav file.
 
-        Takes the path, and returns (PCM audio data, sample rate).
+        Takes the path, and returns (PCM audio data, sample rate). The data
+        is a memoryview into the shared memory mapped file, not a copy.
         """
-        with contextlib.closing(wave.open(path, 'rb')) as wf:
-            num_channels = wf.getnchannels()
-            # assert num_channels == 1
-            sample_width = wf.getsampwidth()
-            assert sample_width == 2
-            sample_rate = wf.getframerate()
-            assert sample_rate in (8000, 16000, 32000, 48000)
-            pcm_data = wf.readframes(wf.getnframes())
-            return pcm_data, sample_rate
-
-    def frame_generator(self, frame_duration_ms, audio, sample_rate):
-        """Generates audio frames from PCM audio data.
-
-        Takes the desired frame duration in milliseconds, the PCM data, and
-        the sample rate.
+        store = AudioStore.get(path)
+        # assert store.channels == 1
+        assert store.sample_width == 2
+        assert store.sample_rate in (8000, 16000, 32000, 48000)
+        return store.get_bytes(), store.sample_rate
 
-        Yields Frames of the requested duration.
+    def prefilter(self, frame_duration_ms, silence_db=-50.0, max_flatness=0.5, block_length=1.0):
+        """
+        Find blocks of block_length seconds that are clearly not speech:
+        every frame below silence_db (dBFS), or noise like, with a spectral
+        flatness (geometric over arithmetic mean of the power spectrum of
+        the block, smoothed over bands of 8 bins) above max_flatness.
+        Returns a uint8 array, 1 for the frames to skip.
+        """
+        store = AudioStore.get(self.sourcefile)
+        n = int(store.sample_rate * (frame_duration_ms / 1000.0))
+        pcm = store.get_pcm().reshape(-1)
+        num_frames = max(0, (len(pcm) * 2 - 1) // (n * 2))
+        block_frames = max(1, int(block_length * 1000 / frame_duration_ms))
+
+        skip = np.zeros(num_frames, dtype=np.uint8)
+        full_blocks = num_frames // block_frames  # A partial last block is never skipped
+        for first in range(0, full_blocks, 1000):
+            last = min(full_blocks, first + 1000)
+            skip[first * block_frames:last * block_frames] = self.skip_blocks(
+                pcm[first * block_frames * n:last * block_frames * n], n, block_frames,
+                silence_db, max_flatness)
+        return skip
+
+    @staticmethod
+    def skip_blocks(pcm, n, block_frames, silence_db, max_flatness):
         """
+        The prefilter for int16 PCM of whole blocks of block_frames frames
+        of n samples, returns 1 for every frame in a block to skip
+        """
+        frames = pcm.reshape(-1, n).astype(np.float32) * (1 / 32768.0)
+        num_blocks = len(frames) // block_frames
+        level = 10 * np.log10(np.einsum("ij,ij->i", frames, frames) / n + 1e-10)
+        quiet = (level < silence_db).reshape(-1, block_frames).all(axis=1)
+
+        # Only the blocks with sound need a spectrum, and every 4th frame
+        # of them is plenty to tell noise from speech
+        check = np.flatnonzero(~quiet)
+        sample = frames.reshape(num_blocks, block_frames, n)[check, ::4]
+        spectrum = (np.abs(np.fft.rfft(sample, n=512, axis=2)) ** 2).mean(axis=1)
+        bands = spectrum[:, :256].reshape(len(check), -1, 8).mean(axis=2) + 1e-10
+        flatness = np.exp(np.log(bands).mean(axis=1)) / bands.mean(axis=1)
+        noisy = np.zeros(num_blocks, dtype=bool)
+        noisy[check] = flatness > max_flatness
+        return np.repeat(quiet | noisy, block_frames).astype(np.uint8)
+
+    def decode(self, block_size=1 << 20):
+        """
+        Decode the source with ffmpeg to mono s16le PCM at self.sample_rate,
+        yields the raw bytes in blocks of up to block_size as they come
+        """
+        import subprocess
+        cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", self.sourcefile,
+               "-vn", "-ac", "1", "-ar", str(self.sample_rate), "-f", "s16le", "-"]
+        print(" ".join(cmd))
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            while True:
+                data = p.stdout.read(block_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            p.stdout.close()
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+        if p.returncode != 0:
+            raise Exception("ffmpeg failed decoding '%s': %s" %
+                            (self.sourcefile, p.stderr.read().decode("utf-8", "replace")))
+
+    def stream_speech_flags(self, vad, frame_duration_ms, prefilter_args=None, skips=None,
+                            block_frames=9900):
+        """
+        Speech flags like speech_flags(), for audio decoded by ffmpeg, so
+        only a block of audio is in memory at a time. With prefilter_args
+        the prefilter is run on each block too (the blocks are whole
+        prefilter blocks), and its flags are added to skips.
+        """
+        sample_rate = self.sample_rate
         n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
-        offset = 0
-        timestamp = 0.0
-        duration = (float(n) / sample_rate) / 2.0
-        while offset + n < len(audio):
-            yield Frame(audio[offset:offset + n], timestamp, duration)
-            timestamp += duration
-            offset += n
-
-    def vad_collector(self, sample_rate, frame_duration_ms,
-                      padding_frames, vad, frames,
-                      output_dir=None, max_segment_length=None, max_pause=0):
-        """
-        If output dir is given, speech audio segments are saved there
-        """
-        triggered = False
-        segments = []
-        voiced_frames = []
-        segment_data = []
-        frames_speech = 0
-        frames_audio = 0
-        padding = start = end = 0
-        for idx, frame in enumerate(frames):
-            is_speech = vad.is_speech(frame.bytes, sample_rate)
-            if is_speech:
-                frames_speech += 1
-            else:
-                frames_audio += 1
-
-            if is_speech:
-                segment_data.append(frame)
-
-            if not triggered and is_speech:
-                triggered = True
-                start = idx * frame_duration_ms
-                # segment_data = [frame]
-                # if start == 0:
-                #    raise SystemExit("What, starts with voice (%d)?" % idx)
-
-            elif triggered and (not is_speech or \
-                  (idx * frame_duration_ms) - start > max_segment_length * 1000):
-                if padding < padding_frames:
-                    padding += 1
-                    continue
-                triggered = False
-                end = idx * frame_duration_ms
-
-                s = {"type": "voice", "start": start / 1000., "end": end / 1000., "idx": idx}
-
-                if output_dir:
-                    target = os.path.join(output_dir, "segment_%08d.wav" % idx)
-
-                merged = False
-                if max_pause and len(segments) > 0:
-                    if s["start"] - segments[-1]["end"] < max_pause and \
-                     s["end"] - segments[-1]["start"] < max_segment_length:
-
-                        # Only merge if the last segment is too short
-                        if segments[-1]["end"] - segments[-1]["start"] < 4.0:
-                            merged = True
-                            # MERGE
-                            print("MERGING", segments[-1]["end"], s["start"], segments[-1]["idx"])
-                            segments[-1]["end"] = s["end"]
-                            # We should overwrite the last file if output_dir is given!
-                            if output_dir:
-                                target = segments[-1]["file"]
-                            s = segments[-1]
-                            if "data" in s:
-                                segment_data = segments[-1]["data"] + segment_data
-
-                # Save the audio segment if requested
-                if output_dir:
-                    # target = os.path.join(output_dir, "segment_%08d.wav" % idx)
-                    with wave.open(target, "w") as target_f:
-                        target_f.setnchannels(1)
-                        target_f.setsampwidth(2)
-                        target_f.setframerate(sample_rate)
-                        for d in segment_data:
-                            target_f.writeframes(d.bytes)
-                    s["file"] = target
-                s["data"] = segment_data
-
-                if not merged:
-                    segments.append(s)
-                start = end = padding = 0
-                segment_data = []
-            elif triggered and is_speech:
-                padding = 0
-
-        if output_dir:
-            for s in segments:
-                del s["data"]
-        return segments
+        prefilter_args = dict(prefilter_args) if prefilter_args is not None else None
+        if prefilter_args is not None:
+            prefilter_frames = max(1, int(prefilter_args.pop("block_length", 1.0) * 1000 / frame_duration_ms))
+            block_frames = max(1, block_frames // prefilter_frames) * prefilter_frames
+
+        def flags_for(pcm):
+            num_frames = max(0, (len(pcm) - 1) // n)
+            skip = None
+            if prefilter_args is not None:
+                full = num_frames // prefilter_frames * prefilter_frames
+                skip = np.zeros(num_frames, dtype=np.uint8)
+                if full:
+                    skip[:full] = self.skip_blocks(np.frombuffer(pcm[:full * n], dtype="<i2"),
+                                                   n // 2, prefilter_frames,
+                                                   prefilter_args.get("silence_db", -50.0),
+                                                   prefilter_args.get("max_flatness", 0.5))
+                skips.append(skip)
+            return next(self.speech_flags(vad, pcm, sample_rate, frame_duration_ms,
+                                          block_frames=max(1, num_frames), skip=skip), None)
+
+        pending = bytearray()
+        for data in self.decode():
+            pending += data
+            # Always keep a byte back, the last frame is only used if
+            # there's something after it (as for wav files)
+            while len(pending) > block_frames * n:
+                flags = flags_for(bytes(pending[:block_frames * n]) + b"\0")
+                del pending[:block_frames * n]
+                if flags is not None:
+                    yield flags
+        flags = flags_for(bytes(pending))
+        if flags is not None:
+            yield flags
+
+    def speech_flags(self, vad, audio, sample_rate, frame_duration_ms, block_frames=10000, skip=None):
+        """Runs the VAD over the PCM data.
+
+        Yields uint8 arrays of speech flags, one per frame of the given
+        duration, block_frames at a time. The frames are memoryview slices
+        of the audio, so nothing is copied, and a trailing partial (or
+        exactly fitting last) frame is skipped like it always was. Frames
+        set in skip are not speech and not given to the VAD.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        num_frames = max(0, (len(audio) - 1) // n)
+        for first in range(0, num_frames, block_frames):
+            last = min(num_frames, first + block_frames)
+            flags = np.zeros(last - first, dtype=np.uint8)
+            frames = range(first, last) if skip is None else np.flatnonzero(skip[first:last] == 0) + first
+            for idx in frames:
+                flags[idx - first] = vad.is_speech(audio[idx * n:(idx + 1) * n], sample_rate)
+            yield flags
+
+    def sharded_speech_flags(self, aggressive, audio_length, sample_rate, frame_duration_ms,
+                             workers, shard_length, lead_in, skip=None):
+        """
+        Speech flags made for shard_length seconds at a time (aligned to
+        frames) in a process pool, yielded in order. webrtcvad adapts to
+        the noise as it goes, so each shard starts lead_in seconds early
+        with a fresh detector. That's not bit identical to one pass over
+        the file, but the flags are the same for any number of workers.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        num_frames = max(0, (audio_length - 1) // n)
+        shard_frames = max(1, int(shard_length * 1000 / frame_duration_ms))
+        lead_in_frames = int(lead_in * 1000 / frame_duration_ms)
+        shards = [(first, min(num_frames, first + shard_frames))
+                  for first in range(0, num_frames, shard_frames)]
+
+        def shard_skip(first, last):
+            if skip is None:
+                return None
+            return skip[max(0, first - lead_in_frames):last]
+
+        if workers <= 1:
+            for first, last in shards:
+                yield shard_speech_flags(self.sourcefile, aggressive, frame_duration_ms,
+                                         first, last, lead_in_frames, shard_skip(first, last))
+            return
+
+        import concurrent.futures
+        import multiprocessing
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            futures = [pool.submit(shard_speech_flags, self.sourcefile, aggressive, frame_duration_ms,
+                                   first, last, lead_in_frames, shard_skip(first, last))
+                       for first, last in shards]
+            for future in futures:
+                yield future.result()
+
+    def write_segments(self, segments, audio, sample_rate, frame_duration_ms):
+        """
+        Save the speech frames of each segment as a wave file
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        for s in segments:
+            first, last = s.pop("frames")
+            with wave.open(s["file"], "w") as target_f:
+                target_f.setnchannels(1)
+                target_f.setsampwidth(2)
+                target_f.setframerate(sample_rate)
+                for idx in np.flatnonzero(self.flags[first:last]) + first:
+                    target_f.writeframes(audio[idx * n:(idx + 1) * n])
 
     def convert(self, mp3file):
 
         import subprocess
         fd, tmpfile = tempfile.mkstemp(suffix=".wav")
         print("Extracting audio to", tmpfile)
-        cmd = ["ffmpeg", "-i", mp3file, "-vn", "-ac", "1", "-y", tmpfile]
+        cmd = ["ffmpeg", "-i", mp3file, "-vn", "-ac", "1", "-ar", str(self.sample_rate), "-y", tmpfile]
         print(" ".join(cmd))
         s = subprocess.Popen(cmd, stderr=subprocess.PIPE)
         s.wait()
@@ -209,6 +455,24 @@ class VoiceDetector:
         return tmpfile
 
 
+def shard_speech_flags(path, aggressive, frame_duration_ms, first, last, lead_in_frames, skip=None):
+    """
+    Speech flags for frames first to last of a wav file, with a fresh
+    detector started lead_in_frames before first. skip is the prefilter
+    mask from the start of the lead in. Runs in a worker process.
+    """
+    store = AudioStore.get(path)
+    audio = store.get_bytes()
+    n = int(store.sample_rate * (frame_duration_ms / 1000.0) * 2)
+    vad = webrtcvad.Vad(aggressive)
+    start = max(0, first - lead_in_frames)
+    flags = np.zeros(last - start, dtype=np.uint8)
+    frames = range(start, last) if skip is None else np.flatnonzero(skip == 0) + start
+    for idx in frames:
+        flags[idx - start] = vad.is_speech(audio[idx * n:(idx + 1) * n], store.sample_rate)
+    return flags[first - start:]
+
+
 def process_task(cc, task):
 
     args = task["args"]
@@ -218,15 +482,46 @@ def process_task(cc, task):
         dst = os.path.splitext(src)[0] + "_segments." + args.get("format", "json")
 
     if os.path.exists(dst):
-        return 100, {"dst": dst}
+        retval = {"dst": dst}
+        if args.get("prefilter", False):
+            retval["nonspeech"] = args.get("nonspeech", None) or os.path.splitext(dst)[0] + "_nonspeech.json"
+        return 100, retval
     detector = VoiceDetector(src, output_dir=args.get("output_dir", None))
+    duration = AudioStore.get(detector.sourcefile).duration if not detector.is_stream else None
+
+    writer = None
+    if args.get("incremental", False) or dst.endswith(".jsonl"):
+        if dst.endswith(".json"):
+            raise Exception("Incremental output must be .jsonl or .csv, not '%s'" % dst)
+        writer = SegmentWriter(dst, src)
+
+    def progress(segments, seconds):
+        if writer:
+            writer.write(segments)
+        if duration:
+            cc.status["progress"] = min(99, int(100 * seconds / duration))
+
+    cc.status["state"] = "Detecting voice"
     segments = detector.analyze(aggressive=args.get("aggressive", 2),
                                 max_pause=float(args.get("max_pause", 0)),
-                                max_segment_length=float(args.get("max_segment_length", 30)))
+                                max_segment_length=float(args.get("max_segment_length", 30)),
+                                workers=int(args.get("workers", 1)),
+                                shard_length=float(args.get("shard_length", 0)),
+                                prefilter=args.get("prefilter", False),
+                                silence_db=float(args.get("silence_db", -50)),
+                                max_flatness=float(args.get("max_flatness", 0.5)),
+                                callback=progress)
+    retval = {"dst": dst}
+    if args.get("prefilter", False):
+        retval["nonspeech"] = args.get("nonspeech", None) or os.path.splitext(dst)[0] + "_nonspeech.json"
+        nonspeech.save(detector.nonspeech, retval["nonspeech"])
+        cc.log.info("Prefilter skipped %.1f seconds" % sum(m["end"] - m["start"] for m in detector.nonspeech))
 
     # Dump json
     print("Segments", segments)
-    if dst.endswith("json"):
+    if writer:
+        writer.close()
+    elif dst.endswith("json"):
         with open(dst, "w") as f:
             json.dump(segments, f, indent=" ")
     else:
@@ -242,4 +537,4 @@ def process_task(cc, task):
                                               item["end"] - item["start"],
                                               src))
 
-    return 100, {"dst": dst}
+    return 100, retval
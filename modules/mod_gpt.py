@@ -1,9 +1,10 @@
 import json
 import re
-import copy
 import os
 import math
 
+import wordalign
+
 try:
     import openai
     CANRUN = True
@@ -77,16 +78,11 @@ all line breaks and line numbers unchanged. Write in Norwegian."""
             json.dump(self.cache, f)
 
     def read_file(self, filename):
-        if filename.lower().endswith(".json"):
-            with open(filename, "r") as f:
-                data = json.load(f)
-        else:
+        if not filename.lower().endswith(".json"):
             raise SystemExit("Don't support VTT for now")
 
-        # Is this generated by whisper?
-        if "segments" in data:
-            data = data["segments"]
-
+        from wordtable import WordTable
+        data = WordTable.load(filename)
 
         # We merge segments, we want fuller lines if possible
         from mod_reformat2 import merge_segments
@@ -94,7 +90,7 @@ all line breaks and line numbers unchanged. Write in Norwegian."""
 
         # We create numbered text lines to save some space
         lines = []
-        for idx, item in enumerate(segments):
+        for idx, item in enumerate(segments.segments):
             lines.append("{}: {}".format(idx, item["text"].strip().replace("\n", " ")))
 
         # We now have lots of lines, process it
@@ -152,7 +148,8 @@ all line breaks and line numbers unchanged. Write in Norwegian."""
 
     def recreate_subfile(self, data, lines):
         """
-        data is the orginial loaded data, lines is the processed and processed lines
+        data is the orginial loaded data (a WordTable), lines is the processed
+        and processed lines
         """
         # First we make the lines into a map split by the int
         pattern = r'^(\d+): (.*)$'
@@ -167,7 +164,7 @@ all line breaks and line numbers unchanged. Write in Norwegian."""
                 print("BAD LINE '{}'".format(line))
 
         # Merge if altered
-        merged_data = copy.copy(data)
+        merged_data = data.to_segments()
         for idx, item in enumerate(merged_data):
             if idx in altered:
                 if item["text"].strip() == altered[idx].strip():
@@ -176,6 +173,8 @@ all line breaks and line numbers unchanged. Write in Norwegian."""
                 print("OLD: {}\nNEW: {}".format(item["text"], altered[idx]))
                 item["text_whisper"] = item["text"]
                 item["text"] = altered[idx]
+                # Give the new words the timing of the words they replace
+                item["words"] = wordalign.retime(altered[idx], item["words"])
         return merged_data
 
 def process_task(cc, task, stop_event):
@@ -1,12 +1,11 @@
 import re
 import os
-import contextlib
-import wave
 import json
 
 try:
     import ftfy
     import numpy as np
+    from audiostore import AudioStore
     CANRUN = True
 except Exception:
     CANRUN = False
@@ -49,11 +48,11 @@ class HfWhisper:
 
     def __init__(self):
 
-        self.processor = None
-        self.model = None
-        self.pipeline = None  # Can be a model/processor OR < pipeline
+        self.model = None  # From the model server
+        self.pipeline = None  # The model if it runs as a pipeline
         self.modelID = ""
         self.log = None
+        self.store = None
         self.pcm_data = b""
 
     def process_task(self, cc, task):
@@ -78,32 +77,13 @@ class HfWhisper:
                 return 100, {"result": "ok", "dst": args["dst"]}
 
 
-        if not self.processor or self.modelID != __model_id:
+        if not self.model or self.modelID != __model_id:
             self.modelID = __model_id
             lang = args.get("lang", "en")
-            if self.modelID.startswith("openai"):
-                from transformers import WhisperProcessor, WhisperForConditionalGeneration
-                self.processor = WhisperProcessor.from_pretrained(self.modelID)
-                self.model = WhisperForConditionalGeneration.from_pretrained(self.modelID).to(self.device)
-                self._forced_decoder_ids = self.processor.get_decoder_prompt_ids(language=lang, task="transcribe", no_timestamps=False)
-                self.model.forced_decoder_ids = self._forced_decoder_ids
-            else:
-                from transformers import pipeline
-                self.pipeline = pipeline(
-                    task="automatic-speech-recognition",
-                    model=self.modelID,
-                    chunk_length_s=29,
-                    device=self.device
-                )
-                from transformers import WhisperProcessor
-                self.processor = WhisperProcessor.from_pretrained("NbAiLab/whisper-norwegian-small-test")
-                # processor = WhisperProcessor.from_pretrained("openai/whisper-large-v2")
-                self.pipeline.model.config.forced_decoder_ids = \
-                   self.processor.get_decoder_prompt_ids(language=lang,
-                                                         task="transcribe",
-                                                         no_timestamps=False)
-                self.model = self.pipeline.model
-                # self.pipeline.model.config.forced_decoder_ids = pipe.processor.get_decoder_prompt_ids(language=lang, task="transcribe")
+            # The openai models are run with generate(), others as a pipeline
+            from modelserver import get_model
+            self.model = get_model("hf_whisper", self.modelID, self.device, lang=lang)
+            self.pipeline = self.model if self.model.has_pipeline() else None
 
         # text = self._whisper(args["src"])
 
@@ -197,18 +177,16 @@ class HfWhisper:
     def read_wave(self, path):
         """Reads a .wav file.
 
-        Takes the path, and returns (PCM audio data, sample rate).
+        Takes the path, and returns (PCM audio data, sample rate). The data
+        is a memoryview into the shared memory mapped file, not a copy.
         """
-        with contextlib.closing(wave.open(path, 'rb')) as wf:
-            num_channels = wf.getnchannels()
-            assert num_channels == 1
-            sample_width = wf.getsampwidth()
-            assert sample_width == 2
-            sample_rate = wf.getframerate()
-            assert sample_rate in [16000]
-            pcm_data = wf.readframes(wf.getnframes())
-            self.pcm_data = pcm_data
-            return pcm_data, sample_rate
+        store = AudioStore.get(path)
+        assert store.channels == 1
+        assert store.sample_width == 2
+        assert store.sample_rate in [16000]
+        self.store = store
+        self.pcm_data = store.get_bytes()
+        return self.pcm_data, store.sample_rate
 
     def frame_generator(self, audio, frame_duration_ms=30000, sample_rate=16000):
         """Generates audio frames from PCM audio data.
@@ -235,17 +213,10 @@ class HfWhisper:
         """
         Return the audio bytes for the given time span
         """
-
-        start_byte = int(sample_rate * 2* start)
-        end_byte = int(sample_rate * 2 * end)
-
-        if (end_byte - start_byte) % 4 != 0:
-            end_byte -= (end_byte - start_byte) % 4
-
-        if end_byte > len(self.pcm_data):
+        if end > self.store.duration:
             raise Exception("NO DATA FOR GIVEN TIME")
 
-        return self.pcm_data[start_byte:end_byte]
+        return self.store.get_bytes(start, end)
 
     def _whisper(self, audio):
         if self.pipeline and isinstance(audio, str):
@@ -255,9 +226,7 @@ class HfWhisper:
             return res["text"]
 
         audio = np.frombuffer(audio, np.int16).flatten().astype(np.float32) / 32768.0
-        input_features = self.processor(audio, return_tensors="pt", sampling_rate=16000).input_features.to(self.device)
-        predicted_ids = self.model.generate(input_features)  # , forced_decoder_ids=self._forced_decoder_ids).to(self.device)
-        transcription = self.processor.batch_decode(predicted_ids, skip_special_tokens=True)
+        transcription = self.model.transcribe(audio)
 
 
         m = re.match(".*\|\>([^\<]*)\<\|", transcription[0])
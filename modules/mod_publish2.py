@@ -1,10 +1,11 @@
 import time
 import os
-import json
 import shutil
 import mimetypes
 import random
 
+import artefacts
+
 ccmodule = {
     "description": "Publish trials",
     "depends": [],
@@ -110,8 +111,7 @@ def merge_episodes(directory, episode):
     episodesfile = os.path.join(directory, "episodes.json")
     episodes = []
     if os.path.exists(episodesfile):
-        with open(episodesfile, "r") as f:
-            episodes = json.load(f)
+        episodes = artefacts.load(episodesfile)
 
     # Is this an update
     found = False
@@ -126,9 +126,8 @@ def merge_episodes(directory, episode):
 
     # Write back
     if os.path.exists(episodesfile):
-        os.rename(episodesfile, episodesfile +".bak")
-    with open(episodesfile, "w") as f:
-        json.dump(episodes, f, indent=" ")
+        shutil.copyfile(episodesfile, episodesfile + ".bak")
+    artefacts.save(episodes, episodesfile, pretty=True)
 
     return episodesfile, len(episodes)
 
@@ -199,8 +198,7 @@ def process_task(cc, job):
     m = make_manifest(id, subtitles_url, cast_url, media_url, mimetype, art=art,
                       cards=cards_url, chapters=chapters, freshness=freshness,
                       auxfile=auxfile, video_url=video_url)
-    with open(manifest, "w") as f:
-        json.dump(m, f, indent=" ")
+    artefacts.save(m, manifest, pretty=True)
 
     episode = make_episode_entry(m["id"], media_url, title, manifest_url,
                                  mimetype, art, published, description)
@@ -4,6 +4,8 @@ import json
 from operator import itemgetter
 import copy
 
+import subtitles
+
 ccmodule = {
     "description": "Reformat FancySubs",
     "depends": [],
@@ -34,74 +36,15 @@ class SubParser:
 
     @staticmethod
     def time2sec(t):
-        ms = t.split(",")[1]
-        t = t[:-len(ms) - 1]
-        if t.count(":") == 2:
-            h, m, s = t.split(":")
-        else:
-            m, s = t.split(":")
-            h = 0
-        ts = int(h) * 3600 + int(m) * 60 + int(s) + (int(ms) / 1000.)
-        return ts
+        return subtitles.time2sec(t)
 
     def load_srt(self, filename, default_who=None):
-        with open(filename, "rb") as f:
-
-            start = end = None
-            text = ""
-
-            for line in f.readlines():
-                line = line.decode("utf-8").strip()
-                if text and line.startswith("-"):
-                    # print("Continuation", line)
-                    s = {
-                        "start": SubParser.time2sec(start) + 0.01,
-                        "end": SubParser.time2sec(end),
-                        "text": line[1::].strip()}
-                    if default_who:
-                        s["who"] = default_who
-                    self.items.append(s)
-                    # text = ""
-                    continue
-                elif line.startswith("-"):
-                    line = line[1:]
-
-                if line.strip() == "":
-                    # print("End of comment", text)
-                    # End of comment
-                    if text and start and end:
-                        s = {
-                            "start": SubParser.time2sec(start),
-                            "end": SubParser.time2sec(end),
-                            "text": text
-                        }
-                        if default_who:
-                            s["who"] = default_who
-
-                        self.items.append(s)
-                    start = end = None
-                    text = ""
-                    continue
-                if re.match("^\d+$", line):
-                    # Just the index, we don't care
-                    continue
-
-                m = re.match("(\d+:\d+:\d+,\d+) --> (\d+:\d+:\d+,\d+)", line.replace(".", ","))
-                if not m:
-                    m = re.match("(\d+:\d+,\d+) --> (\d+:\d+,\d+)", line.replace(".", ","))
-                if m:
-                    start, end = m.groups()
-                    continue
-
-                # print("TEXT", text, "LINE", line)
-                if text and text[-1] != "-":
-                    text += "<br>"
-                    text += line
-                else:
-                    text = text[:-1] + line  # word has been divided
-
+        self.items.extend(subtitles.read(filename, default_who))
         return self.items
 
+    def write_vtt(self, filename, items):
+        subtitles.write_vtt([dict(item, text=item["text"].split("<br>")) for item in items], filename)
+
 
 def balance(lines):
     """
@@ -265,6 +208,6 @@ def process_task(cc, task):
         with open(target, "w") as f:
             json.dump(items, f, indent=" ")
     else:
-        parser.write_vtt(target, items)
+        SubParser().write_vtt(target, items)
 
     return 100, {"result": "ok", "dst": target}
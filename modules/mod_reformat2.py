@@ -1,9 +1,16 @@
 import json
 import re
 import math
+import bisect
+import itertools
 import textwrap
 import os
 
+import artefacts
+import subtitles
+import wordalign
+from wordtable import WordTable
+
 ccmodule = {
     "description": "Reformat subs based on whisper_timestamp with timestamped words",
     "depends": [],
@@ -84,25 +91,30 @@ def fix_segment_start(segment):
 
 def merge_segments(segments):
     # We go through the segments and merge those that are next to each other and
-    # doesn end with some sort of full stop
+    # doesn end with some sort of full stop. Takes a WordTable (or a list of
+    # segments) and returns a WordTable with the merged segments, the words
+    # are just regrouped.
 
     fullstops = "[\.?!]"
 
+    if not isinstance(segments, WordTable):
+        segments = WordTable.from_segments(segments)
+
     new_segments = []
+    groups = []
 
     # First segment is tricky, often due to jingles
     #segments = fix_first_segment(segments)
 
     merge_segment = None
-    for segment in segments:
+    for idx, segment in enumerate(segments.segments):
 
         if not "text" in segment or not segment["text"]:
             print("Not a text segment")
             continue
 
-        if "words" not in segment:
-            print("Weird segment!", segment)
         #segment = fix_segment_start(segment)
+        segment = dict(segment)
 
         # If the text segment is a list, concat them
         if isinstance(segment["text"], list):
@@ -114,10 +126,12 @@ def merge_segments(segments):
                 # Need to merge two segments
                 merge_segment["text"] += " " + segment["text"]
                 merge_segment["end"] = segment["end"]
-                merge_segment["words"].extend(segment["words"])
+                merge_group.append(idx)
                 new_segments.append(merge_segment)
+                groups.append(merge_group)
             else:
                 new_segments.append(segment)
+                groups.append([idx])
             merge_segment = None
             continue
 
@@ -125,135 +139,152 @@ def merge_segments(segments):
         if merge_segment:
             merge_segment["text"] += segment["text"]
             merge_segment["end"] = segment["end"]
-            merge_segment["words"].extend(segment["words"])
+            merge_group.append(idx)
         else:
             merge_segment = segment
+            merge_group = [idx]
 
         # Ensure that there is a space after any comma
         merge_segment["text"] = re.sub(r',(\w)', r', \1', merge_segment["text"])
         merge_segment["text"] = re.sub(r'  ', r' ', merge_segment["text"])
 
     # print(len(segments), "converted to", len(new_segments))
-    return new_segments
+    return segments.regroup(groups, new_segments)
 
 def similar_word(word1, word2, threshold=80):
-    from fuzzywuzzy import fuzz
-    similarity = fuzz.ratio(word1, word2)
-    return similarity >= threshold
+    return wordalign.similarity(word1, word2) * 100 >= threshold
+
 
 def resynchronize(modified_string, original_word_list, similarity_threshold=80):
-    import difflib
+    """
+    Line up the words of a modified text with the original words. Returns
+    one word per modified word, the original one if it is similar enough,
+    otherwise an empty one at the end of the word before, with the
+    modified word as "updated". See wordalign.retime() to get words with
+    the new text and the old timing.
+    """
     modified_words = modified_string.replace("\n", " ").split()
     original_words = [word_obj["text"] for word_obj in original_word_list]
 
-    matcher = difflib.SequenceMatcher(None, original_words, modified_words, autojunk=False)
     synchronized_word_list = []
-    for op, i1, i2, j1, j2 in matcher.get_opcodes():
-        if op == "equal":
-            synchronized_word_list.extend(original_word_list[i1:i2])
-        elif op == "insert":
-            for _ in range(j1, j2):
-                if len(synchronized_word_list) > 0:
-                    synchronized_word_list.append({"text": "", "start": synchronized_word_list[-1]["end"], "end": synchronized_word_list[-1]["end"]})
-                else:
-                    synchronized_word_list.append({"text": "", "start": 0, "end": 0})
-
-        elif op == "delete":
-            # We want an empty one here
-            synchronized_word_list.append({"text": "", "start": 0, "end": 0})
-            pass
-        elif op == "replace":
-            for index in range(j1, j2):
-                # If the modified words is just concatenated, we ignore it -
-                # this is a bit of a hack that shouldn't be necessary, but we
-                # get some of these in particular when whisper is repeating
-                # itself/hallucinating
-                if modified_words[j1:j2][0] == "".join(original_words[i1:i2]).replace("  ", " "):
-                    for original_word_obj in original_word_list[i1:i2]:
-                        synchronized_word_list.append(original_word_obj)
-                    continue
-                modified_word = modified_words[index]
-                for original_word_obj in original_word_list[i1:i2]:
-                    if similar_word(modified_word, original_word_obj["text"], similarity_threshold):
-                        synchronized_word_list.append(original_word_obj)
-                        break
-                else:
-                    if len(synchronized_word_list) > 0:
-                        synchronized_word_list.append({"text": "", "start": synchronized_word_list[-1]["end"], "end": synchronized_word_list[-1]["end"]})
-                    else:
-                        synchronized_word_list.append({"text": "", "start": 0, "end": 0})
-
-    # We now have a list of words that is "sensible" for the new words, but
-    # the words are not the same. Use the new words?
-    for idx, w in enumerate(synchronized_word_list):
-        if idx < len(modified_words):
-            w["updated"] = modified_words[idx]
+    for i, j in wordalign.align(original_words, modified_words):
+        if j is None:
+            continue  # Removed in the modified text
+        if i is not None and similar_word(modified_words[j], original_words[i], similarity_threshold):
+            word = original_word_list[i]
+        elif len(synchronized_word_list) > 0:
+            word = {"text": "", "start": synchronized_word_list[-1]["end"], "end": synchronized_word_list[-1]["end"]}
         else:
-            w["updated"] = ""
+            word = {"text": "", "start": 0, "end": 0}
+        word["updated"] = modified_words[j]
+        synchronized_word_list.append(word)
     return synchronized_word_list
 
 
-def get_cut_point(words, max_time, max_chars, pause_threshold=0.6):
-    if len(words) == 0:
-        return 0
-
-    cut = cut_stop = cut_pause = cut_space = cut_punctuation = textlen = 0
-    start_ts = last_end_time = words[0]["start"]
-    for i, word in enumerate(words):
-        textlen += len(word["text"])
-        if textlen > max_chars:
-            break
-        if word["start"] - start_ts > max_time:
-            break
-
-        if word["text"][-1] in [".", "!", "?"]:
-            cut_stop = i  # Fullstop
-
-        if word["text"][-1] in [",", ":"]:
-            # Not if there is a letter immediately after
-            if i < len(words) - 1 and not words[i + 1]["text"][0].isalpha():
-                cut_punctuation = i  # punctuation
-
-        if word['start'] - last_end_time > pause_threshold:
-            cut_pause = i - 1  # Too long time
-
-        cut_space = i
-        last_end_time = word["end"]
-
-    cut = max(cut_pause, cut_stop, cut_space)
-    if cut == 0:
-        return 0
-
-    # Is there a space close to the end?
-    if cut_pause / cut > 0.6:
-        # Go for the pause
-        cut = cut_pause
-
-    if cut_punctuation / cut > 0.7:
-        # Go for the punctuation
-        cut = cut_punctuation
-
-    if cut_stop / cut > 0.6:
-        # Go for the fullstop
-        cut = cut_stop
-
-    # The pause is actually very important. Always use it
-    if cut_pause and cut_pause < cut:
-        cut = cut_pause
+class CutPoints:
+    """
+    Finds where to cut a list of words into subtitles. Everything the
+    heuristics need is worked out once for the whole list (cumulative
+    text length, the last full stop, punctuation and pause before each
+    word), so finding a cut from an offset only looks at the words within
+    reach of it instead of slicing and rescanning the rest of the list.
+    """
 
-    # Is there a single word after the cut with a space or a full stop?
-    # TODO: Rather use length of words
-    if len(words) > cut + 1 and words[cut + 1]["text"][-1] in [".", ",", "!", "?"]:
-        cut += 1
-    # Two words? :-/
-    if len(words) > cut + 2 and words[cut + 2]["text"][-1] in [".", ",", "!", "?"]:
-        cut += 2
+    def __init__(self, texts, starts, ends, pause_threshold=0.6):
+        n = len(texts)
+        self.n = n
+        self.starts = starts
+        self.cum_len = [0] + list(itertools.accumulate(len(t) for t in texts))
+        last_char = [t[-1:] for t in texts]
+        self.ends_stop = [c in [".", ",", "!", "?"] for c in last_char]
+
+        # Last index <= i with a full stop, a punctuation cut or a pause
+        # before it, -1 if none
+        self.last_stop = []
+        self.last_punctuation = []
+        self.last_pause = []
+        stop = punctuation = pause = -1
+        for i in range(n):
+            if last_char[i] in [".", "!", "?"]:
+                stop = i
+            # Not if there is a letter immediately after
+            if last_char[i] in [",", ":"] and i < n - 1 and not texts[i + 1][0].isalpha():
+                punctuation = i
+            if i > 0 and starts[i] - ends[i - 1] > pause_threshold:
+                pause = i
+            self.last_stop.append(stop)
+            self.last_punctuation.append(punctuation)
+            self.last_pause.append(pause)
+
+    def cut(self, offset, max_time, max_chars):
+        """
+        The cut for the words from offset, as an index relative to offset
+        (the last word to include), like get_cut_point() on words[offset:]
+        """
+        n = self.n
+        if offset >= n:
+            return 0
+
+        # The words that fit, within max_chars and max_time of the first
+        end = bisect.bisect_right(self.cum_len, self.cum_len[offset] + max_chars) - 1
+        start_ts = self.starts[offset]
+        last = offset - 1
+        for i in range(offset, min(n, end)):
+            if self.starts[i] - start_ts > max_time:
+                break
+            last = i
+
+        def relative(idx):
+            return idx - offset if idx >= offset else 0
+
+        cut_space = relative(last)
+        cut_stop = relative(self.last_stop[last]) if last >= offset else 0
+        cut_punctuation = relative(self.last_punctuation[last]) if last >= offset else 0
+        cut_pause = 0
+        if last >= offset and self.last_pause[last] > offset:
+            cut_pause = self.last_pause[last] - 1 - offset  # Too long time
+
+        cut = max(cut_pause, cut_stop, cut_space)
+        if cut == 0:
+            return 0
+
+        # Is there a space close to the end?
+        if cut_pause / cut > 0.6:
+            # Go for the pause
+            cut = cut_pause
+
+        if cut_punctuation / cut > 0.7:
+            # Go for the punctuation
+            cut = cut_punctuation
+
+        if cut_stop / cut > 0.6:
+            # Go for the fullstop
+            cut = cut_stop
+
+        # The pause is actually very important. Always use it
+        if cut_pause and cut_pause < cut:
+            cut = cut_pause
+
+        # Is there a single word after the cut with a space or a full stop?
+        # TODO: Rather use length of words
+        if n > offset + cut + 1 and self.ends_stop[offset + cut + 1]:
+            cut += 1
+        # Two words? :-/
+        if n > offset + cut + 2 and self.ends_stop[offset + cut + 2]:
+            cut += 2
+
+        # If cut is 0 (we found NOTHING, we must return the end)
+        if not cut:
+            return n - offset
+
+        return cut
 
-    # If cut is 0 (we found NOTHING, we must return the end)
-    if not cut:
-        return len(words)
 
-    return cut
+def get_cut_point(words, max_time, max_chars, pause_threshold=0.6):
+    return CutPoints([w["text"] for w in words],
+                     [w["start"] for w in words],
+                     [w["end"] for w in words],
+                     pause_threshold).cut(0, max_time, max_chars)
 
 
 def split_segments(segments, max_chars, max_cps=20.0, max_time=7.0):
@@ -261,60 +292,46 @@ def split_segments(segments, max_chars, max_cps=20.0, max_time=7.0):
     Split segments, ensure that they are within the maximum amount of chars.
     If there is punctuation in the final 30%, split on that.
     max_cps is maximum chars pr second - will adjust the minimum length of a sub
+    Takes a WordTable or a list of segments with words.
     """
-    SIMILARITY = 50  # How similar to detect as same word?
+    if not isinstance(segments, WordTable):
+        segments = WordTable.from_segments(segments)
 
     new_segments = []
-    for segment in segments:
+    for idx, segment in enumerate(segments.segments):
 
         # duration - if it's too long, we split
         if (max_time is None or segment["end"] - segment["start"] < max_time) and \
           len(segment["text"]) < max_chars:
-            new_segments.append(segment)
+            new_segments.append(dict(segment, words=segments.segment_words(idx)))
             continue
 
         fulltext = segment["text"].strip().replace("  ", " ")
-        text = segment["text"].strip()
-        # resynced = resynchronize(fulltext, segment["words"], SIMILARITY)
-        words = []
-        for word in segment["words"]:
-            if word["text"].startswith(" ") or len(words) == 0:
-                words.append({"text": word["text"].lstrip(),
-                              "start": word["start"],
-                              "end": word["start"]})
-            else:
-                print(f'Length of words: {len(words)}')
-                words[-1]["text"] += word["text"]
-        if len(words) != len(fulltext.split(" ")):
-            print(f'Readjusted words from {len(fulltext.split(" "))} vs {len(segment["words"])} to {len(words)}')
-        resynced = words
-        # words = [w["updated"] for w in resynced]
-        # words = fulltext.replace("\n", " ").split()
-        # words = [w["text"] for w in segment["words"]]
-        if 0 and len(resynced) < len(fulltext.split(" ")):
-            print("fulltext\n", fulltext)
-            print("words\n", " ".join([w["text"] for w in words]))  # [w["text"].lstrip() for w in segment["words"]]))
-            print("Resync\n", " ".join([w["text"].lstrip() for w in resynced]))
-            print("BAD RESYNC, using original")
-            print(f'Length of words {len(words)} vs {len(fulltext.split(" "))}"')
-            for i in range(min(len(words), len(fulltext.split(" ")))):
-                if words[i]["text"] != fulltext.split(" ")[i]:
-                    print(f'{i}: "{words[i]}" vs "{fulltext.split(" ")[i]}"')
-            # resynced = segment["words"]
-            resynced = words
-            # raise Exception("Bad resync, {} words, expected {}".format(len(resynced), len(segment["words"])))
+
+        # Tokens without a leading space are the rest of the word before
+        first, last = segments.segment_range(idx)
+        pieces = segments.texts(first, last)
+        heads = [i for i, piece in enumerate(pieces) if i == 0 or piece.startswith(" ")]
+        texts = ["".join(pieces[a:b]).lstrip() for a, b in zip(heads, heads[1:] + [len(pieces)])]
+        all_starts = segments.start[first:last].tolist()
+        starts = [all_starts[i] for i in heads]
+        if len(texts) != len(fulltext.split(" ")):
+            print(f'Readjusted words from {len(fulltext.split(" "))} vs {last - first} to {len(texts)}')
+
         word_offset = 0
         start_ts = segment["start"]
-        # while len(text) > max_chars or segment["end"] - start_ts > max_time:
-        while word_offset < len(resynced):
+        # Words end where they start, the end of the last word in a sub
+        # is the start of it
+        cut_points = CutPoints(texts, starts, starts)
+        while word_offset < len(texts):
 
-            wordnr = word_offset + get_cut_point(words[word_offset:], max_time, max_chars)
-            t = " ".join([s["text"] for s in words[word_offset:wordnr+1]])
+            wordnr = word_offset + cut_points.cut(word_offset, max_time, max_chars)
+            t = " ".join(texts[word_offset:wordnr+1])
 
             min_length = len(t) / 20.  # 20 chars pr second is quite fast
             new_segment = {
                 "start": start_ts,
-                "end": max(resynced[wordnr]["end"], start_ts + min_length),
+                "end": max(starts[wordnr], start_ts + min_length),
                 "text": t
             }
 
@@ -322,13 +339,12 @@ def split_segments(segments, max_chars, max_cps=20.0, max_time=7.0):
             # Better if this is immediately after (if it's a continuation)
             start_ts = new_segment["end"]
             # If the previous char was some sort of stop, allow pause
-            if word_offset > 0 and word_offset < len(resynced) and \
-               resynced[word_offset - 1]["text"] and \
-               resynced[word_offset - 1]["text"][-1] in [".", ",", "!", "?"]:
-                new_segment["start"] = resynced[word_offset]["start"]
+            if word_offset > 0 and word_offset < len(texts) and \
+               texts[word_offset - 1][-1:] in [".", ",", "!", "?"]:
+                new_segment["start"] = starts[word_offset]
             word_offset = wordnr + 1
 
-    print("Converted %d segments to %d segments" % (len(segments), len(new_segments)))
+    print("Converted %d segments to %d segments" % (len(segments.segments), len(new_segments)))
 
     for s in new_segments:
         s["text"] = balance(s["text"], 40)
@@ -389,42 +405,18 @@ def balance(text, max_chars):
 
 
 def trim(s):
-    # Remove additional spaces, also spaces in front of punctuation
-    import re
-
-    while True:
-        m = re.search("(\s[\W\s])", s)
-        if not m:
-            break
-        s = s[:m.span()[0]] + s[m.span()[0] + 1:]
-    return s.strip()
+    # Remove additional spaces, also spaces in front of punctuation. Only
+    # spaces are removed, so a space goes if the next char in the original
+    # is a space or not a word char, which is one pass with a lookahead
+    return re.sub(r"\s(?=[\W\s])", "", s).strip()
 
 
 def sec2time(sec):
-    h = int(sec // 3600)
-    m = int((sec // 60) % 60)
-    s = int(sec % 60)
-    ms = int((sec - int(sec)) * 1000)
-    return f"{h:02d}:{m:02d}:{s:02d}.{ms:03d}"
+    return subtitles.sec2time(sec)
 
 
 def write_vtt(entries, filename, header="FILE"):
-    with open(filename, "w") as f:
-        f.write("WEBVTT %s\n\n" % header)
-
-        counter = 1
-        for entry in entries:
-            f.write("%d\n" % counter)
-            counter += 1
-            f.write("%s --> %s\n" %
-                    (sec2time(entry["start"]), sec2time(entry["end"])))
-
-            if isinstance(entry["text"], list):
-                for text in entry["text"]:
-                    f.write("%s\n" % text)
-            else:
-                f.write(entry["text"] + "\n")
-            f.write("\n")
+    subtitles.write_vtt(entries, filename, header)
 
 
 def fix_overlap(segments, max_overlap=0.5):
@@ -441,28 +433,6 @@ def fix_overlap(segments, max_overlap=0.5):
     return segments
 
 
-def ensure_words_are_sequential(segments):
-    """
-    Issues with buggy transformers sometimes identifies timestamps for words as
-    a previous utterance of the same word. Detect and guess-fix.
-    """
-    last_ts = 0
-    for segment in segments:
-        if "word" not in segment:
-            continue
-        for word in segment["word"]:
-            if word["start"] < last_ts:
-                print("Fixing word timestamp", word["start"], last_ts, word["text"][:10], "...")
-                word["end"] = last_ts + word["end"] - word["start"]
-                word["start"] = last_ts
-            last_ts = word["end"]
-        segment["start"] = segment["word"][0]["start"]
-        segment["end"] = segment["word"][-1]["end"]
-
-        if segment["end"] < segment["start"]:
-            raise Exception("Segment ends before it starts", segment)
-
-
 def process_task(cc, task):
 
     args = task["args"]
@@ -488,14 +458,7 @@ def process_task(cc, task):
     max_time = float(args.get("max_time_pr_sub",6.0))
 
     print("Processing", src)
-    with open(src, "r") as f:
-        subs = json.load(f)
-
-    if "segments" in subs:
-        subs = subs["segments"]
-
-    # Check for bugs
-    ensure_words_are_sequential(subs)
+    subs = WordTable.load(src)
 
     # Merge segments if they are the same speaker so we can re-split them better
     new_segments = merge_segments(subs)
@@ -515,8 +478,7 @@ def process_task(cc, task):
             sub["text"] = "\n".join(sub["text"])
 
         print("  Writing json subs", dst)
-        with open(dst, "w") as f:
-            json.dump(new_subs, f, indent=" ")
+        artefacts.save(new_subs, dst, pretty=True)
     else:
         print("  Writing vtt", dst)
         write_vtt(new_subs, dst)
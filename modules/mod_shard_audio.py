@@ -0,0 +1,121 @@
+import os
+import json
+import bisect
+
+from audiostore import AudioStore
+
+
+ccmodule = {
+    "description": "Split long audio into shards at pauses, so they can be transcribed in parallel",
+    "depends": [],
+    "provides": [],
+    "inputs": {
+        "src": "Source file to split (WAVE file)",
+        "dst": "Destination shard file (.json), default next to the source",
+        "dir": "Directory for the shard wave files, default same as dst",
+        "segments": "Voice segments from mod_detect_voice (.json or .csv), if not given voice detection is run here",
+        "shards": "Number of shards, default 4",
+        "overlap": "Seconds of overlap on each side of a cut, default 2",
+        "min_shard_length": "Never make shards shorter than this (seconds), default 300",
+        "search": "Seconds around the even split points to look for a pause, default 30",
+        "agressive": "How agressive the voice detection is (1-3) if it's run here, default 2"
+    },
+    "outputs": {
+        "dst": "Shard file, {'src', 'duration', 'overlap', 'shards': [{'file', 'start', 'end', 'cut_start', 'cut_end'}]}",
+        "num_shards": "Number of shards made"
+    },
+    "defaults": {
+        "priority": 50,  # Normal
+        "runOn": "success"
+    },
+    "status": {
+        "progress": "Progress 0-100%",
+        "state": "Current state of processing"
+    }
+}
+
+
+def find_cuts(segments, duration, num_shards, search=30.0):
+    """
+    Find num_shards - 1 cut points, for each the middle of the longest
+    pause between voice segments within search seconds of the even split
+    point. If there is no pause there, cut at the split point.
+    """
+    # Pauses as (middle, length)
+    pauses = []
+    for idx in range(1, len(segments)):
+        start, end = segments[idx - 1]["end"], segments[idx]["start"]
+        if end > start:
+            pauses.append(((start + end) / 2, end - start))
+    middles = [p[0] for p in pauses]
+
+    cuts = []
+    for i in range(1, num_shards):
+        target = i * duration / num_shards
+        first = bisect.bisect_left(middles, target - search)
+        last = bisect.bisect_right(middles, target + search)
+        candidates = [p for p in pauses[first:last] if not cuts or p[0] > cuts[-1]]
+        if candidates:
+            cuts.append(max(candidates, key=lambda p: (p[1], -abs(p[0] - target)))[0])
+        else:
+            cuts.append(target)
+    return cuts
+
+
+def load_segments(filename):
+    from mod_whisper import load_segment_file
+    return load_segment_file(filename, max_break=0, min_segment_length=0)
+
+
+def process_task(cc, task):
+
+    args = task["args"]
+    src = args["src"]
+    dst = args.get("dst", None)
+    if not dst:
+        dst = os.path.splitext(src)[0] + "_shards.json"
+    dst_dir = args.get("dir", os.path.dirname(dst))
+    num_shards = int(args.get("shards", 4))
+    overlap = float(args.get("overlap", 2.0))
+    min_shard_length = float(args.get("min_shard_length", 300))
+
+    if os.path.exists(dst):
+        with open(dst, "r") as f:
+            return 100, {"dst": dst, "num_shards": len(json.load(f)["shards"])}
+
+    store = AudioStore.get(src)
+    num_shards = max(1, min(num_shards, int(store.duration // min_shard_length)))
+
+    cc.status["state"] = "Detecting voice"
+    if args.get("segments"):
+        segments = load_segments(args["segments"])
+    else:
+        from mod_detect_voice import VoiceDetector
+        detector = VoiceDetector(src)
+        segments = detector.analyze(aggressive=args.get("agressive", 2), max_segment_length=30)
+
+    cuts = find_cuts(segments, store.duration, num_shards, float(args.get("search", 30)))
+    cc.log.info("Cutting '%s' (%.1fs) at %s" % (src, store.duration, cuts))
+
+    cc.status["state"] = "Splitting"
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    name = os.path.splitext(os.path.basename(src))[0]
+    bounds = [0] + cuts + [store.duration]
+    shards = []
+    for idx in range(len(bounds) - 1):
+        shard = {
+            "file": os.path.join(dst_dir, "%s_shard%02d.wav" % (name, idx)),
+            "start": max(0, bounds[idx] - overlap),
+            "end": min(store.duration, bounds[idx + 1] + overlap),
+            "cut_start": bounds[idx],
+            "cut_end": bounds[idx + 1]
+        }
+        store.write_segment(shard["file"], shard["start"], shard["end"])
+        shards.append(shard)
+        cc.status["progress"] = int(100 * (idx + 1) / (len(bounds) - 1))
+
+    with open(dst, "w") as f:
+        json.dump({"src": src, "duration": store.duration, "overlap": overlap, "shards": shards}, f, indent=" ")
+
+    return 100, {"dst": dst, "num_shards": len(shards)}
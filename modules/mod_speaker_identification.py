@@ -9,6 +9,7 @@ try:
     import librosa as lb
     import torch
     import os
+    from audiostore import AudioStore
     CANRUN = True
 except Exception:
     CANRUN = False
@@ -153,12 +154,21 @@ class VoiceCompare():
         if self._dbg:
             self._dbg.write("%s,%s,%s,%s\n" % (meta1["start"], meta1["end"], meta2["start"], meta2["end"]))
         print("Loading", (meta1["start"], meta1["end"]), (meta2["start"], meta2["end"]))
-        waveform1, rate1 = lb.load(file, sr=16000,
-                                   offset=meta1["start"],
-                                   duration=min(max_length, meta1["end"] - meta1["start"]))
-        waveform2, rate2 = lb.load(file, sr=16000,
-                                   offset=meta2["start"],
-                                   duration=min(max_length, meta2["end"] - meta1["start"]))
+        store = AudioStore.get(file)
+        if store.sample_rate != 16000:
+            waveform1, rate1 = lb.load(file, sr=16000,
+                                       offset=meta1["start"],
+                                       duration=min(max_length, meta1["end"] - meta1["start"]))
+            waveform2, rate2 = lb.load(file, sr=16000,
+                                       offset=meta2["start"],
+                                       duration=min(max_length, meta2["end"] - meta1["start"]))
+            return self.compare_raw(waveform1, waveform2, model)
+
+        # Already 16khz, slice it straight out of the mapped file
+        waveform1 = store.get_float(meta1["start"],
+                                    meta1["start"] + min(max_length, meta1["end"] - meta1["start"]))
+        waveform2 = store.get_float(meta2["start"],
+                                    meta2["start"] + min(max_length, meta2["end"] - meta1["start"]))
         return self.compare_raw(waveform1, waveform2, model)
 
     @staticmethod
@@ -178,25 +188,14 @@ class VoiceCompare():
             start += length * ((trim_percent / 2) / 100.)
             end -= length * ((trim_percent / 2) / 100.)
 
-        import wave
         import tempfile
-        dst_file = tempfile.mktemp(suffix=".wav")
-        dst = wave.open(dst_file, "w")
-        src = wave.open(source, "r")
-
-        # Skip to position
-        rate = src.getframerate()
+        store = AudioStore.get(source)
         # Sanity
-        if start > src.getnframes() / rate:
+        if start > store.duration:
             raise Exception("Segment starts after file end, %s, %s" % (start, source))
 
-        src.setpos(math.floor(rate * start))
-        data = src.readframes(math.ceil(rate * (end - start)))
-        dst.setsampwidth(src.getsampwidth())
-        dst.setnchannels(src.getnchannels())
-        dst.setframerate(rate)
-        dst.writeframes(data)
-        return dst_file
+        dst_file = tempfile.mktemp(suffix=".wav")
+        return store.write_segment(dst_file, start, end)
 
     @staticmethod
     def read_csv(filename):
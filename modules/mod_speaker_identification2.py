@@ -7,7 +7,9 @@ import copy
 import os
 import pickle
 import base64
+import bisect
 
+import artefacts
 
 
 ccmodule = {
@@ -18,12 +20,22 @@ ccmodule = {
         "src": "Media source file",
         "vtt": "Subtitle file (created by Whisper for example)",
         "segments": "Detected audio segments",
+        "follow_segments": "Read the segments while mod_detect_voice is still writing them (incremental mode), and start on the embeddings right away, default False",
+        "follow_timeout": "Incremental mode: give up if the segment file doesn't show up or stops growing for this many seconds, default 600",
+        "nonspeech": "Mask of audio that is not speech (from mod_detect_voice), no embeddings are made for it. In incremental mode it's only there when the segments are done, so embeddings in it are dropped afterwards",
         "people": "Already known list of people (if available) [people_dir/name or path, ...]",
         "people_dir": "Directory of people (if not absolute paths in people file)",
+        "people_store": "Directory of a people store (see peoplestore.py), people are looked up here first",
+        "ann_nprobe": "Lists to probe in the approximate index used for large people lists, higher is more exact but slower, default 8, 0 to always compare with everyone",
+        "store_cutoff": "How similar a detected person must be to someone in the people store to be named, default 0.5",
         "guess_people": "If people are given, still guess for others? Default True",
         "dst": "Destination subtitle json file",
         "cutoff": "How close match to regard as a person - default 0.1, higher number = more closely",
-        "realign": "Try to realign (resync) subtitles with the sound"
+        "realign": "Try to realign (resync) subtitles with the sound",
+        "one_speaker_cutoff": "How similar the bits of a segment must be to regard it as one person when guessing people, default 0.25",
+        "new_speaker_cutoff": "How similar a segment must be to a guessed person to be that person, default 0.16",
+        "batch_size": "Number of speaker windows to embed in one go, default 64",
+        "embedding_cache": "Directory for the embedding cache, default the directory of src, empty to disable"
     },
     "outputs": {
         "cast": "JSON file with cast members",
@@ -35,13 +47,24 @@ ccmodule = {
     },
     "status": {
         "progress": "Progress 0-100%",
-        "state": "Current state of processing"
+        "state": "Current state of processing",
+        "dropped_windows": "Speaker windows that could not be embedded (and are left out)"
     }
 }
 
 try:
     import torch
+    import numpy as np
     import nemo.collections.asr as nemo_asr
+    from modelserver import get_model
+    from audiostore import AudioStore
+    from embeddingcache import EmbeddingCache
+    from peoplestore import PeopleStore
+    from annindex import IVFIndex
+    from speakercluster import SpeakerClusterer
+    from intervalindex import IntervalIndex
+    from segmentfile import follow_segments, read_segments
+    import nonspeech
     import whisper
     CANRUN = True
 except Exception:
@@ -65,25 +88,14 @@ class WhisperBits():
             start += length * ((trim_percent / 2) / 100.)
             end -= length * ((trim_percent / 2) / 100.)
 
-        import wave
         import tempfile
-        dst_file = tempfile.mktemp(suffix=".wav")
-        dst = wave.open(dst_file, "w")
-        src = wave.open(source, "r")
-
-        # Skip to position
-        rate = src.getframerate()
+        store = AudioStore.get(source)
         # Sanity
-        if start > src.getnframes() / rate:
+        if start > store.duration:
             raise Exception("Segment starts after file end, %s, %s" % (start, source))
 
-        src.setpos(math.floor(rate * start))
-        data = src.readframes(math.ceil(rate * (end - start)))
-        dst.setsampwidth(src.getsampwidth())
-        dst.setnchannels(src.getnchannels())
-        dst.setframerate(rate)
-        dst.writeframes(data)
-        return dst_file
+        dst_file = tempfile.mktemp(suffix=".wav")
+        return store.write_segment(dst_file, start, end)
 
     def __init__(self, sourcefile, model="large"):
 
@@ -92,21 +104,14 @@ class WhisperBits():
         if os.path.exists(self.cachefile):
             with open(self.cachefile, "r") as f:
                 self.cache = json.load(f)
-        self.model = whisper.load_model(model)
+        # Shared with the transcription if the node runs a model server
+        self.model = get_model("whisper", model)
 
-        # load audio and pad/trim it to fit 30 seconds
+        # load audio, the first 30 seconds are used to detect the spoken language
         audio = whisper.load_audio(sourcefile)
-        audio = whisper.pad_or_trim(audio)
-
-        # make log-Mel spectrogram and move to the same device as the model
-        mel = whisper.log_mel_spectrogram(audio).to(self.model.device)
-
-        # detect the spoken language
-        _, probs = self.model.detect_language(mel)
+        probs = self.model.detect_language(audio)
         print(f"Detected language: {max(probs, key=probs.get)}")
 
-        self.options = whisper.DecodingOptions()
-
     def __del__(self):
         with open(self.cachefile, "w") as f:
             self.cache = json.dump(self.cache, f)
@@ -119,23 +124,31 @@ class WhisperBits():
         if str((sourcefile, start, end)) in self.cache:
             return self.cache[str((sourcefile, start, end))]
 
-        f = self.save_segment(sourcefile, start, end, max_length=100)
-        audio = whisper.load_audio(f)
-        audio = whisper.pad_or_trim(audio)
-        mel = whisper.log_mel_spectrogram(audio).to(self.model.device)
-        result = whisper.decode(self.model, mel, self.options)
-        self.cache[str((sourcefile, start, end))] = result.text
-        os.remove(f)
-        return result.text
+        store = AudioStore.get(sourcefile)
+        if store.sample_rate == whisper.audio.SAMPLE_RATE:
+            audio = store.get_float(start, start + min(100, end - start))
+        else:
+            f = self.save_segment(sourcefile, start, end, max_length=100)
+            audio = whisper.load_audio(f)
+            os.remove(f)
+        text = self.model.decode(audio)
+        self.cache[str((sourcefile, start, end))] = text
+        return text
 
 
 class VoiceCompare():
-    def __init__(self, log):
+    # Use an approximate index to shortlist people with this many references
+    ANN_MIN_REFERENCES = 2000
+
+    def __init__(self, log, cache=None):
 
         self.model = None
         self.last_model_id = None
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
         self.log = log
+        self.sample_rate = 16000
+        self.cache = cache  # EmbeddingCache or None
+        self.dropped_windows = 0  # Windows the model failed on, left out of the embeddings
         self.cast = []  # We group "seconds" for each speaker
         self.detected_people = {}
         self._cast = {}
@@ -146,30 +159,143 @@ class VoiceCompare():
         if self.last_model_id != model_id:
             # Free existing?
             self.last_model_id = model_id
-            self.model = speaker_model = nemo_asr.models.EncDecSpeakerLabelModel.from_pretrained(model_id)
+            # From the node's model server if it runs
+            self.model = get_model("speaker", model_id, self.device)
+            self.sample_rate = self.model.sample_rate()
 
     def compare_embeddings(self, embeddings0, embeddings1):
         # the resulting embeddings can be used for cosine similarity-based retrieval
-        cosine_sim = torch.nn.CosineSimilarity(dim=-1)
-        similarity = cosine_sim(embeddings0, embeddings1)
-        return similarity
+        return torch.nn.functional.cosine_similarity(embeddings0, embeddings1, dim=-1)
+
+    @staticmethod
+    def embedding_matrix(embeddings):
+        """
+        Stack a list of (1, D) or (D,) embeddings into a normalized (N, D)
+        matrix, so a matrix multiply gives the cosine similarities
+        """
+        matrix = torch.cat([e.reshape(1, -1) for e in embeddings]).float()
+        return torch.nn.functional.normalize(matrix, dim=-1)
 
     def get_embedding(self, wavfile, start=None, end=None):
         """
-        If start and end are given, a temporary file is created and embeddings returned
+        If start and end are given, the segment is sliced out of the memory
+        mapped wav and fed to the model directly. Only if the wav is not at
+        the sample rate of the model, a temporary file is created.
         """
         self._load_model()
 
         if start is not None and end is not None:
+            store = AudioStore.get(wavfile)
+            if store.sample_rate == self.sample_rate:
+                if start > store.duration:
+                    raise Exception("Segment starts after file end, %s, %s" % (start, wavfile))
+                pcm = store.get_pcm(start, end)
+                if not self.cache:
+                    return self.get_signal_embedding(store.to_float(pcm))
+
+                key = (math.floor(store.sample_rate * start), len(pcm))
+                vector = self.cache.get(store.hash(), self.last_model_id, *key)
+                if vector is not None:
+                    return torch.from_numpy(vector.copy()).reshape(1, -1).to(self.device)
+                embedding = self.get_signal_embedding(store.to_float(pcm))
+                self.cache.put(store.hash(), self.last_model_id, [(key, embedding.cpu().numpy())])
+                return embedding
             try:
                 f = self.save_segment(wavfile, start, end, max_length=10000)
-                return self.model.get_embedding(f).to(self.device)
+                return torch.from_numpy(self.model.embed_file(f)).to(self.device)
             finally:
                 try:
                     os.remove(f)
                 except Exception:
                     pass
-        return self.model.get_embedding(wavfile).to(self.device)
+        return torch.from_numpy(self.model.embed_file(wavfile)).to(self.device)
+
+    def get_signal_embedding(self, signal):
+        """
+        Embedding for a mono float32 signal at the sample rate of the model,
+        same as the model's get_embedding() but without the file round trip
+        """
+        self._load_model()
+        embs = self.model.embed(signal[np.newaxis], [signal.shape[0]])
+        return torch.from_numpy(embs).to(self.device)
+
+    def get_embeddings_batch(self, wavfile, windows, batch_size=64):
+        """
+        Embeddings for a list of (start, end) windows of the same length,
+        run through the model batch_size windows at a time. As the windows
+        are all the same length, no padding is needed.
+
+        Returns (embeddings, timestamps), an (N, D) tensor and a parallel
+        (N, 2) array with the windows that were embedded.
+
+        If we have a cache, only the windows that are not in it are run
+        through the model.
+        """
+        self._load_model()
+        store = AudioStore.get(wavfile)
+        if len(windows) == 0:
+            return torch.zeros((0, 0), device=self.device), np.zeros((0, 2))
+
+        if store.sample_rate != self.sample_rate:
+            # Can't slice the model input directly, do it the slow way
+            embeddings = [self.get_embedding(wavfile, start, end) for start, end in windows]
+            return torch.cat(embeddings), np.array(windows, dtype=np.float64)
+
+        length = int(round((windows[0][1] - windows[0][0]) * store.sample_rate))
+        valid = []
+        for start, end in windows:
+            first = math.floor(store.sample_rate * start)
+            if first + length > store.num_samples:
+                if self.log:
+                    self.log.warning("Window [%s - %s] is past the end of %s" % (start, end, wavfile))
+                continue
+            valid.append((first, (start, end)))
+
+        results = {}  # index in valid -> (1, D) embedding
+        if self.cache:
+            audio_hash = store.hash()
+            for i, (first, _) in enumerate(valid):
+                vector = self.cache.get(audio_hash, self.last_model_id, first, length)
+                if vector is not None:
+                    results[i] = torch.from_numpy(vector.copy()).reshape(1, -1).to(self.device)
+            if self.log and results:
+                self.log.debug("Got %d of %d embeddings from cache" % (len(results), len(valid)))
+        todo = [(i, first, ts) for i, (first, ts) in enumerate(valid) if i not in results]
+
+        def embed(batch):
+            signal = np.stack([store.to_float(store.get_samples(first, length))
+                               for _, first, _ in batch])
+            embs = torch.from_numpy(self.model.embed(signal, [length] * len(batch))).to(self.device)
+            for n, (i, _, _) in enumerate(batch):
+                results[i] = embs[n:n + 1]
+            if self.cache:
+                vectors = embs.cpu().numpy()
+                self.cache.put(audio_hash, self.last_model_id,
+                               [((first, length), vectors[n]) for n, (_, first, _) in enumerate(batch)])
+
+        for b in range(0, len(todo), batch_size):
+            batch = todo[b:b + batch_size]
+            try:
+                embed(batch)
+            except Exception:
+                if self.log:
+                    self.log.exception("Failed to get embeddings for %s [%s - %s], retrying one at a time" %
+                                       (wavfile, batch[0][2][0], batch[-1][2][1]))
+                # Only leave out the windows that fail on their own
+                for item in batch:
+                    try:
+                        embed([item])
+                    except Exception:
+                        self.dropped_windows += 1
+                        if self.log:
+                            self.log.warning("Failed to get the embedding for %s [%s - %s], left out" %
+                                             (wavfile, item[2][0], item[2][1]))
+
+        if len(results) == 0:
+            return torch.zeros((0, 0), device=self.device), np.zeros((0, 2))
+        done = sorted(results)
+        return torch.cat([results[i] for i in done]), \
+            np.array([valid[i][1] for i in done], dtype=np.float64)
 
     @staticmethod
     def save_segment(source, start, end, max_length=1, trim_percent=0):
@@ -187,25 +313,14 @@ class VoiceCompare():
             start += length * ((trim_percent / 2) / 100.)
             end -= length * ((trim_percent / 2) / 100.)
 
-        import wave
         import tempfile
-        dst_file = tempfile.mktemp(suffix=".wav")
-        dst = wave.open(dst_file, "w")
-        src = wave.open(source, "r")
-
-        # Skip to position
-        rate = src.getframerate()
+        store = AudioStore.get(source)
         # Sanity
-        if start > src.getnframes() / rate:
+        if start > store.duration:
             raise Exception("Segment starts after file end, %s, %s" % (start, source))
 
-        src.setpos(math.floor(rate * start))
-        data = src.readframes(math.ceil(rate * (end - start)))
-        dst.setsampwidth(src.getsampwidth())
-        dst.setnchannels(src.getnchannels())
-        dst.setframerate(rate)
-        dst.writeframes(data)
-        return dst_file
+        dst_file = tempfile.mktemp(suffix=".wav")
+        return store.write_segment(dst_file, start, end)
 
     @staticmethod
     def read_csv(filename):
@@ -231,9 +346,25 @@ class VoiceCompare():
                 entries.append(sub)
         return entries
 
-    def load_embeddings(self, wavfile, segments, min_time=None, max_time=None):
-
-        embeddings = []
+    def load_embeddings(self, wavfile, segments, min_time=None, max_time=None,
+                        batch_size=64, mask=None):
+        """
+        Cut the segments into 0.5s windows and get the embeddings for them
+        in batches. Returns a list of ((start, end), embedding). Audio in
+        the non-speech mask (if given) is cut out of the segments first.
+        """
+        SEG_LENGTH = 0.50
+        prsec = int(1 / SEG_LENGTH)
+        windows = []
+        result = []
+
+        def embed(windows):
+            embeddings, timestamps = self.get_embeddings_batch(wavfile, windows, batch_size)
+            result.extend(((start, end), embeddings[i:i + 1])
+                          for i, (start, end) in enumerate(timestamps.tolist()))
+
+        # segments can be a generator (follow_segments), so the windows are
+        # embedded as they come
         for segment in segments:
             if min_time and segment["start"] < min_time:
                 continue
@@ -242,25 +373,21 @@ class VoiceCompare():
 
             # if segment["end"] > 900:
             #   break  # For testing
-            SEG_LENGTH = 0.50
-            prsec = int(1 / SEG_LENGTH)
-            for i in range(0, prsec * math.ceil(segment["end"] - segment["start"])):
-                e = min(segment["start"] + SEG_LENGTH + (SEG_LENGTH * i), segment["end"])
-                if e - (segment["start"] + (SEG_LENGTH * i)) < SEG_LENGTH:
-                    continue  # Too short
-                try:
-                    embedding = self.get_embedding(wavfile, segment["start"] + (i * SEG_LENGTH), e)
-                    embeddings.append(((segment["start"] + (SEG_LENGTH * i), e), embedding))
-                except Exception as ex:
-                    if self.log:
-                        self.log.exception("Failed to get embeddings for %s [%s - %s]" %
-                                           (wavfile, segment["start"] + (SEG_LENGTH * i), e))
-                    else:  # Only while debugging
-                        print("Failed to get embeddings for %s [%s - %s]" %
-                              (wavfile, segment["start"] + (SEG_LENGTH * i), e))
-                        import traceback
-                        traceback.print_exc()
-        return embeddings
+            pieces = nonspeech.subtract([segment], mask, min_length=SEG_LENGTH) if mask else [segment]
+            for piece in pieces:
+                for i in range(0, prsec * math.ceil(piece["end"] - piece["start"])):
+                    e = min(piece["start"] + SEG_LENGTH + (SEG_LENGTH * i), piece["end"])
+                    if e - (piece["start"] + (SEG_LENGTH * i)) < SEG_LENGTH:
+                        continue  # Too short
+                    windows.append((piece["start"] + (SEG_LENGTH * i), e))
+
+            if len(windows) >= batch_size * 4:
+                embed(windows)
+                windows = []
+
+        if windows:
+            embed(windows)
+        return result
 
     def find_best_matches(self, embeddings, safe_hit=0.35):
         cast = []
@@ -300,20 +427,33 @@ class VoiceCompare():
         return ret
 
     def guess_known_items(self, wavfile, segments, _embeddings, starttime=None,
-                          endtime=None):
+                          endtime=None, cutoff_one_speaker=0.25, cutoff_new_speaker=0.16):
         """
         Go through the given segments, find some long ones and determine
         if they are one person only.
         If so, is this a known person?
         Will use/update the detected_people map
+
+        cutoff_one_speaker is how similar the bits of a segment must be to
+        be regarded as one person (a bit higher to ensure clean samples),
+        cutoff_new_speaker how similar a segment must be to a person to be
+        that person. The segments are clustered online (see speakercluster.py)
+        so this is linear in the number of segments.
         """
         print("Guessing known items, %d already known" % len(self.detected_people))
         min_segment_length = 5  # seconds
         padding = 0.25  # We skip the first and last bits in case it's no good
-        cutoff_one_speaker = 0.25  # A bit higher to ensure clean samples
-        cutoff_new_speaker = 0.16  # This is perhaps the difficult one?
+        max_embeddings = 3  # Once a person has more, we only update the clustering
         self._people_times = {}
 
+        clusterer = SpeakerClusterer(cutoff_one_speaker, cutoff_new_speaker)
+        for p in self.detected_people:
+            if self.detected_people[p]:
+                clusterer.add_speaker(p, [e for _, e in self.detected_people[p]])
+                self._people_times[p] = []
+
+        # The embeddings are in time order, so we find the ones for each segment by bisecting
+        starts = [ts[0] for ts, _ in _embeddings]
         for segment in segments:
             if starttime and segment["start"] < starttime:
                 continue
@@ -327,44 +467,32 @@ class VoiceCompare():
                 continue
 
             # Get the embeddings for this time
-            embeddings = self.get_embeddings_by_time(_embeddings, start, end)
-            # embeddings = self.load_embeddings(wavfile, [{"start": start, "end": end}])
-
-            # Are all the embeddings the same person?
-            matches = []
-            for x in range(0, len(embeddings)):
-                for y in range(x + 1, len(embeddings)):
-                    matches.append(self.compare_embeddings(embeddings[x][1], embeddings[y][1]))
-            avg = sum(matches) / max(1, len(matches))
-            print("AVG", avg)
-            if avg > cutoff_one_speaker:  # GUESSING that this is ok
-                # Is this a known person?
-                found = False
-                for p in self.detected_people:
-                    for e in self.detected_people[p]:
-                        m = []
-                        for x in embeddings:
-                            m.append(self.compare_embeddings(e[1], x[1]))
-                        print("AVG ", p, sum(m) / max(1, len(m)), "cutoff", cutoff_new_speaker)
-                        if sum(m) / max(1, len(m)) > cutoff_new_speaker:
-                            found = True
-                            print("FOUND PERSON", p, len(self.detected_people[p]))
-                            if len(self.detected_people[p]) > 3:
-                                break
-                            self.detected_people[p].extend(embeddings)
-                            self._people_times[len(self.detected_people)].append({"start": start, "end": end})
-                            print("Now have %d people" % len(self.detected_people))
-                            break
+            embeddings = []
+            for x in range(bisect.bisect_left(starts, start), len(_embeddings)):
+                ts, embedding = _embeddings[x]
+                if ts[0] >= end:
+                    break
+                if ts[1] <= end:
+                    embeddings.append((ts, embedding))
 
-                if not found:
-                    print("New person")
-                    self.detected_people[len(self.detected_people)] = embeddings
-                    self._people_times[len(self.detected_people)] = [{"start": start, "end": end}]
+            # Are all the embeddings the same person, and is this a known person?
+            speaker, similarity, is_new = clusterer.add_segment([e for _, e in embeddings],
+                                                                len(self.detected_people))
+            if speaker is None:
+                continue
 
-            if len(matches) > 0:
-                print("SEGMENT [%s-%s] %.2f avg: %.2f, len: %d" %
-                      (start, end, min(matches), sum(matches) / len(matches), len(matches)))
+            p = speaker.label
+            if is_new:
+                print("New person", p)
+                self.detected_people[p] = embeddings
+                self._people_times[p] = [{"start": start, "end": end}]
+            else:
+                print("FOUND PERSON", p, len(self.detected_people[p]), "similarity %.2f" % similarity)
+                if len(self.detected_people[p]) <= max_embeddings:
+                    self.detected_people[p].extend(embeddings)
+                self._people_times[p].append({"start": start, "end": end})
 
+        print("Now have %d people" % len(self.detected_people))
         return self.detected_people
 
     def cast_to_people(self, castfile):
@@ -432,11 +560,12 @@ class VoiceCompare():
 
         return self._cast
 
-    def load_person_list(self, people_json_file, person_dir=""):
+    def load_person_list(self, people_json_file, person_dir="", store=None):
         """
         person_json_file is a list [person1, person2, person3]
         # where person is a name to be found in the people_dir or 
 
+        If a PeopleStore is given, people are looked up by name there first.
         The person info file is json:    
         Filename is json with 'name' and 'voice', where 'voice' is base64
         encoded pickled embeddings.
@@ -449,6 +578,14 @@ class VoiceCompare():
         known_items = {}
 
         for p in ppl:
+            if store and p in store:
+                info = store.get(p)
+                embeddings = torch.from_numpy(np.array(store.get_embeddings(p))).to(self.device)
+                known_items[p] = [x.reshape(1, -1) for x in embeddings]
+                self._cast[p] = info
+                self.detected_people[p] = [[[0, 1], x] for x in known_items[p]]
+                continue
+
             filename = p
             if not os.path.exists(p):
                 if not person_dir or not os.path.exists(os.path.join(person_dir, p)):
@@ -469,6 +606,30 @@ class VoiceCompare():
 
         return known_items
 
+    def name_people(self, store, people=None, cutoff=0.5, nprobe=8):
+        """
+        Look up auto-detected people in a PeopleStore. People that are
+        similar enough to someone in the store are renamed to them.
+        Returns map of name to the info from the store for the renamed ones
+        """
+        if not people:
+            people = self.detected_people
+
+        named = {}
+        for person in list(people):
+            if person in self._cast:
+                continue  # Given, not detected
+            matches = store.search([e for _, e in people[person]], k=1, nprobe=nprobe)
+            if not matches:
+                break
+            name, similarity = matches[0]
+            if similarity < cutoff or name in people:
+                continue
+            print("Detected person %s is %s (%.2f)" % (person, name, similarity))
+            people[name] = people.pop(person)
+            named[name] = store.get(name)
+        return named
+
     def build_known_items(self, known_people):
         """
         We have a map of people and a list of times they are represented in
@@ -501,32 +662,90 @@ class VoiceCompare():
                 # As an alternative, create a list of 0.5s bits?
         return p
 
-    def find_best_matches_known_items(self, known_items, embeddings, safe_hit=0.35):
-        cast = []
-        best_matches = []
+    @staticmethod
+    def _block_scores(block, safe_hit):
+        """
+        Score of one person for every window, block is the (windows x
+        references) similarities for the person. A person's references are
+        only looked at up to and including the first one that is a safe hit.
+        """
+        best_so_far = torch.cummax(block, dim=1).values
+        hits = block >= safe_hit
+        stop = torch.where(hits.any(dim=1), hits.int().argmax(dim=1),
+                           torch.full_like(hits[:, 0], block.shape[1] - 1, dtype=torch.long))
+        return best_so_far.gather(1, stop.unsqueeze(1)).squeeze(1)
+
+    def find_best_matches_known_items(self, known_items, embeddings, safe_hit=0.35,
+                                      nprobe=8, shortlist=10):
+        """
+        Find the most similar known person for every embedding. All the
+        similarities are one (windows x references) matrix multiply, which
+        is then reduced to a score per person. As before, a person's
+        references are only looked at up to and including the first one
+        that is a safe hit.
+
+        With many references (a large people list), an approximate index
+        first shortlists the people for each window, and only those are
+        scored exactly. nprobe is the recall/speed trade-off of the index,
+        0 to always score everyone.
+        Returns a list of (embedding index, person, similarity), person is
+        None if nothing is similar at all.
+        """
         for k in known_items:
             if len(known_items[k]) == 0:
                 raise Exception("Can't find matches to empty person '%s'" % k)
 
-        for x, e0 in enumerate(embeddings):
+        if len(embeddings) == 0 or len(known_items) == 0:
+            return [(x, None, 0) for x in range(len(embeddings))]
 
-            max_sim = [None, 0]
-            total = 0
-            for person in known_items:
-                for y, e1 in enumerate(known_items[person]):
-                    sim = self.compare_embeddings(e0[1], e1)
-                    if sim > max_sim[1]:
-                        max_sim = [person, sim]
-                    # total += sim
-                    if sim >= safe_hit:
-                        break
-                # avg = total / len(known_items[person])
-                # if avg > max_sim[1]:
-                #    max_sim = [person, avg]
+        people = list(known_items)
+        references = []
+        blocks = []
+        for person in people:
+            blocks.append((len(references), len(references) + len(known_items[person])))
+            references.extend(known_items[person])
 
-            best_matches.append((x, max_sim[0], max_sim[1]))
+        windows = self.embedding_matrix([e for _, e in embeddings])
+        references = self.embedding_matrix(references).to(windows.device)
+
+        if nprobe and len(references) >= self.ANN_MIN_REFERENCES and len(people) > shortlist:
+            scores = self._shortlist_scores(windows, references, blocks, safe_hit,
+                                            nprobe, shortlist)
+        else:
+            similarities = windows @ references.T
+            scores = torch.empty((len(embeddings), len(people)), device=windows.device)
+            for p, (first, last) in enumerate(blocks):
+                scores[:, p] = self._block_scores(similarities[:, first:last], safe_hit)
+
+        best = scores.argmax(dim=1)
+        best_sim = scores.gather(1, best.unsqueeze(1)).squeeze(1)
+        best_matches = []
+        for x, (p, sim) in enumerate(zip(best.tolist(), best_sim.tolist())):
+            if sim > 0:
+                best_matches.append((x, people[p], sim))
+            else:
+                best_matches.append((x, None, 0))
         return best_matches
 
+    def _shortlist_scores(self, windows, references, blocks, safe_hit, nprobe, shortlist):
+        """
+        Exact scores for the people the approximate index shortlists for
+        each window, the rest of the people score -1
+        """
+        labels = np.repeat(np.arange(len(blocks)), [last - first for first, last in blocks])
+        index = IVFIndex(references.cpu().numpy(), labels)
+        candidates, _ = index.search(windows.cpu().numpy(), k=shortlist, nprobe=nprobe)
+        candidates = torch.from_numpy(candidates).to(windows.device)
+
+        scores = torch.full((len(windows), len(blocks)), -1.0, device=windows.device)
+        for p, (first, last) in enumerate(blocks):
+            rows = (candidates == p).any(dim=1).nonzero().squeeze(1)
+            if len(rows) == 0:
+                continue
+            block = windows[rows] @ references[first:last].T
+            scores[rows, p] = self._block_scores(block, safe_hit)
+        return scores
+
     def build_cast_known_items(self, embeddings, known_items, best_matches, cutoff):
         # Collect into cast members
         cast = {}
@@ -635,24 +854,14 @@ class VoiceCompare():
 
     def find_most_likely_speaker(self, cast, start, end):
         """
-        Look through the cast list, find all the members that are active
-        within start-end and return the most likely cast member (if any).
+        Find all the cast members that are active within start-end and
+        return the one that talks the most there (if any). cast is either
+        the cast or an IntervalIndex of it, build that once if this is
+        called for many subtitles.
         """
-        active_members = {}
-        for person in cast:
-            active_members[person] = 0
-            for entry in cast[person]: # entry has "start", "end"
-                if entry["end"] > start and entry["start"] < end:
-                    # Add the overlapping part of this segment
-                    active_members[person] += min(entry["end"], end) - max(entry["start"], start)
-                if entry["end"] > end:
-                    break  # No more hits for this member
-
-        l = [(i, active_members[i]) for i in active_members]
-        l.sort(key=operator.itemgetter(1), reverse=True)
-        if l[0][1] == 0:
-            return None
-        return l[0][0]
+        if not isinstance(cast, IntervalIndex):
+            cast = IntervalIndex.from_cast(cast)
+        return cast.most_overlap(start, end)
 
     def find_most_likely_speaker_OLD(self, cast, start, end):
         """
@@ -796,6 +1005,7 @@ class VoiceCompare():
 
         # Fill in missing speakers
         print("Filling in missing speakers")
+        cast = IntervalIndex.from_cast(cast)
         for idx, sub in enumerate(subs):
             # if "who" not in sub:
             subs[idx]["who"] = self.find_most_likely_speaker(cast, sub["start"], sub["end"]) 
@@ -906,39 +1116,66 @@ def process_task(cc, task, stop_event):
     people_src = args.get("people", "")
     guess_people = args.get("guess_people", True)
     castsource = speakers.replace("_speakers.json", "_people.json")
+    people_store = None
+    if args.get("people_store"):
+        people_store = PeopleStore(args["people_store"])
 
     subs = []
     if vtt:
         if not vtt.endswith("json"):
-            import mod_reformat
-            parser = mod_reformat.SubParser()
+            import subtitles
             print("Loading subtitles from '%s'" % vtt)
-            subs = parser.load_srt(vtt)
+            subs = list(subtitles.read(vtt))
         else:
-            with open(vtt, "r") as f:
-                subs = json.load(f)
+            subs = artefacts.load(vtt)
         if len(subs) == 0:
             raise Exception("No subtitles in file '%s'" % vtt)
         cc.log.debug("Loaded %d subtitles" % len(subs))
 
+    cache = None
+    cache_dir = args.get("embedding_cache", os.path.dirname(os.path.abspath(src)))
+    if cache_dir:
+        cache = EmbeddingCache(cache_dir)
+
     cc.status["progress"] = 0
-    vc = VoiceCompare(cc.log)
+    vc = VoiceCompare(cc.log, cache=cache)
     vc._load_model()
 
     if 0 and os.path.exists(dst) and os.path.getsize(dst) > 10:
         cc.log.warning("Cache didn't catch this one either")
         return 100, {"dst": dst, "cast": castsource}
 
-    if segment_file.endswith(".csv"):
-        segments = vc.read_csv(segment_file)
+    segments = []
+    follow = args.get("follow_segments", False)
+    if follow:
+        def follow_source():
+            for segment in follow_segments(segment_file, stop_event=stop_event,
+                                           timeout=float(args.get("follow_timeout", 600))):
+                segments.append(segment)
+                yield segment
+        source = follow_source()
+    elif segment_file.endswith(".csv"):
+        segments = source = vc.read_csv(segment_file)
+    elif segment_file.endswith(".jsonl"):
+        segments = source = read_segments(segment_file)
     else:
         raise Exception("Bad file format for segments: '%s'" % segment_file)
 
-    cc.log.debug("Loaded %d segments" % len(segments))
-
     cc.status["progress"] = 1
     cc.status["state"] = "Loading embeddings"
-    embeddings = vc.load_embeddings(src, segments)
+    # mod_detect_voice writes the mask before it completes the segment
+    # file, so when following it's only there after the last segment
+    mask = nonspeech.load(args["nonspeech"]) if args.get("nonspeech") and not follow else None
+    embeddings = vc.load_embeddings(src, source, batch_size=int(args.get("batch_size", 64)),
+                                    mask=mask)
+    if follow and args.get("nonspeech"):
+        mask = nonspeech.load(args["nonspeech"])
+        masked = nonspeech.overlaps(mask, [e[0] for e in embeddings])
+        embeddings = [e for e, m in zip(embeddings, masked) if not m]
+    cc.log.debug("Loaded %d segments" % len(segments))
+    cc.status["dropped_windows"] = vc.dropped_windows
+    if vc.dropped_windows:
+        cc.log.warning("Left out %d speaker windows that could not be embedded" % vc.dropped_windows)
     cc.status["progress"] = 5
     cc.log.debug("Loaded %d embeddings" % len(embeddings))
     # TRY THIS:
@@ -948,7 +1185,7 @@ def process_task(cc, task, stop_event):
     known_items = {}
     if os.path.exists(people_src) and os.path.getsize(people_src) > 10:
         cc.log.info("Loading candidate people from '%s'" % people_src)
-        known_items = vc.load_person_list(people_src, people_dir)
+        known_items = vc.load_person_list(people_src, people_dir, people_store)
 
         cc.log.info("Loaded %d candidates" % len(known_items))
 
@@ -956,27 +1193,35 @@ def process_task(cc, task, stop_event):
         # Need to guess
         cc.status["state"] = "Auto-detecting people"
         # We could re-use the embeddings here and save us a LOT of time
-        known_people = vc.guess_known_items(src, segments, embeddings)
+        known_people = vc.guess_known_items(src, segments, embeddings,
+                                            cutoff_one_speaker=float(args.get("one_speaker_cutoff", 0.25)),
+                                            cutoff_new_speaker=float(args.get("new_speaker_cutoff", 0.16)))
         if len(known_people) == 0:
             raise Exception("Failed to detect any people")
 
         cc.log.debug("Got %d known items" % len(known_people))
+        named = {}
+        if people_store:
+            named = vc.name_people(people_store, known_people, float(args.get("store_cutoff", 0.5)),
+                                   nprobe=int(args.get("ann_nprobe", 8)))
+            cc.log.debug("Found %d detected people in the people store" % len(named))
         # DEBUGGING
         c = vc.people_to_cast(src, known_people)
-        with open(castsource, "w") as f:
-            json.dump(c, f, indent=" ")
+        for name in named:
+            c[name].update(named[name])
+        artefacts.save(c, castsource, pretty=True)
 
         # TODO: Just strip off the timestamps from known_people
         known_items.update(vc.build_known_items(c))
     else:
         # Save cast
-        with open(castsource, "w") as f:
-            json.dump(vc._cast, f, indent=" ")
+        artefacts.save(vc._cast, castsource, pretty=True)
 
     cc.status["progress"] = 15
     cc.status["status"] = "Matching"
     print("Finding best matches based on %d known items" % len(known_items))
-    best_matches = vc.find_best_matches_known_items(known_items, embeddings)
+    best_matches = vc.find_best_matches_known_items(known_items, embeddings,
+                                                    nprobe=int(args.get("ann_nprobe", 8)))
     cc.status["progress"] = 55
     cc.status["state"] = "Building cast"
     cast = vc.build_cast_known_items(embeddings, known_items, best_matches, cutoff)
@@ -991,8 +1236,9 @@ def process_task(cc, task, stop_event):
     # Go through the segments, find who is the most likely speaker, then update the thing
     cc.status["state"] = "Identify speakers"
     cc.status["progress"] = 75
+    cast_index = IntervalIndex.from_cast(cast)
     for s in subs:
-        s["who"] = vc.find_most_likely_speaker(cast, s["start"], s["end"])
+        s["who"] = vc.find_most_likely_speaker(cast_index, s["start"], s["end"])
         if s["who"] is None:
             print(" ----- FAILED to identify speaker", s)
 
@@ -1014,8 +1260,7 @@ def process_task(cc, task, stop_event):
         else:
             new_speak.append(speaker)
     
-    with open(speakers, "w") as f:
-        json.dump(new_speak, f, indent=" ")
+    artefacts.save(new_speak, speakers)
 
     cc.status["progress"] = 80
 
@@ -1028,8 +1273,7 @@ def process_task(cc, task, stop_event):
     # Write the CSV back
     # vc.write_csv(segments, dst)
     if subs:
-        with open(dst, "w") as f:
-            json.dump(subs, f, indent=" ")
+        artefacts.save(subs, dst, pretty=True)
 
     return 100, {"dst": dst, "cast": castsource}
 
@@ -21,6 +21,7 @@ ccmodule = {
         "NOPE-people_map": "A list of entries of known speakers, for example introductions in podcasts, tags: start, end, <name>, <avatar>, <filename>",
         "guess_people": "Try to compare identified voices with known people",
         "peopledb": "If you have a database of people (file dir), it will look here for known voices",
+        "people_store": "Directory of a people store (see peoplestore.py) to search for speakers that are not identified",
         "cutoff": "How close match to regard as a person - default 0.1, higher number = more closely",
         "dst": "Destination subtitle json file",
     },
@@ -42,6 +43,9 @@ try:
     from diarization.processing.speakerdiarization import SpeakerDiarization
     import torch
     import nemo.collections.asr as nemo_asr
+    from audiostore import AudioStore
+    from peoplestore import PeopleStore
+    from intervalindex import IntervalIndex
     CANRUN = True
 except Exception:
     CANRUN = False
@@ -106,25 +110,14 @@ class VoiceCompare():
             start += length * ((trim_percent / 2) / 100.)
             end -= length * ((trim_percent / 2) / 100.)
 
-        import wave
         import tempfile
-        dst_file = tempfile.mktemp(suffix=".wav")
-        dst = wave.open(dst_file, "w")
-        src = wave.open(source, "r")
-
-        # Skip to position
-        rate = src.getframerate()
+        store = AudioStore.get(source)
         # Sanity
-        if start > src.getnframes() / rate:
+        if start > store.duration:
             raise Exception("Segment starts after file end, %s, %s" % (start, source))
 
-        src.setpos(math.floor(rate * start))
-        data = src.readframes(math.ceil(rate * (end - start)))
-        dst.setsampwidth(src.getsampwidth())
-        dst.setnchannels(src.getnchannels())
-        dst.setframerate(rate)
-        dst.writeframes(data)
-        return dst_file
+        dst_file = tempfile.mktemp(suffix=".wav")
+        return store.write_segment(dst_file, start, end)
 
     def run_diarization(self, filename, num_speakers=None, max_speakers=None):
         diarizationworker = SpeakerDiarization()
@@ -175,7 +168,7 @@ class VoiceCompare():
 
         return embeddings
 
-    def identify_speakers(people, known_people, cutoff=0.35):
+    def identify_speakers(self, people, known_people, cutoff=0.35):
         # Initialize the resulting mapping
         speaker_mapping = {}
 
@@ -200,29 +193,35 @@ class VoiceCompare():
 
         return speaker_mapping
 
+    def search_speakers(self, people, store, speaker_mapping, cutoff=0.35, nprobe=8):
+        """
+        Search the people store for the speakers that are not in the
+        speaker mapping yet, updates the mapping
+        """
+        for person, embeddings in people.items():
+            if person in speaker_mapping or not embeddings:
+                continue
+            matches = store.search([e for _, e in embeddings], k=1, nprobe=nprobe)
+            if matches and matches[0][1] >= cutoff:
+                speaker_mapping[person] = matches[0][0]
+        return speaker_mapping
+
 
-    def update_subtitles(subs, speakers, speaker_mapping):
+    def update_subtitles(self, subs, speakers, speaker_mapping):
         """
-        Update the subtitles based on segments (spk_id) to person.
+        Update the subtitles based on segments (spk_id) to person, the
+        speaker that talks the most during a subtitle gets it.
         If a speaker id is lacking in the mapping, just use the id
         """
-
-        def calculate_overlap(start1, end1, start2, end2):
-            """Helper function to calculate the overlap between two time ranges"""
-            return max(0, min(end1, end2) - max(start1, start2))
+        index = IntervalIndex()
+        for seg in speakers['segments']:
+            index.add(seg['spk_id'], seg['seg_begin'], seg['seg_end'])
 
         for sub in subs:
-            # Initialize the speaker to None and max overlap to 0
             sub['speaker'] = None
-            max_overlap = 0
-            for seg in speakers['segments']:
-                overlap = calculate_overlap(seg['seg_begin'], seg['seg_end'], sub['start'], sub['end'])
-                if overlap > max_overlap:
-                    max_overlap = overlap
-                    if seg['spk_id'] in speaker_mapping:
-                        sub['who'] = speaker_mapping[seg['spk_id']]
-                    else:
-                        sub['who'] = seg['spk_id']
+            spk_id = index.most_overlap(sub['start'], sub['end'])
+            if spk_id is not None:
+                sub['who'] = speaker_mapping.get(spk_id, spk_id)
 
 
 def process_task(cc, task, stop_event):
@@ -244,10 +243,9 @@ def process_task(cc, task, stop_event):
     subs = []
     if vtt:
         if not vtt.endswith("json"):
-            import mod_reformat
-            parser = mod_reformat.SubParser()
+            import subtitles
             print("Loading subtitles from '%s'" % vtt)
-            subs = parser.load_srt(vtt)
+            subs = list(subtitles.read(vtt))
         else:
             with open(vtt, "r") as f:
                 subs = json.load(f)
@@ -276,6 +274,7 @@ def process_task(cc, task, stop_event):
     # Load the given people (if any)
     known_people = None
     known_items = {}
+    speaker_mapping = {}
     if os.path.exists(people_src) and os.path.getsize(people_src) > 10:
         cc.log.info("Loading candidate people from '%s'" % people_src)
         known_items = vc.load_person_list(people_src, people_dir)
@@ -288,10 +287,12 @@ def process_task(cc, task, stop_event):
         # best_matches = vc.find_best_matches_known_items(known_items, embeddings)
         speaker_mapping = vc.identify_speakers(people, known_items)
 
-    # If we didn't get specific people and we have a database directory, load those
-    if people_dir and os.path.isdir(people_dir):
-        # Check if we have any people that have not been identified yet
-        if len(speaker_mapping) != len(people):
+    # If we didn't get specific people and we have a people store, search it
+    if len(speaker_mapping) != len(people):
+        if args.get("people_store"):
+            cc.status["status"] = "Searching people store"
+            vc.search_speakers(people, PeopleStore(args["people_store"]), speaker_mapping)
+        elif people_dir and os.path.isdir(people_dir):
             raise Exception("Missing people but not implemented DB search")
 
     if len(speaker_mapping) != len(people):
@@ -314,8 +315,9 @@ def process_task(cc, task, stop_event):
     # Go through the segments, find who is the most likely speaker, then update the thing
     cc.status["state"] = "Identify speakers"
     cc.status["progress"] = 75
+    cast_index = IntervalIndex.from_cast(cast)
     for s in subs:
-        s["who"] = vc.find_most_likely_speaker(cast, s["start"], s["end"])
+        s["who"] = cast_index.most_overlap(s["start"], s["end"])
         if s["who"] is None:
             print(" ----- FAILED to identify speaker", s)
 
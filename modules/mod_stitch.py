@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import difflib
+
+import artefacts
+
+
+ccmodule = {
+    "description": "Stitch transcripts of audio shards (from mod_shard_audio) back together",
+    "depends": [],
+    "provides": [],
+    "inputs": {
+        "shards": "Shard file from mod_shard_audio",
+        "dir": "Directory with the transcripts of the shards, and where the result is placed",
+        "srcs": "List of the transcripts (.json) of the shards, default found in dir by the shard names",
+        "max_offset": "Max difference in seconds between the timestamps of the same word in two shards, default 1.0"
+    },
+    "outputs": {
+        "dst": "Output file (VTT)",
+        "dst_txt": "Output file (Text)",
+        "dst_words": "JSON file with word timestamps"
+    },
+    "defaults": {
+        "priority": 50,  # Normal
+        "runOn": "success"
+    },
+    "status": {
+        "progress": "Progress 0-100%",
+        "state": "Current state of processing"
+    }
+}
+
+
+def find_transcript(shard, dst_dir):
+    """
+    The words file mod_whisper made for a shard, whisperx names it
+    <name>.json, the pipeline <name>.wav.words.json
+    """
+    name = os.path.basename(shard["file"])
+    for filename in [os.path.splitext(name)[0] + ".json", name + ".words.json"]:
+        if os.path.exists(os.path.join(dst_dir, filename)):
+            return os.path.join(dst_dir, filename)
+    raise Exception("Missing transcript for shard '%s' in '%s'" % (shard["file"], dst_dir))
+
+
+def load_transcript(filename, offset):
+    """
+    Load the segments of a shard and move them to the time of the full file
+    """
+    segments = artefacts.load_segments(filename)
+    for segment in segments:
+        segment["start"] += offset
+        segment["end"] += offset
+        for word in segment.get("words", []):
+            word["start"] += offset
+            word["end"] += offset
+    return segments
+
+
+def normalize(text):
+    return re.sub(r"[\W_]", "", text.lower())
+
+
+def word_text(word):
+    return word.get("text", word.get("word", ""))
+
+
+def find_stitch(words_a, words_b, cut, start, end, max_offset=1.0):
+    """
+    Where to go from shard a to shard b. Both shards have the overlap
+    start-end around the cut, so the words in it are transcribed twice.
+    The words are aligned by text, and of the words that are the same in
+    both and have about the same timestamp, the one closest to the cut is
+    the stitch point. Returns (last word of a, first word of b) to keep.
+    If nothing aligns, a keeps what starts before the cut.
+    """
+    first_a = next((i for i, w in enumerate(words_a) if w["end"] > start), len(words_a))
+    last_b = next((i for i, w in enumerate(words_b) if w["start"] >= end), len(words_b))
+    text_a = [normalize(word_text(w)) for w in words_a[first_a:]]
+    text_b = [normalize(word_text(w)) for w in words_b[:last_b]]
+
+    best = None
+    matcher = difflib.SequenceMatcher(None, text_a, text_b, autojunk=False)
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            a = words_a[first_a + block.a + k]
+            b = words_b[block.b + k]
+            if not text_a[block.a + k] or abs(a["start"] - b["start"]) > max_offset:
+                continue
+            distance = abs((a["start"] + b["start"]) / 2 - cut)
+            if best is None or distance < best[0]:
+                best = (distance, first_a + block.a + k, block.b + k)
+
+    if best:
+        return best[1], best[2] + 1
+    last_a = next((i for i, w in enumerate(words_a) if w["start"] >= cut), len(words_a))
+    first_b = next((i for i, w in enumerate(words_b) if w["start"] >= cut), len(words_b))
+    return last_a - 1, first_b
+
+
+def trim_segments(segments, first, last):
+    """
+    Keep the words first to last (inclusive, counted over all segments)
+    """
+    trimmed = []
+    idx = 0
+    for segment in segments:
+        words = segment.get("words", [])
+        keep = words[max(0, first - idx):max(0, last + 1 - idx)]
+        idx += len(words)
+        if not keep:
+            continue
+        if len(keep) < len(words):
+            segment["words"] = keep
+            segment["text"] = "".join(word_text(w) for w in keep)
+            segment["start"] = keep[0]["start"]
+            segment["end"] = keep[-1]["end"]
+        trimmed.append(segment)
+    return trimmed
+
+
+def stitch(shards, transcripts, max_offset=1.0):
+    """
+    Stitch the segments of the shards together, dropping the words that
+    are in both shards of an overlap. Speakers are per shard, so they are
+    renamed to not mix up different speakers with the same label.
+    """
+    words = [[w for s in segments for w in s.get("words", [])] for segments in transcripts]
+    keep = [[0, len(w) - 1] for w in words]
+    for idx in range(len(shards) - 1):
+        keep[idx][1], keep[idx + 1][0] = find_stitch(words[idx], words[idx + 1],
+                                                     shards[idx]["cut_end"],
+                                                     shards[idx + 1]["start"],
+                                                     shards[idx]["end"],
+                                                     max_offset)
+
+    result = []
+    speakers = {}
+
+    def rename(idx, speaker):
+        key = (idx, speaker)
+        if key not in speakers:
+            speakers[key] = "Taler_%02d" % len(speakers)
+        return speakers[key]
+
+    for idx, segments in enumerate(transcripts):
+        for segment in trim_segments(segments, keep[idx][0], keep[idx][1]):
+            if "speaker" in segment:
+                segment["speaker"] = rename(idx, segment["speaker"])
+            for word in segment.get("words", []):
+                if "speaker" in word:
+                    word["speaker"] = rename(idx, word["speaker"])
+            result.append(segment)
+    return result
+
+
+def process_task(cc, task):
+
+    args = task["args"]
+    with open(args["shards"], "r") as f:
+        info = json.load(f)
+    shards = info["shards"]
+    dst_dir = args.get("dir", os.path.dirname(args["shards"]))
+
+    base_dst = os.path.splitext(os.path.join(dst_dir, os.path.basename(info["src"])))[0]
+    retval = {
+        "dst": base_dst + ".vtt",
+        "dst_txt": base_dst + ".txt",
+        "dst_words": base_dst + ".json"
+    }
+
+    srcs = args.get("srcs", None) or [find_transcript(shard, dst_dir) for shard in shards]
+    if len(srcs) != len(shards):
+        raise Exception("Got %d transcripts for %d shards" % (len(srcs), len(shards)))
+
+    transcripts = [load_transcript(src, shard["start"]) for src, shard in zip(srcs, shards)]
+    segments = stitch(shards, transcripts, float(args.get("max_offset", 1.0)))
+    cc.log.info("Stitched %d shards into %d segments" % (len(shards), len(segments)))
+
+    artefacts.save(segments, retval["dst_words"], pretty=True)
+
+    with open(retval["dst_txt"], "w") as f:
+        for segment in segments:
+            f.write(segment["text"].strip() + "\n")
+
+    from mod_reformat2 import write_vtt
+    write_vtt([{"start": s["start"], "end": s["end"], "text": s["text"].strip()} for s in segments],
+              retval["dst"], header="")
+
+    return 100, retval
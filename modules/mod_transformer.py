@@ -44,8 +44,7 @@ class Transformer:
 
     def __init__(self):
 
-        self.tokenizer = None
-        self.model = None
+        self.model = None  # From the model server, has the tokenizer too
         self.tokenizerID = ""
         self.modelID = ""
         self.log = None
@@ -100,22 +99,16 @@ class Transformer:
             cc.log.warning("Cache failed to catch this one")
             return 100, {"result": "ok", "dst": args["dst"]}
 
-        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
         import torch
+        from modelserver import get_model
         device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
-        if not self.tokenizer or self.tokenizerID != args["tokenizer"]:
-            cc.log.info("Loading tokenizer %s" % args["tokenizer"])
-            self.tokenizer = AutoTokenizer.from_pretrained(args["tokenizer"])
-            self.tokenizerID = args["tokenizer"]
-
-        if not self.model or self.modelID != args["model"]:
-            cc.log.info("Loading model %s" % args["model"])
-            self.model = AutoModelForSeq2SeqLM.from_pretrained(args["model"]).to(device)
+        if not self.model or (self.modelID, self.tokenizerID) != (args["model"], args["tokenizer"]):
+            cc.log.info("Loading model %s, tokenizer %s" % (args["model"], args["tokenizer"]))
+            self.model = get_model("seq2seq", args["model"], device,
+                                   tokenizer=args["tokenizer"], max_length=max_len)
             self.modelID = args["model"]
-            self.model.config.max_length = max_len
-            self.model.config.task_specific_params["translation"]["max_length"] = max_len
-            self.model.config.task_specific_params["text-generation"]["max_length"] = max_len
+            self.tokenizerID = args["tokenizer"]
 
         # We're ready to lock and load!
 
@@ -145,8 +138,7 @@ class Transformer:
             raise Exception("Newline where no newline is expected")
         print("---- processing ----")
         print(text.replace(" ", ""))
-        translated = self.model.generate(**self.tokenizer(text.replace(" ", ""), return_tensors="pt", padding=True).to(device))
-        o = [self.tokenizer.decode(t, skip_special_tokens=True) for t in translated]
+        o = self.model.generate(text.replace(" ", ""))
         o = self.cleanup_output(o)
 
         if len(o[0]) - len(text) > max(5, (len(text) * 0.2)):
@@ -5,6 +5,9 @@ import select
 import copy
 import re
 import json
+import bisect
+
+import artefacts
 
 try:
     # If we're using the API
@@ -23,6 +26,8 @@ ccmodule = {
     "provides": [],
     "inputs": {
         "src": "Source file to transcribe",
+        "shards": "Shard file from mod_shard_audio, if given the shard given by 'shard' is transcribed instead of src",
+        "shard": "Index of the shard to transcribe, default 0",
         "model": "tiny.en, tiny, base.en, base, small.en, small medium.en, medium, large. Default large",
         "task": "transcribe or translate (to english)",
         "use_pipeline": "Use transformer pipelines (very fast!), default True",
@@ -33,8 +38,17 @@ ccmodule = {
         "initial_promot": "Provide context before the first audio",
         "use_api": "Use Whisper API, don't run the actual process",
         "segments": "If API is used, segments can be sent in and long pauses will be ignored",
+        "nonspeech": "If API is used, mask of audio that is not speech (from mod_detect_voice), it's cut out of the segments",
+        "window": "If API is used with segments, segments are joined into windows of up to this many seconds, default 30",
+        "workers": "If API is used on the CPU, number of processes transcribing windows in parallel, default one per 4 cores",
         "model_dir": "Default model directory for local models, default /scratch/models/",
-        "hf_token": "Huggingface token for dialogization using pyannote"
+        "hf_token": "Huggingface token for dialogization using pyannote",
+        "batch_size": "Batch size for the transformer pipeline, chunks from files that are transcribed at the same time are batched together, default from the pipeline profile",
+        "chunk_length": "Chunk length in seconds for the transformer pipeline, default from the pipeline profile",
+        "stride_length": "Stride length in seconds for the transformer pipeline, default from the pipeline profile",
+        "num_beams": "Beams for the transformer pipeline, default 3",
+        "autotune": "Calibrate the transformer pipeline on first use on a device and model (stored in ~/.cache/transcribe/asr_profiles.json), default True on GPU, False on CPU",
+        "batch_wait": "Seconds to wait for other files to batch with in the transformer pipeline, default 0"
     },
     "outputs": {
         "dst": "Output file (VTT)",
@@ -53,40 +67,29 @@ ccmodule = {
 
 
 class Model:
-    instance = None
-    loaded_model = None
-
+    """
+    whisper(_timestamped) model, from the node's model server if it runs
+    (unless local)
+    """
     @staticmethod
-    def get(model, device):
-
-        import whisper_timestamped as whisper
-        if not Model.instance or Model.loaded_model != model:
-            Model.instance = whisper.load_model(model, device=device)
-            Model.loaded_model = model
-        return Model.instance
+    def get(model, device, local=False):
+        from modelserver import get_model
+        return get_model("whisper", model, device, local=local)
 
 
 class Pipeline:
-    instance = None
-    loaded_model = None
-
     @staticmethod
     def get(model, device):
-        from transformers import pipeline
-        import torch
-
-        if not Pipeline.instance or Pipeline.loaded_model != model:
-            Pipeline.instance = pipeline(task="automatic-speech-recognition",
-                                         torch_dtype=torch.float16,
-                                         model=model,
-                                         device=device,
-                                         return_timestamps="word")
-            Pipeline.loaded_model = model
-        return Pipeline.instance
+        from modelserver import get_model
+        return get_model("asr_pipeline", model, device)
 
 
 def run_whisper_pipeline(cc, src, dst_dir, model, lang, stop_event,
-                         reprocess=False, device="cuda:0"):
+                         reprocess=False, device="cuda:0", batch_wait=0, settings={}):
+    """
+    settings can override chunk_length_s, stride_length_s, batch_size and
+    num_beams, otherwise they come from the profile of the model (see asrtuner.py)
+    """
 
     def create_segments(chunks):
         """
@@ -137,14 +140,30 @@ def run_whisper_pipeline(cc, src, dst_dir, model, lang, stop_event,
     if stop_event.isSet():
         return 0, {"error": "Terminated"}
 
+    import asrtuner
+    num_beams = settings.get("num_beams", 3)
+    autotune = settings.get("autotune")
+    if autotune is None:
+        # Calibrating on the CPU takes forever
+        autotune = not device.startswith("cpu")
+    if all(settings.get(name) is not None for name in asrtuner.DEFAULTS):
+        autotune = False  # Nothing left to tune
+    pipe_settings = asrtuner.get_settings(pipe, model, num_beams,
+                                          autotune=autotune, log=cc.log)
+    for name in pipe_settings:
+        if settings.get(name) is not None:
+            pipe_settings[name] = settings[name]
+    cc.log.debug("Pipeline settings: %s" % pipe_settings)
+
     kwargs = {'task': 'transcribe',
               'language': lang,
-              'num_beams': 3}
+              'num_beams': num_beams}
     cc.log.debug("Transcribing")
-    res = pipe(src, generate_kwargs=kwargs, 
-               chunk_length_s=28,
-               stride_length_s=2,
-               batch_size=6)
+    # Batched with the other files that are being transcribed with the same
+    # model (in the model server or in other threads)
+    res = pipe.transcribe(src, generate_kwargs=kwargs,
+                          max_wait=batch_wait,
+                          **pipe_settings)
     cc.log.debug("Transcribe done")
     segments = create_segments(res["chunks"])
 
@@ -155,8 +174,7 @@ def run_whisper_pipeline(cc, src, dst_dir, model, lang, stop_event,
         "dst_words": os.path.join(dst_dir, name) + ".words.json"
     }
     # Store stuff
-    with open(retval["dst_words"], "w") as f:
-        json.dump(segments, f, indent=" ")
+    artefacts.save(segments, retval["dst_words"], pretty=True)
 
     with open(retval["dst_txt"], "w") as f:
         for segment in segments:
@@ -171,40 +189,161 @@ def run_whisper_pipeline(cc, src, dst_dir, model, lang, stop_event,
 
 def fix_whisperx_output(filename, speaker_prefix="Taler_"):
     # We need to fix the output json from whisperx, it's not 100% what we want
-    with open(filename, "r") as f:
-        data = json.load(f)
-    for s in data["segments"]:
-        last_end = s["start"] 
-        for word in s["words"]:
-            if "start" not in word:
-                word["start"] = last_end
-                word["end"] = last_end
-            last_end = word["end"]
-            word["text"] = " " + word["word"]
-            del word["word"]
+    from wordtable import WordTable
+    data = artefacts.load(filename)
+    # The table gives the words a "text" with a leading space instead of
+    # "word", and words without timestamps the end of the word before
+    table = WordTable.from_segments(data["segments"], whisperx=True)
+    for s in table.segments:
         if s["end"] < s["start"]:
             # TODO: Fix this - hook up with last segment instead? Seems to be single numbers...
             s["end"] = s["start"]  # Very strange, should likely merge with last segment
+    segments = table.to_segments()
 
     # Also renumber speakers if we have them
-    speakers = []
-    for s in data["segments"]:
-        if "speaker" in s and s["speaker"] not in speakers:
-            speakers.append(s["speaker"])
+    artefacts.rename_speakers(segments, speaker_prefix)
+    artefacts.save(segments, filename, pretty=True)
+
 
-    # We have a bunch of speakers, now we rename them all
-    # For simplicity, we make json and string-replace the shit of out it
-    serialized = json.dumps(data["segments"], indent=2, ensure_ascii=False)
-    for snr, speaker in enumerate(speakers):
-        serialized = serialized.replace(speaker, f"{speaker_prefix}{snr:02}")
+class WhisperX:
+    """
+    whisperx in this process, so the models stay loaded between jobs.
+    run() is a generator of progress events, so the caller gets partial
+    segments as they are transcribed.
+    """
+    instance = None
+    loaded_model = None
+    SAMPLE_RATE = 16000
+    CHUNK_LENGTH = 300  # seconds of audio transcribed per progress event
 
-    with open(filename, "w") as f:
-        f.write(serialized)
+    @staticmethod
+    def get(model, device, model_dir):
+        if not WhisperX.instance or WhisperX.loaded_model != (model, device):
+            WhisperX.instance = WhisperX(model, device, model_dir)
+            WhisperX.loaded_model = (model, device)
+        return WhisperX.instance
+
+    def __init__(self, model, device, model_dir):
+        import whisperx
+        self.device = device
+        self.model = whisperx.load_model(model, device,
+                                         compute_type="float16" if device.startswith("cuda") else "int8",
+                                         download_root=model_dir)
+        self.align_models = {}  # language -> (model, metadata)
+        self.diarize_model = None
+
+    def _chunks(self, audio):
+        """
+        Split the audio into CHUNK_LENGTH bits, cutting at the quietest
+        100ms in the last 10 seconds of each
+        """
+        import numpy as np
+        frame = self.SAMPLE_RATE // 10
+        start = 0
+        while start < len(audio):
+            end = start + self.CHUNK_LENGTH * self.SAMPLE_RATE
+            if end + 10 * self.SAMPLE_RATE >= len(audio):
+                yield start, len(audio)
+                return
+            tail = audio[end - 10 * self.SAMPLE_RATE:end].reshape(-1, frame)
+            end -= (len(tail) - int(np.argmin((tail ** 2).mean(axis=1)))) * frame
+            yield start, end
+            start = end
+
+    def run(self, src, lang=None, token=None, batch_size=16):
+        """
+        Transcribe, align and (if there's a token) diarize. Yields events:
+        {"type": "segments", "progress": 0-1, "segments": [...]} for every
+        chunk, {"type": "stage", "stage": "align" | "diarize"} and finally
+        {"type": "done", "result": result}
+        """
+        import whisperx
+        audio = whisperx.load_audio(src)
+        segments = []
+        for start, end in self._chunks(audio):
+            result = self.model.transcribe(audio[start:end], batch_size=batch_size, language=lang)
+            lang = lang or result["language"]
+            for segment in result["segments"]:
+                segment["start"] += start / self.SAMPLE_RATE
+                segment["end"] += start / self.SAMPLE_RATE
+            segments.extend(result["segments"])
+            yield {"type": "segments", "progress": end / len(audio), "segments": result["segments"]}
+
+        yield {"type": "stage", "stage": "align"}
+        if lang not in self.align_models:
+            self.align_models[lang] = whisperx.load_align_model(language_code=lang, device=self.device)
+        align_model, metadata = self.align_models[lang]
+        result = whisperx.align(segments, align_model, metadata, audio, self.device,
+                                return_char_alignments=False)
+
+        if token:
+            yield {"type": "stage", "stage": "diarize"}
+            if not self.diarize_model:
+                self.diarize_model = whisperx.DiarizationPipeline(use_auth_token=token, device=self.device)
+            result = whisperx.assign_word_speakers(self.diarize_model(audio), result)
+
+        result["language"] = lang
+        yield {"type": "done", "result": result}
 
 
 def run_whisper(cc, src, dst_dir, model, lang, stop_event,
-                model_dir, 
+                model_dir,
                 token=None, reprocess=False, device=None):
+    """
+    Run whisperx in this process if we have it, otherwise as a subprocess
+    """
+    name = os.path.splitext(os.path.basename(src))[0]
+    retval = {
+        "dst": os.path.join(dst_dir, name) + ".vtt",
+        "dst_txt": os.path.join(dst_dir, name) + ".txt",
+        "dst_words": os.path.join(dst_dir, name) + ".json"
+    }
+
+    if not reprocess and os.path.exists(retval["dst_words"]) and os.path.getsize(retval["dst_words"]) > 0:
+        return 100, retval
+
+    try:
+        import whisperx
+        import whisperx.utils
+    except Exception:
+        cc.log.info("whisperx not available as a library, running the command line tool")
+        return run_whisper_cli(cc, src, dst_dir, model, lang, stop_event,
+                               model_dir, token, reprocess, device)
+
+    if not device:
+        import torch
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    cc.status["progress"] = 0
+    cc.status["state"] = "Loading model"
+    runner = WhisperX.get(model, device, model_dir)
+    cc.status["state"] = "Transcribing"
+    for event in runner.run(src, lang, token):
+        if stop_event.isSet():
+            cc.log.info("Terminating transcription")
+            raise Exception("Terminated")
+
+        if event["type"] == "segments":
+            cc.status["progress"] = int(80 * event["progress"])
+            for segment in event["segments"]:
+                cc.log.debug("[%.2f - %.2f] %s" % (segment["start"], segment["end"], segment["text"]))
+        elif event["type"] == "stage":
+            cc.status["state"] = event["stage"].capitalize()
+            cc.status["progress"] = 80 if event["stage"] == "align" else 90
+        elif event["type"] == "done":
+            result = event["result"]
+
+    os.makedirs(dst_dir, exist_ok=True)
+    writer = whisperx.utils.get_writer("all", dst_dir)
+    writer(result, src, {"highlight_words": False, "max_line_count": None, "max_line_width": None})
+    fix_whisperx_output(retval["dst_words"])
+    cc.status["progress"] = 100
+    return 100, retval
+
+
+def run_whisper_cli(cc, src, dst_dir, model, lang, stop_event,
+                    model_dir,
+                    token=None, reprocess=False, device=None):
 
     cmd = ["whisperx",
            "--output_dir", dst_dir,
@@ -291,6 +430,8 @@ def load_segment_file(filename, max_break=0.4, min_segment_length=0.6):
     with open(filename, "r") as f:
         if filename.endswith("json"):
             data = json.load(f)
+        elif filename.endswith("jsonl"):
+            data = [json.loads(line) for line in f]
         else:
             # CSV
             data = []
@@ -322,23 +463,103 @@ def load_segment_file(filename, max_break=0.4, min_segment_length=0.6):
         return segments
 
 
+class SegmentWindow:
+    """
+    A window of audio made by joining consecutive VAD segments, so whisper
+    gets up to a full 30s context at a time and not one short segment,
+    while long pauses are still cut out. Keeps the map from time in the
+    window back to time in the file.
+    """
+
+    def __init__(self, segments, sample_rate=16000):
+        self.segments = segments
+        self.sample_rate = sample_rate
+        self.offsets = []  # Start of each segment within the window
+        length = 0
+        for segment in segments:
+            self.offsets.append(length / sample_rate)
+            length += int(segment["end"] * sample_rate) - int(segment["start"] * sample_rate)
+        self.start = segments[0]["start"]
+        self.end = segments[-1]["end"]
+
+    def audio(self, audio):
+        import numpy as np
+        return np.concatenate([audio[int(s["start"] * self.sample_rate):int(s["end"] * self.sample_rate)]
+                               for s in self.segments])
+
+    def to_file_time(self, t):
+        """
+        Map a time in the window to a time in the file
+        """
+        idx = max(0, bisect.bisect_right(self.offsets, t) - 1)
+        segment = self.segments[idx]
+        return min(segment["start"] + t - self.offsets[idx], segment["end"])
+
+
+def create_windows(segments, max_length=30.0):
+    """
+    Group consecutive segments into windows of up to max_length seconds.
+    A segment that is longer than that is a window of its own.
+    """
+    windows = []
+    group = []
+    length = 0
+    for segment in segments:
+        duration = segment["end"] - segment["start"]
+        if group and length + duration > max_length:
+            windows.append(SegmentWindow(group))
+            group = []
+            length = 0
+        group.append(segment)
+        length += duration
+    if group:
+        windows.append(SegmentWindow(group))
+    return windows
+
+
 def merge(target, item, timeoffset):
+    """
+    Add the result of a transcribed bit to the target. timeoffset is the
+    start of the bit in the file, or a SegmentWindow to map the times.
+    The item is updated in place.
+    """
     if "text" not in target:
         raise Exception("Internal: Missing 'text' in target '{}'".format(str(target)))
     if "text" not in item:
         raise Exception("Internal: Missing 'text' in item '{}'".format(str(item)))
+    if isinstance(timeoffset, SegmentWindow):
+        to_file_time = timeoffset.to_file_time
+    else:
+        def to_file_time(t):
+            return t + timeoffset
+
     target["text"] += item["text"]
     for segment in item["segments"]:
         del segment["tokens"]
-        updated_segment = copy.deepcopy(segment)
-        for word in updated_segment["words"]:
-            word["start"] += timeoffset
-            word["end"] += timeoffset
+        for word in segment["words"]:
+            word["start"] = to_file_time(word["start"])
+            word["end"] = max(word["start"], to_file_time(word["end"]))
+
+        segment["start"] = segment["words"][0]["start"]
+        segment["end"] = segment["words"][-1]["end"]
 
-        updated_segment["start"] = updated_segment["words"][0]["start"]
-        updated_segment["end"] = updated_segment["words"][-1]["end"]
+        target["segments"].append(segment)
 
-        target["segments"].append(updated_segment)
+
+def transcribe_window(model, audio, lang, device="cuda:0", threads=None):
+    """
+    Transcribe a bit of audio, in a worker process if model is a name.
+    The workers load their own model, as they would all wait for the same
+    model in the model server otherwise.
+    """
+    if isinstance(model, str):
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        model = Model.get(model, device, local=True)
+    return model.transcribe(audio, language=lang,
+                            beam_size=5, best_of=5,
+                            temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0))
 
 
 def fix_words(res):
@@ -373,6 +594,15 @@ def process_task(cc, task, stop_event):
     if lang == "" or lang == "auto":
         lang = None
     src = args["src"]
+    if args.get("shards"):
+        with open(args["shards"], "r") as f:
+            shards = json.load(f)["shards"]
+        shard = int(args.get("shard", 0))
+        if shard >= len(shards):
+            # Short files get fewer shards than there are transcribe tasks
+            cc.log.info("No shard %d, only %d shards" % (shard, len(shards)))
+            return 100, {"dst": None, "dst_txt": None, "dst_words": None}
+        src = shards[shard]["file"]
     use_api = args.get("use_api", False)
     segment_file = args.get("segments", None)
     dst_dir = args.get("dir", "/tmp")
@@ -397,11 +627,29 @@ def process_task(cc, task, stop_event):
         cc.log.warning("Cache failed to catch this one")
         return 100, retval
 
+    def optional(name, cast):
+        return None if args.get(name) is None else cast(args[name])
+
+    def boolean(value):
+        # Workflow values can be strings, and "False" is truthy
+        if isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return bool(value)
+
+    pipeline_settings = {
+        "chunk_length_s": optional("chunk_length", float),
+        "stride_length_s": optional("stride_length", float),
+        "batch_size": optional("batch_size", int),
+        "num_beams": int(args.get("num_beams", 3)),
+        "autotune": optional("autotune", boolean)
+    }
+
     # Run from commandline or via API
     if not use_api and use_pipeline:
         try:
             return run_whisper_pipeline(cc, src, dst_dir, model, lang,
-                                        stop_event, reprocess, device)
+                                        stop_event, reprocess, device,
+                                        float(args.get("batch_wait", 0)), pipeline_settings)
         except Exception:
             # Try once more after a bit - we seem to get an issue once in a while where a
             # directory exists while being created - possible sync issue?
@@ -409,7 +657,8 @@ def process_task(cc, task, stop_event):
             import time
             time.sleep(random.random() * 10)
             return run_whisper_pipeline(cc, src, dst_dir, model, lang,
-                                        stop_event, reprocess, device)
+                                        stop_event, reprocess, device,
+                                        float(args.get("batch_wait", 0)), pipeline_settings)
 
     if not use_api:
         try:
@@ -421,50 +670,75 @@ def process_task(cc, task, stop_event):
 
     # We're using the API, that means we run whisper_timestamped for now
     import whisper_timestamped as whisper
-    model = Model.get(model, device=args.get("device", "cuda:0"))
+    device = args.get("device", "cuda:0")
+    workers = int(args.get("workers", max(1, os.cpu_count() // 4)))
+    use_pool = device == "cpu" and workers > 1
+    if not use_pool:
+        model = Model.get(model, device=device)
     # What happened to "patience?"
 
     # If we're "streaming", this is likely not too smart, use normal whisper?
     audio = whisper.load_audio(src)
 
-    # Ignore segments fully - DEBUG
-    if 0:
-        res = whisper.transcribe(model, audio, language=lang,            
-                             beam_size=5, best_of=5,
-                             temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0))
-    else:
-        # We should use VAD to ensure that we avoid large pauses - these will
-        # confuse timestamps
-        segments = [{"start": 0, "end": audio.shape[0]/16000.}]  # Default the whole file
-        if segment_file:
-            segments = load_segment_file(segment_file)
-
-        res = {"text": "", "segments": []}
-        DBG = []
-
-        for segment in segments:
-            startsample = segment["start"] * 16000
-            endsample = segment["end"] * 16000
-            cc.log.info(segment)
-            cc.log.info("   {} -> {}".format(startsample, endsample))
-            r = whisper.transcribe(model, audio[int(startsample):int(endsample)], language=lang,            
-                                 beam_size=5, best_of=5,
-                                 temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0))
-
-            DBG.append({"segment": segment, "result": r})
-            # Need to re-timestamp everything....
+    # We should use VAD to ensure that we avoid large pauses - these will
+    # confuse timestamps
+    segments = [{"start": 0, "end": audio.shape[0]/16000.}]  # Default the whole file
+    if segment_file:
+        segments = load_segment_file(segment_file)
+    if args.get("nonspeech"):
+        import nonspeech
+        segments = nonspeech.subtract(segments, nonspeech.load(args["nonspeech"]), min_length=0.2)
+
+    # Join the segments into windows of up to 30 seconds, whisper
+    # works on 30 second bits anyway
+    windows = create_windows(segments, float(args.get("window", 30.0)))
+    cc.log.info("{} segments in {} windows".format(len(segments), len(windows)))
+
+    res = {"text": "", "segments": []}
+    DBG = []
+
+    def results():
+        # Results in order, from a process pool on the CPU (whisper_timestamped
+        # can't batch on the GPU, so there we go one window at a time)
+        if not use_pool:
+            for window in windows:
+                yield transcribe_window(model, window.audio(audio), lang)
+            return
+
+        import concurrent.futures
+        import multiprocessing
+        threads = max(1, os.cpu_count() // workers)
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            futures = [pool.submit(transcribe_window, model, window.audio(audio), lang, device, threads)
+                       for window in windows]
             try:
-                merge(res, r, segment["start"])
-            except Exception as e:
-                cc.log.exception("Processing segment {} -> {}".format(segment["start"], segment["end"]))
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    for idx, r in enumerate(results()):
+        window = windows[idx]
+        cc.log.info("   {} -> {} ({} segments)".format(window.start, window.end, len(window.segments)))
+        cc.status["progress"] = int(100 * (idx + 1) / len(windows))
+
+        DBG.append({"segments": window.segments, "result": r})
+        # Need to re-timestamp everything....
+        try:
+            merge(res, r, window)
+        except Exception as e:
+            cc.log.exception("Processing window {} -> {}".format(window.start, window.end))
+
+        if stop_event.isSet():
+            raise Exception("Terminated")
 
-        with open("/tmp/dbg_whisper.json", "w") as f:
-            json.dump(DBG, f)
+    with open("/tmp/dbg_whisper.json", "w") as f:
+        json.dump(DBG, f)
     res = fix_words(res)
 
     # Save it to the destination
-    with open(retval["dst_words"], "w") as f:
-        json.dump(res, f, indent=" ")
+    artefacts.save(res, retval["dst_words"], pretty=True)
 
     for s in res["segments"]:
         del s["words"] 
@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+"""
+Per node model server.
+
+All the modules on a node get their models through get_model(). If a
+model server is running on the node (python modelserver.py, see
+workernode/modelserver), get_model() gives a handle to a model in the
+server, so every model is loaded once per node whichever module or
+workflow uses it. If not, the model is loaded in the process, in the
+same kind of registry.
+
+Models are wrapped in small adapter classes with plain python / numpy in
+and out, so the same calls work on a local model and over the socket.
+The registry keeps the models within a memory budget and evicts the least
+recently used one when a new one doesn't fit.
+"""
+
+import os
+import gc
+import sys
+import stat
+import time
+import secrets
+import threading
+import traceback
+import contextlib
+import collections
+
+DEFAULT_BUDGET_MB = 20000
+
+
+def _default_address():
+    """
+    The socket goes in a directory only this user can get into, as
+    requests and replies are pickled
+    """
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "transcribe", "modelserver.sock")
+    return "/tmp/transcribe-%d/modelserver.sock" % os.getuid()
+
+
+DEFAULT_ADDRESS = _default_address()
+
+
+def _default_device():
+    import torch
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def _module_size(*modules):
+    """
+    Memory used by the parameters and buffers of the given torch modules
+    """
+    size = 0
+    for module in modules:
+        if hasattr(module, "parameters"):
+            size += sum(p.numel() * p.element_size() for p in module.parameters())
+        if hasattr(module, "buffers"):
+            size += sum(b.numel() * b.element_size() for b in module.buffers())
+    return size
+
+
+class WhisperModel:
+    """
+    OpenAI whisper, used for transcription (with word timestamps) and for
+    decoding short bits
+    """
+
+    def __init__(self, model, device):
+        try:
+            import whisper_timestamped as whisper
+        except ImportError:
+            import whisper
+        self.model = whisper.load_model(model, device=device)
+
+    def size(self):
+        return _module_size(self.model)
+
+    def transcribe(self, audio, **kwargs):
+        import whisper_timestamped as whisper
+        return whisper.transcribe(self.model, audio, **kwargs)
+
+    def _mel(self, audio):
+        import whisper
+        audio = whisper.pad_or_trim(audio)
+        return whisper.log_mel_spectrogram(audio).to(self.model.device)
+
+    def detect_language(self, audio):
+        _, probs = self.model.detect_language(self._mel(audio))
+        return probs
+
+    def decode(self, audio, **options):
+        import whisper
+        return whisper.decode(self.model, self._mel(audio), whisper.DecodingOptions(**options)).text
+
+
+class BatchScheduler:
+    """
+    Collects requests from many callers (threads) and runs them together.
+    A batch is started as soon as there is a request, after waiting up to
+    max_wait seconds for more requests with the same key, since only
+    requests with the same key (same parameters) can be run together.
+    run(items, key) must return a result per item, in order.
+    """
+
+    class Request:
+        def __init__(self, item, key):
+            self.item = item
+            self.key = key
+            self.time = time.time()
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, run, max_items=16):
+        self.run = run
+        self.max_items = max_items
+        self.queue = []
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def submit(self, item, key, max_wait=0):
+        request = BatchScheduler.Request(item, key)
+        request.deadline = request.time + max_wait
+        with self.cond:
+            self.queue.append(request)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            first = self.queue[0]
+            while True:
+                batch = [r for r in self.queue if r.key == first.key][:self.max_items]
+                remaining = first.deadline - time.time()
+                if len(batch) >= self.max_items or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            for r in batch:
+                self.queue.remove(r)
+            return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self.run([r.item for r in batch], batch[0].key)
+                for r, result in zip(batch, results):
+                    r.result = result
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            for r in batch:
+                r.done.set()
+
+
+class AsrPipeline:
+    """
+    Huggingface speech recognition pipeline with word timestamps.
+    transcribe() batches the chunks of files from concurrent jobs
+    together, so a batch is full even if the files are short. It isn't
+    run under the registry lock of the model, so the pipeline has its
+    own lock for everything that runs it.
+    """
+    UNLOCKED = ["transcribe"]  # Does its own scheduling
+
+    def __init__(self, model, device):
+        from transformers import pipeline
+        import torch
+        self.pipeline = pipeline(task="automatic-speech-recognition",
+                                 torch_dtype=torch.float16,
+                                 model=model,
+                                 device=device,
+                                 return_timestamps="word")
+        self.scheduler = BatchScheduler(self._run)
+        self.lock = threading.Lock()
+
+    def size(self):
+        return _module_size(self.pipeline.model)
+
+    def __call__(self, *args, **kwargs):
+        with self.lock:
+            return self.pipeline(*args, **kwargs)
+
+    def device_name(self):
+        import torch
+        if self.pipeline.device.type == "cuda":
+            return torch.cuda.get_device_name(self.pipeline.device)
+        return "cpu"
+
+    def calibrate(self, **kwargs):
+        """
+        Find the fastest settings on this device, see asrtuner.calibrate()
+        """
+        import asrtuner
+        with self.lock:
+            return asrtuner.calibrate(self.pipeline, **kwargs)
+
+    def _run(self, sources, key):
+        generate_kwargs, kwargs = key
+        print("Transcribing %d files in one go" % len(sources))
+        with self.lock:
+            results = self.pipeline(sources, generate_kwargs=dict(generate_kwargs), **dict(kwargs))
+        return results if isinstance(results, list) else [results]
+
+    def transcribe(self, source, generate_kwargs={}, max_wait=0, **kwargs):
+        """
+        Transcribe a file together with the other files that are queued
+        now or within max_wait seconds, using the same parameters.
+        kwargs are chunk_length_s, batch_size etc. for the pipeline.
+        """
+        key = (tuple(sorted(generate_kwargs.items())), tuple(sorted(kwargs.items())))
+        return self.scheduler.submit(source, key, max_wait)
+
+
+class SentenceModel:
+    def __init__(self, model, device):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model, device=device)
+
+    def size(self):
+        return _module_size(self.model)
+
+    def encode(self, sentences, **kwargs):
+        return self.model.encode(sentences, **kwargs)
+
+
+class SpeakerModel:
+    """
+    NeMo speaker verification model, gives speaker embeddings
+    """
+
+    def __init__(self, model, device):
+        import torch
+        import nemo.collections.asr as nemo_asr
+        self.model = nemo_asr.models.EncDecSpeakerLabelModel.from_pretrained(model, map_location=device)
+        self.model.eval()
+        if self.model.device.type == "cpu":
+            # No GPU, make sure a batch is spread over all the cores
+            torch.set_num_threads(os.cpu_count())
+
+    def size(self):
+        return _module_size(self.model)
+
+    def sample_rate(self):
+        return self.model._cfg.train_ds.get("sample_rate", 16000)
+
+    def embed(self, signals, lengths):
+        """
+        Embeddings for a (batch, samples) float32 array of signals
+        """
+        import torch
+        audio = torch.from_numpy(signals).to(self.model.device)
+        lengths = torch.tensor(lengths, device=self.model.device)
+        with torch.no_grad():
+            _, embs = self.model.forward(input_signal=audio, input_signal_length=lengths)
+        return embs.cpu().numpy()
+
+    def embed_file(self, filename):
+        return self.model.get_embedding(filename).cpu().numpy()
+
+
+class Seq2SeqModel:
+    """
+    Huggingface text to text model (punctuation etc.)
+    """
+
+    def __init__(self, model, device, tokenizer, max_length=512):
+        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(model).to(device)
+        self.model.config.max_length = max_length
+        self.model.config.task_specific_params["translation"]["max_length"] = max_length
+        self.model.config.task_specific_params["text-generation"]["max_length"] = max_length
+
+    def size(self):
+        return _module_size(self.model)
+
+    def generate(self, text):
+        translated = self.model.generate(**self.tokenizer(text, return_tensors="pt", padding=True).to(self.device))
+        return [self.tokenizer.decode(t, skip_special_tokens=True) for t in translated]
+
+
+class HfWhisperModel:
+    """
+    Huggingface whisper, the openai models are run with generate(), the
+    others as a pipeline
+    """
+
+    def __init__(self, model, device, lang="en"):
+        from transformers import WhisperProcessor
+        self.device = device
+        self.pipeline = None
+        if model.startswith("openai"):
+            from transformers import WhisperForConditionalGeneration
+            self.processor = WhisperProcessor.from_pretrained(model)
+            self.model = WhisperForConditionalGeneration.from_pretrained(model).to(device)
+            self.model.forced_decoder_ids = self.processor.get_decoder_prompt_ids(language=lang, task="transcribe",
+                                                                                  no_timestamps=False)
+        else:
+            from transformers import pipeline
+            self.pipeline = pipeline(task="automatic-speech-recognition",
+                                     model=model,
+                                     chunk_length_s=29,
+                                     device=device)
+            self.processor = WhisperProcessor.from_pretrained("NbAiLab/whisper-norwegian-small-test")
+            self.pipeline.model.config.forced_decoder_ids = \
+                self.processor.get_decoder_prompt_ids(language=lang,
+                                                      task="transcribe",
+                                                      no_timestamps=False)
+            self.model = self.pipeline.model
+
+    def size(self):
+        return _module_size(self.model)
+
+    def has_pipeline(self):
+        return self.pipeline is not None
+
+    def __call__(self, source):
+        return self.pipeline(source)
+
+    def transcribe(self, audio):
+        input_features = self.processor(audio, return_tensors="pt", sampling_rate=16000).input_features.to(self.device)
+        predicted_ids = self.model.generate(input_features)
+        return self.processor.batch_decode(predicted_ids, skip_special_tokens=True)
+
+
+KINDS = {
+    "whisper": WhisperModel,
+    "asr_pipeline": AsrPipeline,
+    "sentence_transformer": SentenceModel,
+    "speaker": SpeakerModel,
+    "seq2seq": Seq2SeqModel,
+    "hf_whisper": HfWhisperModel
+}
+
+
+class ModelRegistry:
+    """
+    Loads models once and keeps them within a memory budget, evicting the
+    least recently used models that are not in use
+    """
+    instance = None
+    _instance_lock = threading.Lock()
+
+    class Entry:
+        def __init__(self):
+            self.model = None
+            self.size = 0
+            self.lock = threading.Lock()  # Held while a (locked) method runs
+            self.users = 0  # Callers using the model, it's not evicted while > 0
+            self.ready = threading.Event()
+            self.error = None
+
+    @staticmethod
+    def get(budget_mb=None):
+        with ModelRegistry._instance_lock:
+            if not ModelRegistry.instance:
+                if budget_mb is None:
+                    budget_mb = int(os.environ.get("MODEL_BUDGET_MB", DEFAULT_BUDGET_MB))
+                ModelRegistry.instance = ModelRegistry(budget_mb)
+            return ModelRegistry.instance
+
+    def __init__(self, budget_mb):
+        self.budget = budget_mb * 1024 * 1024
+        self.models = collections.OrderedDict()  # key -> Entry, least recently used first
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(kind, model, device, options):
+        return (kind, model, device, tuple(sorted(options.items())))
+
+    @contextlib.contextmanager
+    def use(self, kind, model, device=None, options={}):
+        """
+        The entry of a model, loaded if needed. The model is not evicted
+        until the block is done. Models are loaded outside the registry
+        lock, so other models can be used meanwhile, and callers wanting
+        a model that is being loaded wait for it.
+        """
+        if kind not in KINDS:
+            raise Exception("Unknown model kind '%s'" % kind)
+        if not device:
+            device = _default_device()
+        key = self.key(kind, model, device, options)
+        with self.lock:
+            entry = self.models.get(key)
+            loading = entry is None
+            if loading:
+                entry = ModelRegistry.Entry()
+                self.models[key] = entry
+            self.models.move_to_end(key)
+            entry.users += 1
+
+        try:
+            if loading:
+                try:
+                    print("Loading %s model %s on %s" % (kind, model, device))
+                    t = time.time()
+                    entry.model = KINDS[kind](model, device, **options)
+                    entry.size = entry.model.size()
+                    print("  loaded in %.1fs, %d MB" % (time.time() - t, entry.size / (1024 * 1024)))
+                except Exception as e:
+                    entry.error = e
+                    with self.lock:
+                        del self.models[key]
+                    raise
+                finally:
+                    entry.ready.set()
+                with self.lock:
+                    self._evict(keep=key)
+            else:
+                entry.ready.wait()
+                if entry.error:
+                    raise Exception("Loading %s model %s failed: %s" % (kind, model, entry.error))
+            yield entry
+        finally:
+            with self.lock:
+                entry.users -= 1
+
+    def load(self, kind, model, device=None, options={}):
+        with self.use(kind, model, device, options) as entry:
+            return entry.model
+
+    def _evict(self, keep):
+        total = sum(entry.size for entry in self.models.values())
+        for key in list(self.models):
+            if total <= self.budget:
+                break
+            entry = self.models[key]
+            if key == keep or entry.users > 0 or not entry.ready.is_set():
+                continue  # In use
+            print("Evicting %s model %s (%d MB)" % (key[0], key[1], entry.size / (1024 * 1024)))
+            del self.models[key]
+            total -= entry.size
+
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return [{"kind": k[0], "model": k[1], "device": k[2], "size": entry.size}
+                    for k, entry in self.models.items() if entry.ready.is_set()]
+
+    def call(self, kind, model, device, options, method, args, kwargs):
+        with self.use(kind, model, device, options) as entry:
+            if method in getattr(entry.model, "UNLOCKED", []):
+                return getattr(entry.model, method)(*args, **kwargs)
+            with entry.lock:
+                return getattr(entry.model, method)(*args, **kwargs)
+
+
+class LocalModel:
+    """
+    Model in this process, goes through the registry for every call like
+    the server does
+    """
+
+    def __init__(self, kind, model, device, options):
+        self._args = (kind, model, device, options)
+        ModelRegistry.get().load(kind, model, device, options)
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return ModelRegistry.get().call(*self._args, method, args, kwargs)
+        return call
+
+    def __call__(self, *args, **kwargs):
+        return ModelRegistry.get().call(*self._args, "__call__", args, kwargs)
+
+
+class RemoteModel:
+    """
+    Handle to a model in the model server
+    """
+
+    def __init__(self, address, kind, model, device, options):
+        from multiprocessing.connection import Client
+        self._args = (kind, model, device, options)
+        self._conn = Client(address, family="AF_UNIX", authkey=_authkey(address))
+        self._lock = threading.Lock()
+        self._request("load", kind, model, device, options)
+
+    def _request(self, *request):
+        with self._lock:
+            self._conn.send(request)
+            status, result = self._conn.recv()
+        if status != "ok":
+            raise Exception("Model server failed: %s" % result)
+        return result
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self._request("call", *self._args, method, args, kwargs)
+        return call
+
+    def __call__(self, *args, **kwargs):
+        return self._request("call", *self._args, "__call__", args, kwargs)
+
+    def __del__(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+
+
+def _private_dir(address, create=False):
+    """
+    The directory of the socket, which must be ours and not open to
+    anyone else, since whoever can connect can run code in the server
+    (and a fake server can run code in the clients)
+    """
+    directory = os.path.dirname(os.path.abspath(address))
+    if create:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise Exception("Model server directory '%s' must be a directory owned by "
+                        "this user with mode 0700" % directory)
+    return directory
+
+
+def _authkey(address, create=False):
+    """
+    MODEL_SERVER_KEY, or a random key in a file only this user can read
+    next to the socket, made by the server if create
+    """
+    if os.environ.get("MODEL_SERVER_KEY"):
+        return os.environ["MODEL_SERVER_KEY"].encode("utf-8")
+    keyfile = os.path.join(_private_dir(address, create), "modelserver.key")
+    if create and not os.path.exists(keyfile):
+        fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    st = os.lstat(keyfile)
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise Exception("Model server key '%s' must be owned by this user with mode 0600" % keyfile)
+    with open(keyfile, "r") as f:
+        return f.read().strip().encode("utf-8")
+
+
+def get_model(kind, model, device=None, local=False, **options):
+    """
+    Get a model, from the model server on this node if there is one
+    (MODEL_SERVER is the socket, default in $XDG_RUNTIME_DIR), otherwise
+    loaded in this process. local loads it in this process anyway, for
+    workers that are there to run a model in parallel.
+    """
+    address = os.environ.get("MODEL_SERVER", DEFAULT_ADDRESS)
+    if not local and os.path.exists(address):
+        try:
+            return RemoteModel(address, kind, model, device, options)
+        except (ConnectionError, EOFError, OSError):
+            print("Model server at '%s' not responding, loading the model locally" % address)
+        except Exception as e:
+            print("Not using the model server at '%s': %s" % (address, e))
+    return LocalModel(kind, model, device, options)
+
+
+def serve(address, budget_mb):
+    """
+    Serve models on a unix socket, a thread per client
+    """
+    from multiprocessing.connection import Listener
+
+    registry = ModelRegistry.get(budget_mb)
+
+    def handle(conn):
+        try:
+            while True:
+                request = conn.recv()
+                try:
+                    if request[0] == "load":
+                        registry.load(*request[1:])
+                        conn.send(("ok", None))
+                    elif request[0] == "call":
+                        conn.send(("ok", registry.call(*request[1:])))
+                    elif request[0] == "stats":
+                        conn.send(("ok", registry.stats()))
+                    else:
+                        conn.send(("error", "Unknown request '%s'" % request[0]))
+                except Exception:
+                    traceback.print_exc()
+                    conn.send(("error", traceback.format_exc()))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    authkey = _authkey(address, create=True)
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    os.chmod(address, 0o600)
+    print("Model server listening on %s, budget %d MB" % (address, budget_mb))
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                traceback.print_exc()
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    finally:
+        listener.close()
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Serve models to the modules on this node")
+    parser.add_argument("-s", "--socket", dest="socket",
+                        default=os.environ.get("MODEL_SERVER", DEFAULT_ADDRESS),
+                        help="Unix socket to listen on")
+    parser.add_argument("-b", "--budget", dest="budget", type=int,
+                        default=int(os.environ.get("MODEL_BUDGET_MB", DEFAULT_BUDGET_MB)),
+                        help="Memory budget for models in MB")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        help="Print the models loaded in a running server")
+
+    options = parser.parse_args()
+    if options.stats:
+        from multiprocessing.connection import Client
+        conn = Client(options.socket, family="AF_UNIX", authkey=_authkey(options.socket))
+        conn.send(("stats",))
+        for model in conn.recv()[1]:
+            print("%(kind)-20s %(model)-40s %(device)-8s %(size)12d" % model)
+        sys.exit(0)
+
+    serve(options.socket, options.budget)
@@ -0,0 +1,68 @@
+"""
+Non-speech masks, sorted lists of {"start", "end", "type"} for audio that
+is known not to be speech (silence, noise), made by mod_detect_voice when
+the prefilter is on. Stages that run models over the audio cut these bits
+out of their segments to not waste inference on them.
+"""
+
+import json
+import bisect
+
+
+def save(mask, filename):
+    with open(filename, "w") as f:
+        json.dump(mask, f, indent=" ")
+
+
+def load(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def from_flags(flags, frame_duration_ms, kind="nonspeech"):
+    """
+    Mask from a per frame array, non zero for frames that are not speech
+    """
+    import numpy as np
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], flags != 0, [0])).astype(np.int8)))
+    return [{"start": start * frame_duration_ms / 1000.,
+             "end": end * frame_duration_ms / 1000.,
+             "type": kind}
+            for start, end in zip(edges[::2].tolist(), edges[1::2].tolist())]
+
+
+def overlaps(mask, spans):
+    """
+    For each (start, end) in spans, True if any of the mask is in it
+    """
+    ends = [m["end"] for m in mask]
+    result = []
+    for start, end in spans:
+        idx = bisect.bisect_right(ends, start)
+        result.append(idx < len(mask) and mask[idx]["start"] < end)
+    return result
+
+
+def subtract(segments, mask, min_length=0.0):
+    """
+    Cut the masked bits out of the segments. Segments are split where a
+    mask interval is inside them, and pieces shorter than min_length are
+    dropped (as are empty ones). Returns new segments, the given ones are
+    not changed.
+    """
+    def keep(length):
+        return length > 0 and length >= min_length - 1e-9
+
+    ends = [m["end"] for m in mask]
+    result = []
+    for segment in segments:
+        start = segment["start"]
+        idx = bisect.bisect_right(ends, start)
+        while idx < len(mask) and mask[idx]["start"] < segment["end"]:
+            if keep(mask[idx]["start"] - start):
+                result.append(dict(segment, start=start, end=mask[idx]["start"]))
+            start = max(start, mask[idx]["end"])
+            idx += 1
+        if keep(segment["end"] - start):
+            result.append(dict(segment, start=start, end=segment["end"]))
+    return result
@@ -0,0 +1,253 @@
+import os
+import glob
+import json
+import secrets
+
+import numpy as np
+
+
+class PeopleStore:
+    """
+    Packed database of known voices.
+
+    The embeddings of all people are rows in one float32 matrix (an .npy
+    file, memory mapped when loaded), while people.json holds the name,
+    color, avatar etc. of each person and which rows are theirs. Rows are
+    normalized when they are added, so a search is a single matrix
+    multiply, and loading the store never unpickles anything.
+
+    Every save writes the matrix to a new file and then replaces
+    people.json, which names that file, so people.json always goes with
+    the matrix it was written for.
+    """
+    EMBEDDINGS = "embeddings.npy"  # Stores from before the file was named in people.json
+    METADATA = "people.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.people = []  # [{"name": ..., "color": ..., "src": ..., "first": row, "count": rows}]
+        self._index = {}  # name -> position in people
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._ivf = None  # Approximate index, see build_index()
+
+        if os.path.exists(os.path.join(directory, PeopleStore.METADATA)):
+            self.load()
+
+    def load(self, retries=3):
+        for attempt in range(retries):
+            with open(os.path.join(self.directory, PeopleStore.METADATA), "r") as f:
+                data = json.load(f)
+            people = data["people"]
+            matrix = np.zeros((0, 0), dtype=np.float32)
+            if people:
+                try:
+                    matrix = np.load(os.path.join(self.directory,
+                                                  data.get("embeddings", PeopleStore.EMBEDDINGS)),
+                                     mmap_mode="r")
+                except FileNotFoundError:
+                    if attempt == retries - 1:
+                        raise
+                    continue  # Saved again since we read people.json
+            break
+
+        rows = data.get("rows", sum(p["count"] for p in people))
+        if len(matrix) != rows:
+            raise Exception("People store '%s' is broken, %d embeddings where %d were saved" %
+                            (self.directory, len(matrix), rows))
+        self.people = people
+        self._index = {p["name"]: i for i, p in enumerate(self.people)}
+        self._matrix = matrix
+        self._ivf = None
+
+    def save(self):
+        """
+        Write the store, replacing the files atomically so a running
+        workflow never sees a half written store
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        old = glob.glob(os.path.join(self.directory, "embeddings*.npy"))
+        name = "embeddings-%s.npy" % secrets.token_hex(8)
+        dst = os.path.join(self.directory, name)
+        with open(dst + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(self._matrix, dtype=np.float32))
+        os.replace(dst + ".tmp", dst)
+
+        dst = os.path.join(self.directory, PeopleStore.METADATA)
+        with open(dst + ".tmp", "w") as f:
+            json.dump({"people": self.people, "embeddings": name, "rows": len(self._matrix)},
+                      f, indent=" ")
+        os.replace(dst + ".tmp", dst)
+
+        # Only now nobody can find the old matrix any more
+        for filename in old:
+            os.remove(filename)
+
+    def __len__(self):
+        return len(self.people)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def names(self):
+        return [p["name"] for p in self.people]
+
+    def get(self, name):
+        """
+        The metadata of a person (without the row info)
+        """
+        info = dict(self.people[self._index[name]])
+        del info["first"], info["count"]
+        return info
+
+    def get_embeddings(self, name):
+        """
+        The (normalized) embeddings of a person as a (count, D) array
+        """
+        p = self.people[self._index[name]]
+        return self._matrix[p["first"]:p["first"] + p["count"]]
+
+    @staticmethod
+    def _as_matrix(embeddings):
+        """
+        Convert a list of embeddings (torch tensors or arrays, (1, D) or
+        (D,)) or a single (N, D) array to a normalized float32 (N, D) array
+        """
+        if hasattr(embeddings, "cpu") or isinstance(embeddings, np.ndarray):
+            embeddings = [embeddings]
+        rows = []
+        for e in embeddings:
+            if hasattr(e, "cpu"):
+                e = e.detach().cpu().numpy()
+            rows.append(np.asarray(e, dtype=np.float32).reshape(-1, np.shape(e)[-1]))
+        matrix = np.concatenate(rows)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def add_person(self, info, embeddings):
+        """
+        Add a person, info is a dict with at least "name". If the person is
+        already in the store, the person is replaced. Call save() to store.
+        """
+        if "name" not in info:
+            raise Exception("Missing name for person")
+        matrix = self._as_matrix(embeddings)
+        if len(matrix) == 0:
+            raise Exception("No embeddings for person '%s'" % info["name"])
+        if len(self._matrix) and matrix.shape[1] != self._matrix.shape[1]:
+            raise Exception("Embedding size %d doesn't match the store (%d)" %
+                            (matrix.shape[1], self._matrix.shape[1]))
+
+        if info["name"] in self._index:
+            self.remove_person(info["name"])
+
+        person = {k: v for k, v in info.items() if k not in ("voice", "segments")}
+        person["first"] = len(self._matrix)
+        person["count"] = len(matrix)
+        if len(self._matrix):
+            self._matrix = np.concatenate((self._matrix, matrix))
+        else:
+            self._matrix = matrix
+        self._index[person["name"]] = len(self.people)
+        self.people.append(person)
+        self._ivf = None
+
+    def remove_person(self, name):
+        p = self.people[self._index[name]]
+        keep = np.ones(len(self._matrix), dtype=bool)
+        keep[p["first"]:p["first"] + p["count"]] = False
+        self._matrix = self._matrix[keep]
+
+        self.people.remove(p)
+        for other in self.people:
+            if other["first"] > p["first"]:
+                other["first"] -= p["count"]
+        self._index = {p["name"]: i for i, p in enumerate(self.people)}
+        self._ivf = None
+
+    def build_index(self, nlist=None):
+        """
+        Build an approximate index over the store, used by search() with
+        nprobe. Has to be rebuilt if people are added.
+        """
+        from annindex import IVFIndex
+        labels = np.empty(len(self._matrix), dtype=np.int64)
+        for i, p in enumerate(self.people):
+            labels[p["first"]:p["first"] + p["count"]] = i
+        self._ivf = IVFIndex(np.asarray(self._matrix), labels, nlist=nlist)
+        return self._ivf
+
+    def search(self, query, k=5, nprobe=0, shortlist=20):
+        """
+        Find the k most similar people for the query, which is one or more
+        embeddings of the same voice. A person's score is the best cosine
+        similarity between any of the query embeddings and any of theirs.
+        If nprobe is given, an approximate index shortlists the people
+        that are scored (see annindex.py).
+        Returns [(name, similarity), ...], best first.
+        """
+        if len(self.people) == 0:
+            return []
+
+        query = self._as_matrix(query)
+        people = []
+        if nprobe and len(self.people) > shortlist:
+            if self._ivf is None:
+                self.build_index()
+            candidates, _ = self._ivf.search(query, k=shortlist, nprobe=nprobe)
+            people = [int(p) for p in np.unique(candidates) if p >= 0]
+        if people:
+            scores = np.empty(len(people), dtype=np.float32)
+            for n, i in enumerate(people):
+                scores[n] = (query @ self.get_embeddings(self.people[i]["name"]).T).max()
+        else:
+            # Exact search, also if the probed lists had nobody in them
+            people = list(range(len(self.people)))
+            similarities = (query @ np.asarray(self._matrix).T).max(axis=0)
+            # The rows of a person are consecutive, so this is the best per person
+            firsts = np.array([p["first"] for p in self.people])
+            order = np.argsort(firsts)
+            scores = np.empty(len(self.people), dtype=np.float32)
+            scores[order] = np.maximum.reduceat(similarities, firsts[order])
+
+        k = min(k, len(people))
+        if k <= 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.people[people[i]]["name"], float(scores[i])) for i in best]
+
+
+def migrate(src_dir, dst_dir):
+    """
+    Import the old people files (json with base64 encoded pickled torch
+    embeddings) into a store. This is the only place that unpickles them.
+    """
+    import base64
+    import pickle
+
+    store = PeopleStore(dst_dir)
+    for filename in sorted(glob.glob(os.path.join(src_dir, "*.json"))):
+        with open(filename, "r") as f:
+            info = json.load(f)
+        if "name" not in info or "voice" not in info:
+            print("Skipping '%s', not a person" % filename)
+            continue
+        embeddings = pickle.loads(base64.b64decode(info["voice"].encode("ascii")))
+        store.add_person(info, embeddings)
+        print("Added %s (%d embeddings)" % (info["name"], len(embeddings)))
+    store.save()
+    return store
+
+
+if __name__ == "__main__":
+
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Migrate a directory of people files to a people store")
+    parser.add_argument("-s", "--src", dest="src", default=os.path.expanduser("~/peopleDB"),
+                        help="Directory with old style people json files")
+    parser.add_argument("-d", "--dest", dest="dst", required=True, help="People store directory")
+
+    options = parser.parse_args()
+    store = migrate(options.src, options.dst)
+    print("Store '%s' has %d people" % (options.dst, len(store)))
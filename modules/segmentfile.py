@@ -0,0 +1,103 @@
+import os
+import json
+import time
+
+
+class SegmentWriter:
+    """
+    Write segments to a .jsonl or .csv file as they are found. They go to
+    <filename>.partial, which is renamed to filename when done, so a
+    consumer can follow the partial file (see follow_segments()) and knows
+    that all segments are there once the real file exists.
+    """
+
+    def __init__(self, filename, src=""):
+        self.filename = filename
+        self.src = src
+        self.is_csv = not filename.endswith(".jsonl")
+        self.count = 0
+        self._f = open(filename + ".partial", "w")
+        if self.is_csv:
+            self._f.write("speaker,start,end,duration,audio_path\n")
+            self._f.flush()
+
+    def write(self, segments):
+        for item in segments:
+            if self.is_csv:
+                self._f.write("%s,%f,%f,%f,%s\n" % (item.get("who", "unknown"),
+                                                    item["start"],
+                                                    item["end"],
+                                                    item["end"] - item["start"],
+                                                    self.src))
+            else:
+                self._f.write(json.dumps({k: v for k, v in item.items() if k != "frames"}) + "\n")
+        self.count += len(segments)
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+        os.replace(self.filename + ".partial", self.filename)
+
+
+def parse_line(line, is_csv):
+    """
+    A segment from a line of a segment file, None for the csv header
+    """
+    if not is_csv:
+        return json.loads(line)
+    speaker, start, end, duration, fn = line.rstrip("\n").split(",", 4)
+    if not start.replace(".", "").isnumeric():
+        return None
+    return {"start": float(start), "end": float(end), "who": speaker, "file": fn, "text": ""}
+
+
+def read_segments(filename):
+    """
+    All the segments of a complete segment file
+    """
+    is_csv = not filename.endswith(".jsonl")
+    with open(filename, "r") as f:
+        return [segment for segment in (parse_line(line, is_csv) for line in f if line.strip())
+                if segment]
+
+
+def follow_segments(filename, poll=1.0, stop_event=None, timeout=None):
+    """
+    Yield the segments of a segment file made by SegmentWriter as they are
+    written, until the file is complete. Works on complete files too.
+    With a timeout, give up if the file doesn't show up or stops growing
+    for that many seconds (the writer died).
+    """
+    is_csv = not filename.endswith(".jsonl")
+    partial = filename + ".partial"
+    pos = 0
+    size = -1
+    changed = time.time()
+    while True:
+        # Check before reading, so nothing written before the rename is missed
+        done = os.path.exists(filename)
+        path = filename if done else partial
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                f.seek(pos)
+                while True:
+                    line = f.readline()
+                    if not line.endswith("\n"):
+                        break  # Not completely written yet
+                    pos = f.tell()
+                    segment = parse_line(line, is_csv)
+                    if segment:
+                        yield segment
+                grown = os.fstat(f.fileno()).st_size != size
+                size = os.fstat(f.fileno()).st_size
+            if grown:
+                changed = time.time()
+            elif not done and timeout and time.time() - changed > timeout:
+                raise Exception("Segment file '%s' stopped growing" % filename)
+        elif timeout and time.time() - changed > timeout:
+            raise Exception("Segment file '%s' did not show up" % filename)
+        if done:
+            return
+        if stop_event and stop_event.isSet():
+            raise Exception("Terminated")
+        time.sleep(poll)
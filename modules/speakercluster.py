@@ -0,0 +1,104 @@
+import torch
+
+
+class Speaker:
+    """
+    The running mean of the (normalized) embeddings of one speaker, updated
+    a segment at a time. Speakers are matched on their mean only.
+    """
+
+    def __init__(self, label, dim, device):
+        self.label = label
+        self.n = 0
+        self.mean = torch.zeros(dim, device=device)
+
+    def update(self, embeddings):
+        """
+        Add an (n, D) batch of normalized embeddings
+        """
+        m = len(embeddings)
+        total = self.n + m
+        self.mean += (embeddings.mean(dim=0) - self.mean) * (m / total)
+        self.n = total
+
+
+class SpeakerClusterer:
+    """
+    Online clustering of speech segments into speakers.
+
+    Segments are given in order, each as the embeddings of its windows.
+    A segment is only used if it looks like one speaker, i.e. if the
+    average similarity between its embeddings is at least one_speaker.
+    It then goes to the speaker it is most similar to, if that is at least
+    new_speaker, otherwise it starts a new speaker.
+
+    The similarity between a segment and a speaker is the average
+    similarity between the embeddings of the two, which for normalized
+    embeddings is just the dot product of their means, so a segment is
+    compared with all speakers in one matrix-vector product whatever the
+    length of the programme.
+    """
+
+    def __init__(self, one_speaker=0.25, new_speaker=0.16):
+        self.one_speaker = one_speaker
+        self.new_speaker = new_speaker
+        self.speakers = []
+        self._means = None  # (speakers, D), the means of the speakers
+
+    @staticmethod
+    def _matrix(embeddings):
+        """
+        Normalized (n, D) matrix from a list of (1, D) or (D,) embeddings
+        """
+        matrix = torch.cat([e.reshape(1, -1) for e in embeddings]).float()
+        return torch.nn.functional.normalize(matrix, dim=-1)
+
+    @staticmethod
+    def consistency(matrix):
+        """
+        Average pairwise similarity of the rows of a normalized matrix,
+        from the norm of their sum: |sum|^2 = n + sum over pairs i != j
+        """
+        n = len(matrix)
+        if n < 2:
+            return 0.0
+        total = matrix.sum(dim=0)
+        return float((total @ total - n) / (n * (n - 1)))
+
+    def add_speaker(self, label, embeddings):
+        """
+        Add an already known speaker
+        """
+        matrix = self._matrix(embeddings)
+        speaker = Speaker(label, matrix.shape[1], matrix.device)
+        speaker.update(matrix)
+        self.speakers.append(speaker)
+        mean = speaker.mean.unsqueeze(0)
+        self._means = mean if self._means is None else torch.cat((self._means, mean))
+        return speaker
+
+    def add_segment(self, embeddings, new_label):
+        """
+        Cluster a segment. Returns (speaker, similarity, is_new), speaker is
+        None if the segment doesn't look like a single speaker. A new
+        speaker is given new_label, the similarity is then the consistency
+        of the segment.
+        """
+        if len(embeddings) < 2:
+            return None, 0.0, False
+        matrix = self._matrix(embeddings)
+        consistency = self.consistency(matrix)
+        if consistency <= self.one_speaker:
+            return None, consistency, False
+
+        if self.speakers:
+            scores = self._means.to(matrix.device) @ matrix.mean(dim=0)
+            best = int(scores.argmax())
+            similarity = float(scores[best])
+            if similarity > self.new_speaker:
+                speaker = self.speakers[best]
+                speaker.update(matrix)
+                self._means[best] = speaker.mean
+                return speaker, similarity, False
+
+        return self.add_speaker(new_label, embeddings), consistency, True
@@ -0,0 +1,133 @@
+"""
+Reading and writing WebVTT and SRT subtitles in one pass over the file.
+
+read() is a generator of cues ({"start", "end", "text"}), lines of a cue
+are joined with <br> like mod_reformat always did. write() takes any
+iterable of cues (text a string or a list of lines) and writes them a
+block at a time, with the timestamps of a block formatted in one go.
+"""
+
+import re
+import itertools
+
+import numpy as np
+
+CUE_TIMES = re.compile(r"((?:\d+:)?\d+:\d+[,.]\d+) --> ((?:\d+:)?\d+:\d+[,.]\d+)")
+INDEX = re.compile(r"\d+$")
+
+
+def time2sec(t):
+    """
+    Seconds from a "[hh:]mm:ss,mmm" or "[hh:]mm:ss.mmm" timestamp
+    """
+    t, ms = re.split("[,.]", t)
+    parts = t.split(":")
+    h = parts[0] if len(parts) == 3 else 0
+    return int(h) * 3600 + int(parts[-2]) * 60 + int(parts[-1]) + (int(ms) / 1000.)
+
+
+def sec2time(sec, separator="."):
+    return format_times([sec], separator)[0]
+
+
+def format_times(secs, separator="."):
+    """
+    "hh:mm:ss.mmm" for all the given seconds
+    """
+    secs = np.asarray(secs, dtype=np.float64)
+    h = (secs // 3600).astype(np.int64).tolist()
+    m = ((secs // 60) % 60).astype(np.int64).tolist()
+    s = (secs % 60).astype(np.int64).tolist()
+    ms = ((secs - np.trunc(secs)) * 1000).astype(np.int64).tolist()
+    fmt = "%02d:%02d:%02d" + separator + "%03d"
+    return [fmt % t for t in zip(h, m, s, ms)]
+
+
+def read(filename, default_who=None):
+    """
+    Generator of the cues of a VTT or SRT file. A line starting with "-"
+    within a cue is a new speaker, and is given as a cue of its own.
+    """
+    start = end = None
+    text = ""
+
+    def cue(start, end, text):
+        s = {"start": start, "end": end, "text": text}
+        if default_who:
+            s["who"] = default_who
+        return s
+
+    with open(filename, "r", encoding="utf-8-sig") as f:
+        for line in f:
+            line = line.strip()
+            if text and line.startswith("-"):
+                yield cue(time2sec(start) + 0.01, time2sec(end), line[1:].strip())
+                continue
+            elif line.startswith("-"):
+                line = line[1:]
+
+            if not line.strip():
+                # End of cue
+                if text and start and end:
+                    yield cue(time2sec(start), time2sec(end), text)
+                start = end = None
+                text = ""
+                continue
+
+            if INDEX.match(line):
+                # Just the index, we don't care
+                continue
+
+            m = CUE_TIMES.match(line)
+            if m:
+                start, end = m.groups()
+                continue
+
+            if text and text[-1] != "-":
+                text += "<br>" + line
+            else:
+                text = text[:-1] + line  # word has been divided
+
+    # No empty line after the last one
+    if text and start and end:
+        yield cue(time2sec(start), time2sec(end), text)
+
+
+def format_cues(cues, fmt="vtt", first=1, block_size=1000):
+    """
+    Generator of the text of the cues in blocks of block_size cues
+    """
+    separator = "," if fmt == "srt" else "."
+    counter = first
+    cues = iter(cues)
+    while True:
+        block = list(itertools.islice(cues, block_size))
+        if not block:
+            return
+        starts = format_times([c["start"] for c in block], separator)
+        ends = format_times([c["end"] for c in block], separator)
+        out = []
+        for cue, start, end in zip(block, starts, ends):
+            text = cue["text"]
+            if isinstance(text, list):
+                text = "\n".join(text)
+            out.append("%d\n%s --> %s\n%s\n\n" % (counter, start, end, text))
+            counter += 1
+        yield "".join(out)
+
+
+def write(cues, filename, header="FILE", fmt=None):
+    """
+    Write cues as VTT or SRT (default from the file extension)
+    """
+    if fmt is None:
+        fmt = "srt" if filename.lower().endswith(".srt") else "vtt"
+    with open(filename, "w", encoding="utf-8") as f:
+        if fmt == "vtt":
+            f.write("WEBVTT %s\n\n" % header)
+        for chunk in format_cues(cues, fmt):
+            f.write(chunk)
+
+
+def write_vtt(cues, filename, header="FILE"):
+    write(cues, filename, header, fmt="vtt")
@@ -0,0 +1,324 @@
+"""
+Align an edited text (e.g. corrected by GPT) with the words of the
+transcript it came from, so the edited words can get the timestamps of
+the words they replace.
+
+The alignment is Needleman-Wunsch over words. Words that are only once
+in both texts are anchors (like patience diff), and the blocks between
+them are aligned on their own, without a band when they are small and
+in a band that follows the alignment when not, so it's linear in the
+number of words for the local edits we get. Run this file to compare it
+with difflib on random edits. Words are compared by their normalized form
+(lowercase, no punctuation). The edited bits are then aligned again
+with similar words scoring higher than other substitutions, so they are
+lined up right when words are added or removed.
+"""
+
+import re
+import bisect
+import difflib
+import functools
+import collections
+
+MATCH = 2
+SIMILAR = 0
+SUBSTITUTE = -1
+GAP = -1
+
+_strip = re.compile(r"[^\w]+")
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize(word):
+    return _strip.sub("", word.lower())
+
+
+@functools.lru_cache(maxsize=262144)
+def _similarity(a, b):
+    if a == b:
+        return 1.0
+    if not a or not b or 2.0 * min(len(a), len(b)) / (len(a) + len(b)) < 0.5:
+        return 0.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def similarity(word1, word2):
+    """
+    0-1, how alike two words are ignoring case and punctuation
+    """
+    return _similarity(normalize(word1), normalize(word2))
+
+
+def _align(a, b, band=None, threshold=None):
+    """
+    Needleman-Wunsch over the normalized words a and b. With a band, only
+    cells scoring at most band below the best cell of their row are kept
+    and followed to the next row, so the rows follow the alignment through
+    added and removed words (up to about band of them in a row) wherever
+    it goes. Without a threshold only equal words score, which is much
+    cheaper.
+    """
+    n, m = len(a), len(b)
+    lo = [0] * (n + 1)
+    hi = [m] * (n + 1)
+    if band is not None:
+        hi[0] = min(m, band)
+
+    # trace: 0 diagonal, 1 up (word only in a), 2 left (only in b)
+    scores = [GAP * j for j in range(hi[0] + 1)]
+    trace = [bytes([2]) * (hi[0] + 1)]
+    for i in range(1, n + 1):
+        plo, phi, prev = lo[i - 1], hi[i - 1], scores
+        rlo, rhi = plo, phi + 1
+        if band is not None:
+            # Only go on from the cells that are still in the running
+            limit = max(prev) - band
+            kept = [j for j, score in enumerate(prev, plo) if score >= limit]
+            rlo, rhi = kept[0], kept[-1] + 1
+        word = a[i - 1]
+        scores = []
+        row = bytearray()
+        row_best = None
+        j = rlo
+        while j <= m:
+            best = None
+            if plo <= j - 1 <= phi:
+                other = b[j - 1]
+                if word == other:
+                    best = prev[j - 1 - plo] + MATCH
+                elif threshold is not None and _similarity(word, other) >= threshold:
+                    best = prev[j - 1 - plo] + SIMILAR
+                else:
+                    best = prev[j - 1 - plo] + SUBSTITUTE
+                move = 0
+            if plo <= j <= phi and (best is None or prev[j - plo] + GAP > best):
+                best = prev[j - plo] + GAP
+                move = 1
+            # On a tie, line up the first words and leave the added ones last
+            if j > rlo and (best is None or scores[-1] + GAP >= best):
+                best = scores[-1] + GAP
+                move = 2
+            if j > rhi and band is not None and best < row_best - band:
+                break  # Words only in b, but too many of them
+            if row_best is None or best > row_best:
+                row_best = best
+            scores.append(best)
+            row.append(move)
+            j += 1
+            if band is None and j > rhi:
+                break
+        lo[i], hi[i] = rlo, rlo + len(scores) - 1
+        trace.append(bytes(row))
+
+    # If the band doesn't reach the end of b, the rest of b is added words
+    path = [(None, j) for j in range(m - 1, hi[n] - 1, -1)]
+    i, j = n, hi[n]
+    while i > 0 or j > 0:
+        move = trace[i][j - lo[i]]
+        if move == 0:
+            i -= 1
+            j -= 1
+            path.append((i, j))
+        elif move == 1:
+            i -= 1
+            path.append((i, None))
+        else:
+            j -= 1
+            path.append((None, j))
+    path.reverse()
+    return path
+
+
+def _anchors(a, b):
+    """
+    Pairs (i, j) of words that are only once in both a and b, and have a
+    neighbour that is the same too (so an added word that happens to be
+    in a somewhere else isn't one), the longest chain of them that is in
+    the same order in both (patience diff)
+    """
+    count_a = collections.Counter(a)
+    count_b = collections.Counter(b)
+    where = {word: j for j, word in enumerate(b) if count_b[word] == 1}
+    pairs = []
+    for i, word in enumerate(a):
+        if count_a[word] == 1 and word in where:
+            j = where[word]
+            if (i > 0 and j > 0 and a[i - 1] == b[j - 1]) or \
+               (i + 1 < len(a) and j + 1 < len(b) and a[i + 1] == b[j + 1]):
+                pairs.append((i, j))
+
+    # Longest increasing subsequence of j
+    tails = []
+    tail_idx = []
+    before = [None] * len(pairs)
+    for k, (i, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        before[k] = tail_idx[pos - 1] if pos else None
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(k)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = k
+    chain = []
+    k = tail_idx[-1] if tail_idx else None
+    while k is not None:
+        chain.append(pairs[k])
+        k = before[k]
+    chain.reverse()
+    return chain
+
+
+def _align_anchored(a, b, band, max_block):
+    """
+    _align between the anchors, so the alignment can't get lost for long,
+    whole blocks (up to max_block x max_block words) without a band
+    """
+    path = []
+    i0 = j0 = 0
+    for i1, j1 in _anchors(a, b) + [(len(a), len(b))]:
+        if i1 > i0 or j1 > j0:
+            small = (i1 - i0) * (j1 - j0) <= max_block * max_block
+            path.extend((None if x is None else x + i0, None if y is None else y + j0)
+                        for x, y in _align(a[i0:i1], b[j0:j1], None if small else band))
+        if i1 < len(a):
+            path.append((i1, j1))
+        i0, j0 = i1 + 1, j1 + 1
+    return path
+
+
+def align(original, modified, band=20, threshold=0.8, max_block=100):
+    """
+    Align two lists of words. Returns the path as a list of (i, j), where
+    i is an index in original and j in modified, None for a word that is
+    only in the other one.
+
+    The words are aligned on equal words first, then the blocks between
+    those (the edits) are aligned again taking similar words into account.
+    """
+    a = [normalize(w) for w in original]
+    b = [normalize(w) for w in modified]
+    path = _align_anchored(a, b, band, max_block)
+
+    result = []
+    k = 0
+    while k < len(path):
+        i, j = path[k]
+        if i is not None and j is not None and a[i] == b[j]:
+            result.append(path[k])
+            k += 1
+            continue
+        end = k
+        while end < len(path) and not (path[end][0] is not None and path[end][1] is not None and
+                                        a[path[end][0]] == b[path[end][1]]):
+            end += 1
+        ii = [p[0] for p in path[k:end] if p[0] is not None]
+        jj = [p[1] for p in path[k:end] if p[1] is not None]
+        if ii and jj and len(ii) * len(jj) <= max_block * max_block:
+            i0, j0 = ii[0], jj[0]
+            result.extend((None if x is None else x + i0, None if y is None else y + j0)
+                          for x, y in _align(a[i0:ii[-1] + 1], b[j0:jj[-1] + 1],
+                                             threshold=threshold))
+        else:
+            result.extend(path[k:end])
+        k = end
+    return result
+
+
+def join_subwords(words):
+    """
+    Tokens without a leading space are the rest of the word before, join
+    them to whole words
+    """
+    joined = []
+    for word in words:
+        if word["text"].startswith(" ") or not joined:
+            joined.append(dict(word))
+        else:
+            joined[-1]["text"] += word["text"]
+            joined[-1]["end"] = word["end"]
+    return joined
+
+
+def retime(text, words, band=20):
+    """
+    Words with timestamps for text, an edited version of the text of
+    words. A word gets the time of the word it is aligned with (also if
+    it was changed), added words share the time between their neighbours.
+    """
+    words = join_subwords(words)
+    tokens = text.replace("\n", " ").split()
+    new = [None] * len(tokens)
+    for i, j in align([w["text"] for w in words], tokens, band):
+        if i is not None and j is not None:
+            new[j] = {"start": words[i]["start"], "end": words[i]["end"], "text": " " + tokens[j]}
+            if "speaker" in words[i]:
+                new[j]["speaker"] = words[i]["speaker"]
+
+    j = 0
+    while j < len(new):
+        if new[j]:
+            j += 1
+            continue
+        last = j
+        while last < len(new) and not new[last]:
+            last += 1
+        if j > 0:
+            start = new[j - 1]["end"]
+        else:
+            start = words[0]["start"] if words else 0
+        if last < len(new):
+            end = new[last]["start"]
+        else:
+            end = words[-1]["end"] if words else start
+        end = max(start, end)
+        step = (end - start) / (last - j)
+        for k in range(j, last):
+            new[k] = {"start": start + (k - j) * step, "end": start + (k - j + 1) * step,
+                      "text": " " + tokens[k]}
+        j = last
+    return new
+
+
+def self_check(cases=500, band=20, min_ratio=0.85):
+    """
+    Align random texts with runs of up to 10 added, removed and changed
+    words and compare the number of equal words lined up with difflib.
+    Raises if a path is broken or a case gets less than min_ratio of what
+    difflib finds.
+    """
+    import random
+    worst = 1.0
+    for seed in range(cases):
+        r = random.Random(seed)
+        vocab = ["w%d" % i for i in range(r.choice([20, 200, 2000]))]
+        a = [r.choice(vocab) for _ in range(r.randint(50, 600))]
+        b = []
+        k = 0
+        while k < len(a):
+            x = r.random()
+            if x < 0.04:
+                b += [r.choice(vocab) for _ in range(r.randint(1, 10))]
+            elif x < 0.08:
+                k += r.randint(1, 10)
+            else:
+                b.append(a[k] if x >= 0.1 else r.choice(vocab))
+                k += 1
+
+        path = align(a, b, band)
+        if [i for i, j in path if i is not None] != list(range(len(a))) or \
+           [j for i, j in path if j is not None] != list(range(len(b))):
+            raise Exception("Broken path for case %d" % seed)
+        ours = sum(1 for i, j in path if i is not None and j is not None and a[i] == b[j])
+        theirs = sum(m.size for m in difflib.SequenceMatcher(None, a, b, autojunk=False)
+                     .get_matching_blocks())
+        ratio = ours / theirs if theirs else 1.0
+        if ratio < min_ratio:
+            raise Exception("Case %d: %d equal words lined up, difflib finds %d" %
+                            (seed, ours, theirs))
+        worst = min(worst, ratio)
+    print("%d cases, worst %.2f of difflib" % (cases, worst))
+
+
+if __name__ == "__main__":
+    self_check()
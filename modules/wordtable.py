@@ -0,0 +1,178 @@
+import numpy as np
+
+import artefacts
+
+
+class WordTable:
+    """
+    Word timestamps of a transcript as columns instead of a dict per word.
+
+    start, end and score (nan if missing) are float arrays, speaker is the
+    index of the word's speaker in speakers (-1 for none). The text of all
+    the words is one string, word i is text[offsets[i]:offsets[i + 1]].
+
+    The segments themselves (text, start, end, speaker, ...) are kept as
+    dicts without their words, with bounds[i]:bounds[i + 1] being the
+    words of segment i, so merging segments doesn't touch the words.
+    A multi-hour transcript is a few MB this way, not hundreds.
+    """
+
+    def __init__(self, start, end, score, speaker, text, offsets, segments, bounds,
+                 speakers, score_key="score"):
+        self.start = start
+        self.end = end
+        self.score = score
+        self.speaker = speaker
+        self.text = text
+        self.offsets = offsets
+        self.segments = segments
+        self.bounds = bounds
+        self.speakers = speakers
+        self.score_key = score_key
+
+    @staticmethod
+    def load(filename):
+        """
+        Load a transcript from whisperx, whisper(_timestamped) or the
+        transformer pipeline (mod_whisper), a list of segments or a dict
+        with "segments"
+        """
+        return WordTable.from_segments(artefacts.load_segments(filename))
+
+    @staticmethod
+    def from_segments(segments, whisperx=False):
+        """
+        Build a table from segments with "words". Words have their text
+        as "text" (whisper_timestamped, pipeline) or "word" (raw whisperx).
+        With whisperx the text gets a leading space like the other
+        formats, and words that couldn't be aligned (no timestamps) get
+        the end of the word before.
+        """
+        n = sum(len(s.get("words", [])) for s in segments)
+        start = np.zeros(n)
+        end = np.zeros(n)
+        score = np.full(n, np.nan)
+        speaker = np.full(n, -1, dtype=np.int16)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        bounds = np.zeros(len(segments) + 1, dtype=np.int64)
+        texts = []
+        speakers = {}
+        score_key = "score"
+        meta = []
+
+        i = 0
+        length = 0
+        for idx, segment in enumerate(segments):
+            last_end = segment.get("start", 0)
+            for word in segment.get("words", []):
+                if whisperx:
+                    text = " " + word["word"]
+                else:
+                    text = word["text"] if "text" in word else word["word"]
+                texts.append(text)
+                length += len(text)
+                offsets[i + 1] = length
+                start[i] = word.get("start", last_end)
+                end[i] = word.get("end", last_end)
+                last_end = end[i]
+                if "score" in word or "confidence" in word:
+                    score_key = "score" if "score" in word else "confidence"
+                    score[i] = word[score_key]
+                if "speaker" in word:
+                    speaker[i] = speakers.setdefault(word["speaker"], len(speakers))
+                i += 1
+            bounds[idx + 1] = i
+            meta.append({k: v for k, v in segment.items() if k != "words"})
+
+        return WordTable(start, end, score, speaker, "".join(texts), offsets, meta, bounds,
+                         list(speakers), score_key)
+
+    def __len__(self):
+        return len(self.start)
+
+    def word(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+    def texts(self, first=0, last=None):
+        """
+        The texts of words first to last (exclusive) as a list
+        """
+        if last is None:
+            last = len(self)
+        offsets = self.offsets[first:last + 1].tolist()
+        return [self.text[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    def words(self, first=0, last=None):
+        """
+        Words first to last (exclusive) as the usual list of dicts
+        """
+        if last is None:
+            last = len(self)
+        words = []
+        for i, text in enumerate(self.texts(first, last), first):
+            word = {"start": float(self.start[i]), "end": float(self.end[i]), "text": text}
+            if not np.isnan(self.score[i]):
+                word[self.score_key] = float(self.score[i])
+            if self.speaker[i] >= 0:
+                word["speaker"] = self.speakers[self.speaker[i]]
+            words.append(word)
+        return words
+
+    def segment_range(self, idx):
+        return int(self.bounds[idx]), int(self.bounds[idx + 1])
+
+    def segment_words(self, idx):
+        return self.words(*self.segment_range(idx))
+
+    def segment_ids(self):
+        """
+        The segment index of every word
+        """
+        return np.repeat(np.arange(len(self.segments)), np.diff(self.bounds))
+
+    def regroup(self, groups, segments):
+        """
+        A table where segment i is segments[i] with the words of the
+        segments groups[i] of this one, e.g. merged segments. Words of
+        segments that are in no group are dropped. If all are still
+        there in the same order (the usual case), the columns are shared.
+        """
+        ranges = [self.segment_range(idx) for group in groups for idx in group]
+        counts = [sum(self.bounds[idx + 1] - self.bounds[idx] for idx in group) for group in groups]
+        bounds = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+        pos = 0
+        for first, last in ranges:
+            if first != pos:
+                break
+            pos = last
+        else:
+            if pos == len(self):
+                return WordTable(self.start, self.end, self.score, self.speaker, self.text,
+                                 self.offsets, segments, bounds, self.speakers, self.score_key)
+
+        # Some words are dropped or moved, take the ones we need
+        index = np.concatenate([np.arange(first, last) for first, last in ranges] +
+                               [np.zeros(0, dtype=np.int64)])
+        pieces = []
+        offsets = [np.zeros(1, dtype=np.int64)]
+        length = 0
+        for first, last in ranges:
+            a, b = self.offsets[first], self.offsets[last]
+            pieces.append(self.text[a:b])
+            offsets.append(self.offsets[first + 1:last + 1] - a + length)
+            length += b - a
+        return WordTable(self.start[index], self.end[index], self.score[index],
+                         self.speaker[index], "".join(pieces), np.concatenate(offsets),
+                         segments, bounds, self.speakers, self.score_key)
+
+    def to_segments(self):
+        """
+        Back to a list of segments with "words"
+        """
+        segments = []
+        for idx, segment in enumerate(self.segments):
+            segment = dict(segment)
+            segment["words"] = self.segment_words(idx)
+            segments.append(segment)
+        return segments
@@ -0,0 +1,57 @@
+"""
+Golden output test for mod_reformat2: a whisperx transcript is fixed up
+like mod_whisper does and reformatted to vtt and json, which must be the
+same as what the code before the CutPoints/WordTable rewrite made.
+
+data/whisperx.json is in the format whisperx writes (words with "word",
+numbers without timestamps, speakers), data/whisperx_reformat2.* are the
+outputs of the old code for it. Run with pytest, or as a script.
+"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "modules"))
+
+import mod_reformat2  # noqa: E402
+from mod_whisper import fix_whisperx_output  # noqa: E402
+
+DATA = os.path.join(HERE, "data")
+
+
+def reformat(fileformat, tmpdir):
+    words = os.path.join(tmpdir, "words.json")
+    shutil.copy(os.path.join(DATA, "whisperx.json"), words)
+    fix_whisperx_output(words)
+    dst = os.path.join(tmpdir, "subs." + fileformat)
+    cc = types.SimpleNamespace(log=logging.getLogger("test"))
+    mod_reformat2.process_task(cc, {"args": {"src": words, "dst": dst}})
+    return dst
+
+
+def test_vtt():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(reformat("vtt", tmpdir), "r", encoding="utf-8") as f:
+            result = f.read()
+    with open(os.path.join(DATA, "whisperx_reformat2.vtt"), "r", encoding="utf-8") as f:
+        assert result == f.read()
+
+
+def test_json():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with open(reformat("json", tmpdir), "r") as f:
+            result = json.load(f)
+    with open(os.path.join(DATA, "whisperx_reformat2.json"), "r") as f:
+        assert result == json.load(f)
+
+
+if __name__ == "__main__":
+    test_vtt()
+    test_json()
+    print("ok")
@@ -6,6 +6,9 @@ export CC_DIR=/home/cryocore/git/cryocloud
 echo "Starting CPU node"
 screen -d -m /data/cpunode
 sleep 1s
+echo "Starting model server"
+screen -d -m -S modelserver -L -Logfile /tmp/modelserver.log /data/modelserver
+sleep 1s
 echo "Starting GPU nodes"
 screen -d -m -S cpunode -L -Logfile /tmp/cpunode.log /data/cpunode
 screen -d -m -S gpunode1 -L -Logfile /tmp/gpunode0.log /data/gpunode0